@@ -6,391 +6,531 @@ convertPheno takes in patient data in the OMOP CDM format and transforms that da
     - PARSING parse SQL output to a dictionary 
     - FORMATTING make necessary conversions and transformations from OMOP to Phenopacket data
     - PHENOPACKET CREATION generate and save the Phenopacket data  
+- PIPELINE runs the four groups chunk by chunk over a cohort; the work queue, the conversion service and the command line 
+  that expose it are in the omop2pheno package (`python -m omop2pheno`)
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from google.protobuf.json_format import Parse, MessageToJson
+from google.protobuf.json_format import Parse, MessageToJson, MessageToDict
 from google.protobuf.timestamp_pb2 import Timestamp
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.internal import type_checkers
 
 from phenopackets import Phenopacket,Individual, Disease, Sex, PhenotypicFeature, OntologyClass,Treatment, \
-		TimeElement,Procedure,VitalStatus,Quantity,Measurement,Value, MedicalAction, DoseInterval
+		TimeElement,Procedure,VitalStatus,Quantity,Measurement,Value, MedicalAction, DoseInterval, DrugType, \
+		ReferenceRange, TimeInterval
 
 
 import operator
+import numpy as np
 import pandas as pd
 
+import base64
+import bz2
+import contextlib
+import cProfile
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import lzma
+import math
+import mmap
+import os
+import pickle
+import pstats
+import random
+import re
+import struct
+import socket
+import tempfile
+import threading
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import time
 import logging
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
 # SQL QUERIES
-def get_individual_query(pid, db):
-    logging.info(f"Extracting individual data")
-	
-    query = """select p3.id,
-       null as alternate_ids,
-       p3.date_of_birth,
-       max(vo.visit_start_date) as time_at_last_encounter,
-       p3.vital_status,
-       p3.sex,
-       null as karyotypic_sex,
-       null as gender,
-       'NCBITaxon:9606' as taxonomy_id,
-       'human' as taxonomy_label
-       from (
-           select p2.id,p2.date_of_birth, p2.sex,
-           (case when p2.death_pid is null then 0 else 2 end) as vital_status
-           from (
-            select p1.*, d.person_id as death_pid
-            from
-            (select p.person_id as id,
-            p.birth_datetime as date_of_birth,
-            (case when p.gender_concept_id is null then 0
+# Each domain query selects from a column list of (result column, select expression, profile field). Columns of a 
+# profile field (see get_profile) and the joins they need are only queried when the field is enabled; fields = None 
+# queries every column. The parse_* functions read the same column lists. 
+# filters are extra where conditions of the event domains (see get_event_filters).
+INDIVIDUAL_COLUMNS = [
+    ('id', 'p.person_id', None),
+    ('date_of_birth', 'p.birth_datetime', None),
+    ('time_at_last_encounter', 'max(vo.visit_start_date)', 'time_at_last_encounter'),
+    ('vital_status', '(case when d.person_id is null then 0 else 2 end)', 'vital_status'),
+    ('sex', """(case when p.gender_concept_id is null then 0
             when p.gender_concept_id = 8532 then 1
             when p.gender_concept_id = 8507 then 2
-            else 3 end) as sex
-            from """ + db + """person p
-            WHERE p.person_id in """ + pid + """) p1
-            left join """ + db + """death d
-            on p1.id = d.person_id) p2) p3
-            left join """ + db + """visit_occurrence vo
-            on p3.id = vo.person_id
-            group by p3.id,p3.sex,p3.date_of_birth,p3.vital_status;"""
+            else 3 end)""", 'sex'),
+    ('taxonomy_id', "'NCBITaxon:9606'", 'taxonomy'),
+    ('taxonomy_label', "'human'", 'taxonomy'),
+]
+
+VITAL_STATUS_COLUMNS = [
+    ('person_id', 'p.person_id', None),
+    ('vital_status', '(case when d.person_id is null then 0 else 2 end)', None),
+    ('time_of_death', 'd.death_datetime', 'vital_status.time_of_death'),
+]
+
+CONDITION_COLUMNS = [
+    ('person_id', 'co.person_id', None),
+    ('term_id', "concat(c.vocabulary_id,':',c.concept_code)", None),
+    ('term_label', 'c.concept_name', None),
+    ('onset_timestamp', 'co.condition_start_date', None),
+    ('resolution', 'co.condition_end_date', 'resolution'),
+    ('primary_site_id', """case when cr.concept_id_2 is null then null
+          else concat(c2.vocabulary_id, ':', c2.concept_code) end""", 'primary_site'),
+    ('primary_site_label', 'c2.concept_name', 'primary_site'),
+    ('concept_id', 'c.concept_id', None),
+]
+
+PHENOFEATURE_COLUMNS = [
+    ('person_id', 'obs.person_id', None),
+    ('type_id', "concat(c.vocabulary_id, ':', c.concept_code)", None),
+    ('type_label', 'c.concept_name', None),
+    ('modifier_id', """case when obs.value_as_concept_id is null then null
+          else concat(c2.vocabulary_id, ':', c2.concept_code) end""", 'modifiers'),
+    ('modifier_label', 'c2.concept_name', 'modifiers'),
+    ('description', 'obs.value_as_string', 'description'),
+    ('onset_timestamp', 'obs.observation_datetime', None),
+]
+
+MEASUREMENT_COLUMNS = [
+    ('person_id', 'm.person_id', None),
+    ('assay_id', "concat(c.vocabulary_id,':',c.concept_code)", None),
+    ('assay_label', 'c.concept_name', None),
+    ('value_as_number', 'm.value_as_number', None),
+    ('value_id', "concat(c3.vocabulary_id,':',c3.concept_code)", None),
+    ('value_label', 'c3.concept_name', None),
+    ('range_low', 'm.range_low', 'measurement_value.reference_range'),
+    ('range_high', 'm.range_high', 'measurement_value.reference_range'),
+    ('measurement_datetime', 'm.measurement_datetime', 'time_observed'),
+    ('unit_id', "concat(c2.vocabulary_id,':',c2.concept_code)", 'measurement_value.unit'),
+    ('unit_label', 'c2.concept_name', 'measurement_value.unit'),
+]
+
+TREATMENT_COLUMNS = [
+    ('person_id', 'de.person_id', None),
+    ('agent_id', "concat(c.vocabulary_id,':',c.concept_code)", None),
+    ('agent_label', 'c.concept_name', None),
+    ('route_of_administration_id', """case when c2.concept_code is null then null
+          else concat(c2.vocabulary_id,':',c2.concept_code) end""", 'route_of_administration'),
+    ('route_of_administration_label', 'c2.concept_name', 'route_of_administration'),
+    # dose intervals: dosage, looked up client-side in the drug strength index (see add_drug_strength)
+    ('drug_concept_id', 'de.drug_concept_id', 'dose_intervals.quantity'),
+    ('interval_start', 'de.drug_exposure_start_date', None),
+    ('interval_end', 'dateadd(day, de.days_supply,de.drug_exposure_start_date)', None),
+    ('drug_type_id', 'de.drug_type_concept_id', None),
+    ('sched_freq', 'CASE WHEN de.days_supply = 0 THEN 0 ELSE CEILING(de.quantity / de.days_supply) END', 'dose_intervals.schedule_frequency'),
+]
+
+PROCEDURE_COLUMNS = [
+    ('person_id', 'po.person_id', None),
+    ('code_id', "concat(c.vocabulary_id, ':', c.concept_code)", None),
+    ('code_label', 'c.concept_name', None),
+    ('body_site_id', """case when c2.concept_id is null then null
+          else concat(c2.vocabulary_id,':',c2.concept_id) end""", 'body_site'),
+    ('body_site_label', 'c2.concept_name', 'body_site'),
+    ('performed_timestamp', 'po.procedure_datetime', None),
+]
+
+def query_columns(columns, fields = None):
+    # The (result column, select expression) pairs of a column list that are queried for the enabled profile fields
+    return [(name, expr) for name, expr, field in columns if field is None or fields is None or field in fields]
+
+def select_list(columns, fields = None):
+    return ",\n       ".join(expr + " as " + name for name, expr in query_columns(columns, fields))
+
+def enabled(field, fields):
+    return fields is None or field in fields
+
+def get_individual_query(pid, db, fields = None):
+    logging.info(f"Extracting individual data")
+
+    query = """select """ + select_list(INDIVIDUAL_COLUMNS, fields) + """
+       from """ + db + """person p"""
+    group_by = ['p.person_id', 'p.birth_datetime', 'p.gender_concept_id']
+    if enabled('vital_status', fields):
+        query += """
+       left join """ + db + """death d
+       on p.person_id = d.person_id"""
+        group_by.append('d.person_id')
+    if enabled('time_at_last_encounter', fields):
+        query += """
+       left join """ + db + """visit_occurrence vo
+       on p.person_id = vo.person_id"""
+    query += """
+       WHERE p.person_id in """ + pid + """
+       group by """ + ",".join(group_by) + """;"""
     return query
 
-def get_vitalstatus_query(pid, db):
+def get_vitalstatus_query(pid, db, fields = None):
     logging.info(f"Extracting vital status data")
-    query =  """select * from (select id as person_id,
-       (case when pid_death.death_pid is null then 0 else 2 end) as vital_status,
-       pid_death.time_of_death,
-       null as cause_of_death_id,
-       null as cause_of_death_label
-       from (
-        select p.person_id as id, d.person_id as death_pid, d.death_datetime as time_of_death
-        from """ + db + """person p left join death d
-        on p.person_id = d.person_id
-        where p.person_id in """ + pid + """) pid_death) p1
-        group by person_id, vital_status, time_of_death, cause_of_death_id, cause_of_death_label;"""
+    query = """select distinct """ + select_list(VITAL_STATUS_COLUMNS, fields) + """
+       from """ + db + """person p left join """ + db + """death d
+       on p.person_id = d.person_id
+       where p.person_id in """ + pid + """;"""
     return query 
 
-def get_condition_query(pid, db, ohdsi_db):
+def get_condition_query(pid, db, ohdsi_db, fields = None, filters = ''):
     logging.info(f"Extracting condition data")
-    query = """select a.person_id,
-      a.term_id,
-      a.term_label,
-      a.condition_source_value,
-      a.excluded,
-      a.onset_timestamp,
-      a.resolution,
-      a.clinical_tnm_finding_id,
-      a.clinical_tnm_finding_label,
-      case when a.primary_site_concept is null then null
-          else concat(primary_site_vocab, ':', primary_site_code)
-          end as primary_site_id,
-      a.primary_site_label, 
-      a.concept_id
-    from
-    (select co.person_id,
-
-
-        -- TERM
-        concat(c.vocabulary_id,':',c.concept_code) as term_id,
-        c.concept_name as term_label,
-        c.concept_id,
-        co.condition_source_value,
-
-
-        -- Excluded
-        0 as excluded,
-
-
-        -- Onset
-        co.condition_start_date as onset_timestamp,
-        co.condition_end_date as resolution,
-
-
-        -- Clinical_tnm_finding
-        null as clinical_tnm_finding_id,
-        null as clinical_tnm_finding_label,
-
-
-        -- Primary Site
-        cr.concept_id_2 as primary_site_concept,
-        c2.concept_name as primary_site_label,
-        c2.vocabulary_id as primary_site_vocab,
-        c2.concept_code as primary_site_code
-
-
+    query = """select """ + select_list(CONDITION_COLUMNS, fields) + """
     from """ + db + """condition_occurrence co
     left join """ + ohdsi_db + """concept c
-    on co.condition_concept_id = c.concept_id
+    on co.condition_concept_id = c.concept_id"""
+    if enabled('primary_site', fields):
+        query += """
     left join """ + ohdsi_db + """concept_relationship cr
     on cr.concept_id_1 = co.condition_concept_id and cr.relationship_id = 'Has finding site'
     left join """ + ohdsi_db + """concept c2
-    on cr.concept_id_2 = c2.concept_id
-    where person_id in """ + pid + """) a;"""
+    on cr.concept_id_2 = c2.concept_id"""
+    query += """
+    where co.person_id in """ + pid + filters + """;"""
 
     return query
 
-def get_phenofeature_query(pid, db, ohdsi_db):
+def get_phenofeature_query(pid, db, ohdsi_db, fields = None, filters = ''):
     logging.info(f"Extracting phenotypic feature data")
-    query = """select a.person_id, 
-    a.type_id,
-      a.type_label,
-      case when a.value_as_concept_id is null then null
-          else concat(a.modifier_vocab, ':', a.modifier_code) end as modifier_id,
-      a.modifier_label,
-      case when a.value_as_string is null then null
-          else a.value_as_string end as description,
-	  a.observation_datetime as onset_timestamp,
-      concat('P',datediff(yyyy,a.birth_datetime,a.observation_datetime),'Y') as onset_age
-    from (select obs.person_id, 
-	    c.concept_name as type_label,
-        concat(c.vocabulary_id, ':', c.concept_code) as type_id,
-        obs.observation_concept_id,
-        obs.value_as_concept_id,
-        c2.concept_name as modifier_label,
-        c2.vocabulary_id as modifier_vocab,
-        c2.concept_code as modifier_code,
-        obs.value_as_string,
-        obs.value_as_number,
-        obs.observation_datetime,
-        p.birth_datetime
+    query = """select """ + select_list(PHENOFEATURE_COLUMNS, fields) + """
     from """ + db + """observation obs
     left join """ + ohdsi_db + """concept c
-    on obs.observation_concept_id = c.concept_id
-    left join person p
-    on obs.person_id = p.person_id
+    on obs.observation_concept_id = c.concept_id"""
+    if enabled('modifiers', fields):
+        query += """
     left join """ + ohdsi_db + """concept c2
-    on obs.value_as_concept_id = c2.concept_id
-    where obs.person_id in """ + pid + """) a;"""
+    on obs.value_as_concept_id = c2.concept_id"""
+    query += """
+    where obs.person_id in """ + pid + filters + """;"""
 
     return query 
 
-def get_measurement_query(pid, db, ohdsi_db):
+def get_measurement_query(pid, db, ohdsi_db, fields = None, filters = ''):
     logging.info(f"Extracting measurement data")
-    query =  """select m.person_id,
-       m.measurement_concept_id,
-     -- ASSAY
-    concat(c.vocabulary_id,':',c.concept_code) as assay_id,
-    c.concept_name as assay_label,
-    -- VALUE - QUANTITY/NUMERIC
-    m.value_as_number,
-     -- VALUE - ORDINAL/Categorical/OntologyClass
-    concat(c3.vocabulary_id,':',c3.concept_code) as value_id,
-    c3.concept_name as value_label,
-
-    -- RANGe
-    m.range_low,
-    m.range_high,
-
-
-    -- time_observed
-    m.measurement_datetime,
-    -- UNIT
-    concat(c2.vocabulary_id,':',c2.concept_code) as unit_id,
-    c2.concept_name as unit_label,
-
-    c2.concept_id,
-    m.unit_source_value,
-
-    m.visit_occurrence_id,
-
-    row_number() over (partition by m.person_id, m.measurement_datetime, m.visit_occurrence_id order by m.person_id) as row_number
+    query = """select """ + select_list(MEASUREMENT_COLUMNS, fields) + """
     FROM """ + db + """measurement m
-    left join """ + ohdsi_db + """concept c on c.concept_id = m.measurement_concept_id
-    left join """ + ohdsi_db + """concept c2 on c2.concept_id = m.unit_concept_id
+    left join """ + ohdsi_db + """concept c on c.concept_id = m.measurement_concept_id"""
+    if enabled('measurement_value.unit', fields):
+        query += """
+    left join """ + ohdsi_db + """concept c2 on c2.concept_id = m.unit_concept_id"""
+    query += """
     left join """ + ohdsi_db + """concept c3 on c3.concept_id = m.value_as_concept_id
-    where m.person_id in """ + pid + """;"""
+    where m.person_id in """ + pid + filters + """;"""
 
     return query
 
-def get_treatment_query(pid, db, ohdsi_db):
+def get_treatment_query(pid, db, ohdsi_db, fields = None, filters = ''):
     logging.info(f"Extracting treatment data")
-    query = get_treatment_query = """select a.person_id,
-      a.agent_id,
-      a.agent_label,
-      case when route_administration_code is null then null
-          else concat(a.route_administration_vocab,':',a.route_administration_code) end as route_of_adminsitration_id,
-      a.route_of_adminsitration_label,
-      case when quantity_code_id is null then null
-          else concat(a.quantity_vocab_id,':',a.quantity_code_id) end as quantity_id,
-     a.quantity_unit_label,
-     a.quantity_value,
-     a.interval_start,
-     a.interval_end,
-     a.drug_type_id,
-     a.sched_freq
-    from
-    (select de.person_id,
-        -- Agent
-        concat(c.vocabulary_id,':',c.concept_code) as agent_id,
-        c.concept_name as agent_label,
-
-
-        -- Route of administration
-        c2.vocabulary_id as route_administration_vocab,
-        c2.concept_code as route_administration_code,
-        c2.concept_name as route_of_adminsitration_label,
-
-        -- schedule_Freq
-        CASE WHEN de.days_supply = 0 THEN 0 ELSE CEILING(de.quantity / de.days_supply)  END AS sched_freq,
-
-        -- Dose Intervals
-        -- dose intervals: dosage
-        ds.amount_value as quantity_value,
-        c3.vocabulary_id as quantity_vocab_id,
-        c3.concept_code as quantity_code_id,
-        c3.concept_name as quantity_unit_label,
-
-
-        -- dose intervals: interval start/end
-        de.drug_exposure_start_date as interval_start,
-        dateadd(day, de.days_supply,de.drug_exposure_start_date) as interval_end,
-
-
-        -- Drug_type
-        c4.concept_id as drug_type_id,
-        c4.concept_name as drug_type_name
-
-
+    query = """select """ + select_list(TREATMENT_COLUMNS, fields) + """
     from """ + db + """drug_exposure de
     left join """ + ohdsi_db + """concept c
-    on c.concept_id = de.drug_concept_id
-    left join """ + ohdsi_db + """concept c2 on c2.concept_id = de.route_concept_id
-    left join """ + ohdsi_db + """drug_strength ds -- joining for dosage based on drug concept id
-    on ds.drug_concept_id = de.drug_concept_id
-    left join """ + ohdsi_db + """concept c3
-    on c3.concept_id = ds.amount_unit_concept_id-- joining drug strength concept id to concept table to get vocab id and label (name) of unit ;
-    left join """ + ohdsi_db + """concept c4
-    on c4.concept_id = de.drug_type_concept_id
-    where person_id in """ + pid + """) a;
-    """
+    on c.concept_id = de.drug_concept_id"""
+    if enabled('route_of_administration', fields):
+        query += """
+    left join """ + ohdsi_db + """concept c2 on c2.concept_id = de.route_concept_id"""
+    query += """
+    where de.person_id in """ + pid + filters + """;"""
     return query
 
-def get_procedure_query(pid, db, ohdsi_db):
+def get_procedure_query(pid, db, ohdsi_db, fields = None, filters = ''):
     logging.info(f"Extracting procedure data")
-    query = """select a.person_id,
-      a.code_id,
-      a.code_label,
-      case when a.body_site_concept_id is null then null
-          else concat(body_site_vocab_id,':',body_site_concept_id) end as body_site_id,
-      a.body_site_label,
-      a.procedure_datetime as performed_timestamp,
-      concat('P',datediff(yyyy,a.birth_datetime,a.procedure_datetime),'Y') as performed_age
-    from
-    (select po.person_id,
-
-
-        -- code
-        concat(c.vocabulary_id, ':', c.concept_code) as code_id,
-        c.concept_name as code_label,
-
-
-        c2.concept_id as body_site_concept_id,
-        c2.vocabulary_id as body_site_vocab_id,
-        c2.concept_name as body_site_label,
-
-
-        po.procedure_datetime,
-        p.birth_datetime
-
-
+    query = """select """ + select_list(PROCEDURE_COLUMNS, fields) + """
     from """ + db + """procedure_occurrence po
     left join """ + ohdsi_db + """concept c
-    on c.concept_id = po.procedure_concept_id
+    on c.concept_id = po.procedure_concept_id"""
+    if enabled('body_site', fields):
+        query += """
     left join """ + ohdsi_db + """concept_relationship cr -- getting concept id of body site
     on cr.concept_id_1 = po.procedure_concept_id and cr.relationship_id = 'Has proc site'
     left join """ + ohdsi_db + """concept c2 -- getting vocab id, concept code, and name of body site
-    on c2.concept_id = cr.concept_id_2
-    left join """ + db + """person p 
-    on po.person_id = p.person_id
-    where po.person_id in """ + pid + """) a;"""
+    on c2.concept_id = cr.concept_id_2"""
+    query += """
+    where po.person_id in """ + pid + filters + """;"""
+
+    return query
+
+# OMOP domain -> (table, standard concept column, source concept column), used to select a cohort from a concept set
+COHORT_DOMAINS = {
+    'Condition': ('condition_occurrence', 'condition_concept_id', 'condition_source_concept_id'),
+    'Drug': ('drug_exposure', 'drug_concept_id', 'drug_source_concept_id'),
+    'Measurement': ('measurement', 'measurement_concept_id', 'measurement_source_concept_id'),
+    'Observation': ('observation', 'observation_concept_id', 'observation_source_concept_id'),
+    'Procedure': ('procedure_occurrence', 'procedure_concept_id', 'procedure_source_concept_id'),
+}
+
+def get_cohort_table_query(concepts, db, ohdsi_db, table, chunk_size, include_descendants = False):
+    """Input: 
+            - concepts: list of dicts with concept_id, domain_id and standard (see get_cohort_def)
+            - table: name of the server-side person table to create (e.g. '##omop2pheno_cohort')
+            - chunk_size: persons per chunk, stored as chunk_id next to every person_id 
+            - include_descendants: expands standard concepts to their descendants through concept_ancestor
+        Output: SQL creating table (person_id, chunk_id) with every person having any of the concepts
+    """
+    logging.info(f"Creating cohort table {table}")
+    selects = []
+    for domain_id, (domain_table, concept_col, source_col) in COHORT_DOMAINS.items():
+        standard = sorted({c['concept_id'] for c in concepts if c['domain_id'] == domain_id and c['standard']})
+        source = sorted({c['concept_id'] for c in concepts if c['domain_id'] == domain_id and not c['standard']})
+        conditions = []
+        if standard:
+            concept_set = '(' + ','.join(str(int(c)) for c in standard) + ')'
+            if include_descendants:
+                conditions.append(concept_col + """ in (select ca.descendant_concept_id
+                from """ + ohdsi_db + """concept_ancestor ca
+                where ca.ancestor_concept_id in """ + concept_set + """)""")
+            else:
+                conditions.append(concept_col + " in " + concept_set)
+        if source: # non-standard concepts (e.g. ICD9CM) are only recorded as source concepts
+            conditions.append(source_col + " in (" + ','.join(str(int(c)) for c in source) + ")")
+        if conditions:
+            selects.append("""select person_id from """ + db + domain_table + """
+            where """ + """
+            or """.join(conditions))
+
+    if not selects:
+        raise ValueError("Cohort definition has no concepts in a supported domain: " + ', '.join(COHORT_DOMAINS))
+
+    query = """select a.person_id,
+       (row_number() over (order by a.person_id) - 1) / """ + str(int(chunk_size)) + """ as chunk_id
+    into """ + table + """
+    from (
+        """ + """
+        union
+        """.join(selects) + """) a;
+    create clustered index ix_cohort_chunk on """ + table + """ (chunk_id, person_id);"""
+    return query
+
+def get_cohort_chunks_query(table):
+    # Persons per chunk and a fingerprint of which persons they are (lowest and highest person_id, checksum of all)
+    return """select chunk_id, count(*) as persons, min(person_id), max(person_id), checksum_agg(checksum(person_id))
+    from """ + table + """
+    group by chunk_id
+    order by chunk_id;"""
+
+def cohort_pid(table, chunk_id):
+    """Drop-in replacement for the '(1,2,3)' pid string: every get_*_query then joins against the cohort table on the server. 
+        The expression only names the chunk's number; the extraction cache and checkpoint keys take the chunk's membership 
+        (see read_cohort_chunks) separately.
+    """
+    return "(select person_id from " + table + " where chunk_id = " + str(int(chunk_id)) + ")"
+
+def get_drug_strength_query(ohdsi_db):
+    logging.info(f"Extracting drug strength data")
+    query = """select ds.drug_concept_id,
+      ds.ingredient_concept_id,
+      ds.amount_value,
+      concat(c.vocabulary_id,':',c.concept_code) as unit_id,
+      c.concept_name as unit_label
+    from """ + ohdsi_db + """drug_strength ds
+    join """ + ohdsi_db + """concept c
+    on c.concept_id = ds.amount_unit_concept_id
+    where ds.amount_value is not null
+    and (ds.invalid_reason is null or ds.invalid_reason = '');"""
+    return query
 
+def get_row_count_query(pid, db):
+    # Rows per person in the large domains, used to balance chunks (persons without rows are not returned)
+    query = """select a.person_id, count(*) as n
+    from (
+        select person_id from """ + db + """condition_occurrence where person_id in """ + pid + """
+        union all
+        select person_id from """ + db + """observation where person_id in """ + pid + """
+        union all
+        select person_id from """ + db + """measurement where person_id in """ + pid + """
+        union all
+        select person_id from """ + db + """drug_exposure where person_id in """ + pid + """
+        union all
+        select person_id from """ + db + """procedure_occurrence where person_id in """ + pid + """) a
+    group by a.person_id;"""
+    return query
+
+# table -> aggregate over a person's rows t that changes when a row is added; with the row count a fingerprint of the 
+# person's rows in that table (see get_freshness_query). visit_occurrence sets time_at_last_encounter.
+FRESHNESS_TABLES = {
+    'death': 'checksum_agg(checksum(t.death_datetime))',
+    'visit_occurrence': 'max(t.visit_occurrence_id)',
+    'condition_occurrence': 'max(t.condition_occurrence_id)',
+    'observation': 'max(t.observation_id)',
+    'measurement': 'max(t.measurement_id)',
+    'drug_exposure': 'max(t.drug_exposure_id)',
+    'procedure_occurrence': 'max(t.procedure_occurrence_id)',
+}
+
+def get_freshness_query(pid, db):
+    """Output: SQL returning (table, person_id, rows, version) per table and person, a fingerprint of each person's 
+        records that changes when rows are added or deleted, when the person's birth date or gender or the death date 
+        changes. Every existing person has a 'person' row, whose version is a checksum of the person columns the 
+        Individual is built from; persons without rows in a table have no row for it. 
+        The person batch is referenced once, so pid can be a parameterized batch.
+    """
+    query = """with p as (
+        select person_id, checksum(birth_datetime, gender_concept_id) as version
+        from """ + db + """person where person_id in """ + pid + """)
+    select 'person' as tbl, person_id, 1 as n, version from p"""
+    for table, version in FRESHNESS_TABLES.items():
+        query += """
+    union all
+    select '""" + table + """', t.person_id, count(*), """ + version + """
+    from """ + db + table + """ t join p on p.person_id = t.person_id
+    group by t.person_id"""
+    return query + ";"
+
+def get_cohort_weight_queries(table, db):
+    """Output: SQL statements adding a weight column (1 + domain rows) to the cohort table and returning (persons, total weight)"""
+    counts = get_row_count_query("(select person_id from " + table + ")", db).rstrip(';')
+    return [
+        """alter table """ + table + """ add weight bigint null;""",
+        """update c set c.weight = 1 + coalesce(r.n, 0)
+    from """ + table + """ c
+    left join (""" + counts + """) r
+    on c.person_id = r.person_id;""",
+        """select count(*), sum(weight) from """ + table + """;"""
+    ]
+
+def get_cohort_balance_query(table, target, chunk_size):
+    """Reassigns chunk_id on the cohort table so chunks hold about target weight and at most chunk_size persons: persons 
+        of at least target weight get a chunk of their own, the others are packed in person_id order by the running sum 
+        of their weights, and a pack of more than chunk_size persons is split in person_id order
+    """
+    target = str(int(target))
+    chunk_size = str(int(chunk_size))
+    query = """with s as (
+        select person_id, weight,
+           sum(case when weight >= """ + target + """ then 0 else weight end)
+               over (order by person_id rows unbounded preceding) as light_cum
+        from """ + table + """
+    ), b as (
+        select person_id,
+           case when weight >= """ + target + """ then 1 else 0 end as heavy,
+           case when weight >= """ + target + """ then person_id else (light_cum - weight) / """ + target + """ end as bucket
+        from s
+    ), r as (
+        select person_id, heavy, bucket,
+           (row_number() over (partition by heavy, bucket order by person_id) - 1) / """ + chunk_size + """ as part
+        from b
+    ), k as (
+        select person_id,
+           dense_rank() over (order by heavy, bucket, part) - 1 as chunk_id
+        from r
+    )
+    update c set c.chunk_id = k.chunk_id
+    from """ + table + """ c
+    join k on c.person_id = k.person_id;"""
     return query
 
+def get_vocabulary_version_query(ohdsi_db):
+    return """select vocabulary_version from """ + ohdsi_db + """vocabulary where vocabulary_id = 'None';"""
+
 # PARSING 
-def parse_Individual(records):
-	fields=["id","alternate_ids","date_of_birth","time_at_last_encounter","vital_status","sex","karyotypic_sex","gender","taxonomy_id","taxonomy_label"]
+def parse_Individual(records, fields = None):
+	columns = [c for c, e in query_columns(INDIVIDUAL_COLUMNS, fields)]
 	indivs = []
 
 	for r in records:
-		indivs.append({i:j for i,j in zip(fields,r) if j is not None })
+		indivs.append({i:j for i,j in zip(columns,r) if j is not None })
 	
 	return indivs
 
-def parse_VitalStatus(records):
-	fields=["person_id","vital_status","time_of_death","cause_of_death_id","cause_of_death_label"]
+def parse_VitalStatus(records, fields = None):
+	columns = [c for c, e in query_columns(VITAL_STATUS_COLUMNS, fields)]
 	vitals = []
 
 	for r in records:
-		vitals.append({i:j for i,j in zip(fields,r) if j is not None })
+		vitals.append({i:j for i,j in zip(columns,r) if j is not None })
 
 	return vitals 	
 
-def parse_Conditions(records, pheno_map):
-	fields_con = ["person_id","term_id","term_label","condition_source_value","excluded","onset_timestamp","resolution","clinical_tnm_finding_id","clinical_tnm_finding_label","primary_site_id","primary_site_label","concept_id"]
-	fields_phe = ["person_id","type_id","type_label","condition_source_value","excluded","onset_timestamp","resolution","clinical_tnm_finding_id","clinical_tnm_finding_label","modifier_id","modifier_label","concept_id"]
-
-	diseases = []
-	features = []
+def iterParseConditions(records, pheno_map, fields = None):
+	# Lazy parse_Conditions: yields (True, PhenotypicFeature record) or (False, Disease record) per record
+	fields_con = [c for c, e in query_columns(CONDITION_COLUMNS, fields)]
+	# Conditions mapped to PhenotypicFeature keep their finding site as modifier
+	renamed = {'term_id':'type_id','term_label':'type_label','primary_site_id':'modifier_id','primary_site_label':'modifier_label'}
+	fields_phe = [renamed.get(c, c) for c in fields_con]
+	concept = fields_con.index('concept_id')
+	pheno_map = set(pheno_map)
 
 	values_nono=[None,"None:No matching concept","No matching concept"]
 	for r in records:
-			if(r[11] in pheno_map):
-				features.append({i:j for i,j in zip(fields_phe,r) if j not in values_nono })
+			if(r[concept] in pheno_map):
+				yield True, {i:j for i,j in zip(fields_phe,r) if j not in values_nono }
 			else:
-				diseases.append({i:j for i,j in zip(fields_con,r) if j not in values_nono })
+				yield False, {i:j for i,j in zip(fields_con,r) if j not in values_nono }
+
+def parse_Conditions(records, pheno_map, fields = None):
+	diseases = []
+	features = []
+
+	for is_feature, r in iterParseConditions(records, pheno_map, fields):
+		(features if is_feature else diseases).append(r)
 	return diseases, features
 
-def parse_PhenoFeatures(records):
-	fields = ["person_id","type_id","type_label","modifier_id","modifier_label","description","onset_timestamp","onset_age"]
+def parse_PhenoFeatures(records, fields = None):
+	columns = [c for c, e in query_columns(PHENOFEATURE_COLUMNS, fields)]
 
 	phenoFeatures = []
 	values_nono=[None,"None:No matching concept","No matching concept"]
 
 	for r in records:
-		phenoFeatures.append({i:j for i,j in zip(fields,r) if j not in values_nono })
+		phenoFeatures.append({i:j for i,j in zip(columns,r) if j not in values_nono })
 
 	return phenoFeatures
 
-def parse_Measurements(records):
-	fields=["person_id","measurement_concept_id","assay_id","assay_label","value_as_number","value_id","value_label","range_low","range_high","measurement_datetime","unit_id","unit_label","concept_id","unit_source_value","visit_occurrence_id","row_number"]
+def parse_Measurements(records, fields = None):
+	columns = [c for c, e in query_columns(MEASUREMENT_COLUMNS, fields)]
 
 	measurements=[]
 	values_nono=[None,"None:No matching concept","No matching concept"]
 	for r in records:
-		measurements.append({i:j for i,j in zip(fields,r) if j not in values_nono })
+		measurements.append({i:j for i,j in zip(columns,r) if j not in values_nono })
 	return measurements
 
-def parse_Treatments(records):
-	fields = ["person_id","agent_id","agent_label","route_of_administration_id","route_of_administration_label","quantity_id","quantity_unit_label","quantity_value","interval_start","interval_end","drug_type_id","sched_freq"]
+def parse_Treatments(records, fields = None):
+	columns = [c for c, e in query_columns(TREATMENT_COLUMNS, fields)]
 
 	treatments = []
 	values_nono=[None,"None:No matching concept","No matching concept"]
 
 	for r in records:
-		treatments.append({i:j for i,j in zip(fields,r) if j not in values_nono })
+		treatments.append({i:j for i,j in zip(columns,r) if j not in values_nono })
 
 	return treatments
 
-def parse_Procedures(records):
-	fields = ["person_id","code_id","code_label","body_site_id","body_site_label","performed_timestamp","performed_age"]
+def parse_Procedures(records, fields = None):
+	columns = [c for c, e in query_columns(PROCEDURE_COLUMNS, fields)]
 
 	procedures = []
 	values_nono=[None,"None:No matching concept","No matching concept"]
 
 	for r in records:
-		procedures.append({i:j for i,j in zip(fields,r) if j not in values_nono })
+		procedures.append({i:j for i,j in zip(columns,r) if j not in values_nono })
 
 	return procedures
 
-# TRANSFROMATION
-def createDictIndividual(mydict,vsdict):
-	idict_all = {}
+def iterParse(records, columns, values_nono = (None,"None:No matching concept","No matching concept")):
+	# Lazy parse_* for the streamed domains: yields one dict per record (parse_Individual and parse_VitalStatus only drop None)
+	for r in records:
+		yield {i:j for i,j in zip(columns,r) if j not in values_nono }
 
+# TRANSFROMATION
+def iterDictIndividual(groups, vital_groups = ()):
+	"""Yields (person_id, Individual dict) in person_id order. 
+		groups and vital_groups are parse_Individual and parse_VitalStatus records grouped by person in person_id order 
+		(see group_by_person); they are merged, so only one person's records are held at a time.
+	"""
 	# Variables for logging
+	original = 0
+	included = 0
 	discarded = 0
 	alternate_ids = 0
 	date_of_birth = 0 
@@ -398,78 +538,80 @@ def createDictIndividual(mydict,vsdict):
 	sex = 0
 	vital_status = 0
 
-	for i in mydict: 
-		pid = i['id']
-		idict={}
-		
-		if('id' in i):
-			idict['id']=i['id']
-		else:
-			discarded += 1
+	# Vital status joined to each individual by a merge on person_id
+	for pid, parts in merge_domains({'individual': groups, 'vital_status': vital_groups}):
+		if('individual' not in parts):
 			continue
+		vs = parts['vital_status'][0] if 'vital_status' in parts else {}
+
+		for i in parts['individual']:
+			original += 1
+			idict={}
+		
+			if('id' in i):
+				idict['id']=i['id']
+			else:
+				discarded += 1
+				continue
 		
-		if('alternate_ids' in i):
-			idict['alternate_ids']=i['alternate_ids']
-			alternate_ids += 1
-		if('date_of_birth' in i):
-			idict['date_of_birth']=convert_time(i['date_of_birth'])
-			date_of_birth += 1
-		if('time_at_last_encounter' in i):
-			idict['time_at_last_encounter']=convert_time(i['time_at_last_encounter'])
-			time_at_last_encounter += 1
-		if('sex' in i):
-			sex += 1
-			if(i['sex']==0):
-				idict['sex']='UNKNOWN_SEX'
-			elif(i['sex']==1):
-				idict['sex']='FEMALE'
-			elif(i['sex']==2):
-				idict['sex']='MALE'
-			elif(i['sex']==3):
-				idict['sex']='OTHER_SEX'
-		if('taxonomy_id' in i):
-			idict['taxonomy']={'id':i['taxonomy_id'],'label':i['taxonomy_label']} 
-
-		if('vital_status' in i and i['vital_status']!=0):
-			vital_status += 1 
+			if('alternate_ids' in i):
+				idict['alternate_ids']=i['alternate_ids']
+				alternate_ids += 1
+			if('date_of_birth' in i):
+				idict['date_of_birth']=convert_time(i['date_of_birth'])
+				date_of_birth += 1
+			if('time_at_last_encounter' in i):
+				idict['time_at_last_encounter']=convert_time(i['time_at_last_encounter'])
+				time_at_last_encounter += 1
+			if('sex' in i):
+				sex += 1
+				if(i['sex'] in SEX_CODES):
+					idict['sex']=SEX_CODES[i['sex']]
+			if('taxonomy_id' in i):
+				idict['taxonomy']={'id':i['taxonomy_id'],'label':i['taxonomy_label']} 
+
+			if('vital_status' in i and i['vital_status']!=0):
+				vital_status += 1 
 
-			tempdict={}
-			if('vital_status' in vsdict):
 				tempdict={}
-				if(vsdict['vital_status']==0):
-					tempdict['status']='UNKNOWN_STATUS'
-				elif(vsdict['vital_status']==1):
-					tempdict['status']='ALIVE'
-				elif(vsdict['vital_status']==2):
-					tempdict['status']='DECEASED'            
-			if('time_of_death' in vsdict):
-				tempdict['time_of_death']=convert_time(vsdict['time_of_death'])
-			if('cause_of_death_id' in vsdict):
-				tempdict['cause_of_death']={'id':vsdict['cause_of_death_id'],'label':vsdict['cause_of_death_label']}
-
-			idict['vital_status']=tempdict
+				if('vital_status' in vs):
+					if(vs['vital_status']==0):
+						tempdict['status']='UNKNOWN_STATUS'
+					elif(vs['vital_status']==1):
+						tempdict['status']='ALIVE'
+					elif(vs['vital_status']==2):
+						tempdict['status']='DECEASED'            
+				if('time_of_death' in vs):
+					tempdict['time_of_death']=convert_time(vs['time_of_death'])
+				if('cause_of_death_id' in vs):
+					tempdict['cause_of_death']={'id':vs['cause_of_death_id'],'label':vs['cause_of_death_label']}
+
+				idict['vital_status']=tempdict
 			
-		idict['id'] = str(idict['id']).encode()
+			idict['id'] = str(idict['id']).encode()
 		
-		idict_all[pid] = idict
+			included += 1
+			yield pid, idict
 
-	logging.info(f"Individual - Original - records fetched - Total: {len(mydict)}")
+	logging.info(f"Individual - Original - records fetched - Total: {original}")
 	logging.info(f"Individual - Discarded - based on absence of - id: {discarded}")    
-	logging.info(f"Individual - Final - records included - Total: {len(idict_all)}")
+	logging.info(f"Individual - Final - records included - Total: {included}")
 	logging.info(f"Individual - Final - records with completed - date_of_birth: {date_of_birth}")
 	logging.info(f"Individual - Final - records with completed - time_at_last_encounter: {time_at_last_encounter}")
 	logging.info(f"Individual - Final - records with completed - sex: {sex}")
 	logging.info(f"Individual - Final - records with completed - vital_status: {vital_status}")
 
-	if not((len(idict_all) - discarded) == (len(mydict))):
+	if not((included + discarded) == original):
 		logging.info(f"Discrepancy in counts for Individual")
 
-	return idict_all
-
-def createListDictConditions(md):
-    ilist_dict = {}
-    ilist = []
+def createDictIndividual(mydict,vsdict):
+	return dict(iterDictIndividual(group_by_person(mydict, key = 'id'), group_by_person(vsdict)))
 
+def iterListDictConditions(groups):
+    """Yields (person_id, list of Disease entries) in person_id order, from parse_Conditions disease records grouped by 
+        person in person_id order (see group_by_person). Every group gives an entry list, empty when it has no records.
+    """
+    original = 0
     discarded = 0
     resolution = 0 
     primary_site = 0 
@@ -477,57 +619,57 @@ def createListDictConditions(md):
     discarded_primary_site = 0 
     discarded_resolution = 0 
 
-    for m in md:
-        pid = m['person_id']
-
-        if(pid not in ilist_dict):
-            ilist_dict[pid] = []
+    for pid, md in groups:
+        ilist = []
+        for m in md:
+            original += 1
 
-        if not('term_id' in m):
-            ilist.append({'discarded':'yes'})
-            ilist_dict[pid].append({'discarded':'yes'})
-            discarded += 1 
+            if not('term_id' in m):
+                ilist.append({'discarded':'yes'})
+                discarded += 1 
             
-            if('resolution' in m): discarded_resolution += 1
-            if('primary_site' in m): discarded_primary_site += 1
+                if('resolution' in m): discarded_resolution += 1
+                if('primary_site' in m): discarded_primary_site += 1
 
-            continue
+                continue
 
-        tempdict = {}
-        tempdict['term'] = {'id':m['term_id'],'label':m['term_label']}
+            tempdict = {}
+            tempdict['term'] = {'id':m['term_id'],'label':m['term_label']}
         
-        time_temp = convert_time(m['onset_timestamp']) 
+            time_temp = convert_time(m['onset_timestamp']) 
         
-        tempdict['onset'] = {'timestamp':time_temp} # add date conversion 
+            tempdict['onset'] = {'timestamp':time_temp} # add date conversion 
         
-        if ('resolution' in m):
-            resolution_temp = convert_time(m['resolution'])
-            tempdict['resolution'] = {'timestamp':resolution_temp} # add date conversion
-            resolution += 1
+            if ('resolution' in m):
+                resolution_temp = convert_time(m['resolution'])
+                tempdict['resolution'] = {'timestamp':resolution_temp} # add date conversion
+                resolution += 1
         
-        if ('primary_site_id' in m):
-            tempdict['primary_site'] = {'id':m['primary_site_id'],'label':m['primary_site_label']}
-            primary_site += 1
+            if ('primary_site_id' in m):
+                tempdict['primary_site'] = {'id':m['primary_site_id'],'label':m['primary_site_label']}
+                primary_site += 1
 
-        ilist.append(tempdict)
-        ilist_dict[pid].append(tempdict)
+            ilist.append(tempdict)
+
+        yield pid, ilist
         
-    logging.info(f"Condition - Original -  records fetched - Total: {len(ilist)}")
+    logging.info(f"Condition - Original -  records fetched - Total: {original}")
     logging.info(f"Condition - Discarded - Total, based on absence of - term: {discarded}")    
     logging.info(f"Condition - Discarded - Resolution, based on absence of - term: {discarded_resolution}")    
     logging.info(f"Condition - Discarded - Primary site, based on absence of - term: {discarded_primary_site}")    
-    logging.info(f"Condition - Final - records included - Total: {len([i for i in ilist if 'discarded' not in i])}")
+    logging.info(f"Condition - Final - records included - Total: {original - discarded}")
     logging.info(f"Condition - Final - records with completed (Dict) - resolution: {resolution}")
     logging.info(f"Condition - Final - records with completed (Dict) - primary_site: {primary_site}")
 
-    if not((len(ilist) - discarded) == (len([i for i in ilist if 'discarded' not in i]))):
-        logging.info(f"Discrepancy in counts for PhenotypicFeature from Condition")
-
-    return ilist_dict
+def createListDictConditions(md):
+    return dict(iterListDictConditions(group_by_person(md)))
         
-def createListDictPhenoFeature(md, flag = 'observation'):
-	ilist = []
-	ilist_dict = {}
+def iterListDictPhenoFeature(groups, flag = 'observation'):
+	"""Yields (person_id, list of PhenotypicFeature entries) in person_id order, from parse_Conditions feature records 
+		(flag 'condition') or parse_PhenoFeatures records (flag 'observation') grouped by person in person_id order 
+		(see group_by_person). Every group gives an entry list, empty when it has no records.
+	"""
+	original = 0
 	discarded = 0 
 	modifier = 0 
 	resolution = 0
@@ -537,79 +679,70 @@ def createListDictPhenoFeature(md, flag = 'observation'):
 	discarded_resolution = 0
 	discarded_description = 0 
 
-	for m in md:
-		pid = m['person_id']
-		
-		if(pid not in ilist_dict):
-			ilist_dict[pid] = []
+	for pid, md in groups:
+		ilist = []
+		for m in md:
+			original += 1
 
-		if not('type_id' in m):
-			ilist.append({'discarded':'yes'})
-			ilist_dict[pid].append({'discarded':'yes'})
-			discarded += 1
+			if not('type_id' in m):
+				ilist.append({'discarded':'yes'})
+				discarded += 1
 			
-			if('modifier_id' in m): discarded_modifier += 1 
-			if('resolution' in m): discarded_resolution += 1 
-			if('description' in m): discarded_description += 1
+				if('modifier_id' in m): discarded_modifier += 1 
+				if('resolution' in m): discarded_resolution += 1 
+				if('description' in m): discarded_description += 1
 
-			continue
+				continue
 
-		tempdict = {}
-		tempdict['type'] = {'id':m['type_id'],'label':m['type_label']}
+			tempdict = {}
+			tempdict['type'] = {'id':m['type_id'],'label':m['type_label']}
 
-		if('modifier_id' in m):
-			tempdict['modifiers'] = {'id':m['modifier_id'],'label':m['modifier_label']}
-			modifier += 1
+			if('modifier_id' in m):
+				tempdict['modifiers'] = {'id':m['modifier_id'],'label':m['modifier_label']}
+				modifier += 1
 
-		timstamp_temp = convert_time(m['onset_timestamp'])
-		tempdict['onset'] = {'timestamp':timstamp_temp}
+			timstamp_temp = convert_time(m['onset_timestamp'])
+			tempdict['onset'] = {'timestamp':timstamp_temp}
 		
-		if('resolution' in m):
-			resolution_temp = convert_time(m['resolution'])
-			tempdict['resolution'] = {'timestamp':resolution_temp}
-			resolution += 1
+			if('resolution' in m):
+				resolution_temp = convert_time(m['resolution'])
+				tempdict['resolution'] = {'timestamp':resolution_temp}
+				resolution += 1
+
+			if('description' in m):
+				tempdict['description'] = m['description']
+				description += 1 
 
-		if('description' in m):
-			tempdict['description'] = m['description']
-			description += 1 
+			ilist.append(tempdict)
 
-		ilist.append(tempdict)
-		ilist_dict[pid].append(tempdict)
+		yield pid, ilist
 		
-	if(flag == 'condition'):
-		logging.info(f"PhenotypicFeature (from Condition) - Original -  records fetched - Total: {len(ilist)}")
-		logging.info(f"PhenotypicFeature (from Condition) - Discarded - Total, based on absence of - type: {discarded}")    
-		logging.info(f"PhenotypicFeature (from Condition) - Discarded - Modifier, based on absence of - type: {discarded_modifier}")    
-		logging.info(f"PhenotypicFeature (from Condition) - Discarded - Resolution, based on absence of - type: {discarded_resolution}")    
-		logging.info(f"PhenotypicFeature (from Condition) - Discarded - Description, based on absence of - type: {discarded_description}")    
-		logging.info(f"PhenotypicFeature (from Condition) - Final - records included - Total: {len([i for i in ilist if 'discarded' not in i])}")
-		logging.info(f"PhenotypicFeature (from Condition) - Final - records with completed (Dict) - modifier: {modifier}")
-		logging.info(f"PhenotypicFeature (from Condition) - Final - records with completed (Dict) - resolution: {resolution}")
-		logging.info(f"PhenotypicFeature (from Condition) - Final - records with completed (Dict) - description: {description}")
-
-		if not((len(ilist) - discarded) == (len([i for i in ilist if 'discarded' not in i]))):
-			logging.info(f"Discrepancy in counts for PhenotypicFeature from Condition")
-
-	elif(flag == 'observation'):
-		logging.info(f"PhenotypicFeature (from Observation) - Original -  records fetched - Total: {len(ilist)}")
-		logging.info(f"PhenotypicFeature (from Observation) - Discarded - Total, based on absence of - type: {discarded}")    
-		logging.info(f"PhenotypicFeature (from Observation) - Discarded - Modifier, based on absence of - type: {discarded_modifier}")    
-		logging.info(f"PhenotypicFeature (from Observation) - Discarded - Resolution, based on absence of - type: {discarded_resolution}")    
-		logging.info(f"PhenotypicFeature (from Observation) - Discarded - Description, based on absence of - type: {discarded_description}")    
-		logging.info(f"PhenotypicFeature (from Observation) - Final - records included - Total: {len([i for i in ilist if 'discarded' not in i])}")
-		logging.info(f"PhenotypicFeature (from Observation) - Final - records with completed (Dict) - modifier: {modifier}")
-		logging.info(f"PhenotypicFeature (from Observation) - Final - records with completed (Dict) - resolution: {resolution}")
-		logging.info(f"PhenotypicFeature (from Observation) - Final - records with completed (Dict) - description: {description}")
-
-		if not((len(ilist) - discarded) == (len([i for i in ilist if 'discarded' not in i]))):
-			logging.info(f"Discrepancy in counts for PhenotypicFeature from Observation")
-	return ilist_dict
-
-def createListDictMeasurements(md):
-
-	ilist_dict = {}
-	ilist = []
+	source = {'condition': 'Condition', 'observation': 'Observation'}.get(flag)
+	if(source is not None):
+		logging.info(f"PhenotypicFeature (from {source}) - Original -  records fetched - Total: {original}")
+		logging.info(f"PhenotypicFeature (from {source}) - Discarded - Total, based on absence of - type: {discarded}")    
+		logging.info(f"PhenotypicFeature (from {source}) - Discarded - Modifier, based on absence of - type: {discarded_modifier}")    
+		logging.info(f"PhenotypicFeature (from {source}) - Discarded - Resolution, based on absence of - type: {discarded_resolution}")    
+		logging.info(f"PhenotypicFeature (from {source}) - Discarded - Description, based on absence of - type: {discarded_description}")    
+		logging.info(f"PhenotypicFeature (from {source}) - Final - records included - Total: {original - discarded}")
+		logging.info(f"PhenotypicFeature (from {source}) - Final - records with completed (Dict) - modifier: {modifier}")
+		logging.info(f"PhenotypicFeature (from {source}) - Final - records with completed (Dict) - resolution: {resolution}")
+		logging.info(f"PhenotypicFeature (from {source}) - Final - records with completed (Dict) - description: {description}")
 
+def createListDictPhenoFeature(md, flag = 'observation'):
+	return dict(iterListDictPhenoFeature(group_by_person(md), flag))
+
+def iterCombined(*streams):
+	"""Yields (person_id, entries) in person_id order, the entries of each person concatenated in stream order 
+		(the streaming combineDicts); streams are iterables of (person_id, entries) in person_id order
+	"""
+	for pid, parts in merge_domains(dict(enumerate(streams))):
+		yield pid, [e for n in range(len(streams)) for e in parts.get(n, [])]
+
+def iterListDictMeasurements(md, max_records = None):
+	"""Yields (person_id, list of measurement entries) in person_id order, entries grouped by assay. 
+		md is streamed through external_group, so at most max_records rows are held in memory at a time.
+	"""
 	discarded = 0
 	discarded_dueto_assay = 0 
 	discarded_dueto_value = 0 # Discarded because of missing value 
@@ -618,233 +751,256 @@ def createListDictMeasurements(md):
 	discarded_value = 0 # Loss of a value
 	discarded_assay = 0 # Loss of assay 
 
-	for m in md:
-		pid = m['person_id']
+	total = 0
+
+	for pid, entries in external_group(md, sort_key=lambda m: (m['person_id'], m.get('assay_id', '')),
+					group_key=operator.itemgetter('person_id'), max_records=max_records):
+		ilist = []
+		for m in entries:
+			total += 1
+
+			# discard if no assay information
+			if(not 'assay_label' in m):
+				ilist.append({'discarded':'yes'})
+				discarded += 1
+
+				# Get reason for discard 
+				if(not any(k in m for k in ('value_as_number','value_label'))):
+					discarded_dueto_both += 1
+				else:
+					discarded_dueto_assay += 1
+					discarded_value += 1
+
+				continue
+
+			# discard if no value (either number or label)
+			elif(not any(k in m for k in ('value_as_number','value_label'))):
+				ilist.append({'discarded':'yes'})
+				discarded += 1
+				discarded_dueto_value += 1
+
+				discarded_assay += 1
+				
+				continue
+			
+			tempdict={}
+			#assay
+			tempdict['assay']={'id':m['assay_id'],'label':m['assay_label']}
 
-		if(pid not in ilist_dict):
-			ilist_dict[pid] = []
+			if('measurement_datetime' in m):
+				tempdict['time_observed']=convert_time(m['measurement_datetime'])
 
-		# discard if no assay information
-		if(not 'assay_label' in m):
-			ilist_dict[pid].append({'discarded':'yes'})
-			ilist.append({'discarded':'yes'})
-			discarded += 1
+			if('value_as_number' in m):#Measurement with quantity
+				tdict={}
+				tdict['value']=m['value_as_number']
+				if('unit_label' in m):
+					tdict['unit']={'id':m['unit_id'],'label':m['unit_label']}
+				tempdict['value']={'quantity':tdict}
 
-			# Get reason for discard 
-			if(not any(k in m for k in ('value_as_number','value_label'))):
-				discarded_dueto_both += 1
-			else:
-				discarded_dueto_assay += 1
-				discarded_value += 1
+				if(any(k in m for k in ('range_low','range_high'))):
+					tdict={}
+					if('unit_label' in m):
+						tdict['unit']={'id':m['unit_id'],'label':m['unit_label']}
+					if('range_low' in m):
+						tdict['low']=m['range_low']
+					if('range_high' in m):
+						tdict['high']=m['range_high']
+					tempdict['reference_range']=tdict				
+			else:#Measurement with ontology
+				tempdict['value']={'id':m['value_id'],'label':m['value_label']}
 
-			continue
+			ilist.append(tempdict)
 
-		# discard if no value (either number or label)
-		elif(not any(k in m for k in ('value_as_number','value_label'))):
-			ilist_dict[pid].append({'discarded':'yes'})
-			ilist.append({'discarded':'yes'})
-			discarded += 1
-			discarded_dueto_value += 1
+		yield pid, ilist
 
-			discarded_assay += 1
-			
-			continue
-		
-		tempdict={}
-		#assay
-		tempdict['assay']={'id':m['assay_id'],'label':m['assay_label']}
-
-		if('measurement_datetime' in m):
-			tempdict['time_observed']=convert_time(m['measurement_datetime'])
-
-		if('value_as_number' in m):#Measurement with quantity
-			tdict={}
-			tdict['value']=m['value_as_number']
-			#if('.' in m['value_label']):
-			#	tdict['value']=float(m['value_label'])
-			#else:
-			#	tdict['value']=int(m['value_label'])
-			if('unit_label' in m):
-				tdict['unit']={'id':m['unit_id'],'label':m['unit_label']}
-			tempdict['value']={'quantity':tdict}
-
-			if(any(k in m for k in ('range_low','range_high'))):
-				tdict={}
-				if('unit_label' in m):
-					tdict['unit']={'id':m['unit_id'],'label':m['unit_label']}
-				if('range_low' in m):
-					tdict['low']=m['range_low']
-				if('range_high' in m):
-					tdict['high']=m['range_high']
-				tempdict['reference_range']=tdict				
-		else:#Measurement with ontology
-			tempdict['value']={'id':m['value_id'],'label':m['value_label']}
-
-		ilist_dict[pid].append(tempdict)
-		ilist.append(tempdict)
-
-	logging.info(f"Measurement - Original -  records fetched - Total: {len(ilist)}")
+	logging.info(f"Measurement - Original -  records fetched - Total: {total}")
 	logging.info(f"Measurement - Discarded - Total: {discarded}")    
 	logging.info(f"Measurement - Discarded - Total, based on absence of - both assay and value: {discarded_dueto_both}")    
 	logging.info(f"Measurement - Discarded - Total, based on absence of - assay: {discarded_dueto_assay}")    
 	logging.info(f"Measurement - Discarded - Total, based on absence of - value: {discarded_dueto_value}")    
 	logging.info(f"Measurement - Discarded - Assay: {discarded_assay}")    
 	logging.info(f"Measurement - Discarded - Value: {discarded_value}")    
-	logging.info(f"Measurement - Final - records included - Total: {len([i for i in ilist if 'discarded' not in i])}")
-   
-	return ilist_dict
-
-def createListDictTreatment(txdict):
-    # Sort the initial list by 'person_id', 'agent_id', and 'agent_label'
-    txdict_orig = txdict
-    txdict_discard = [i for i in txdict if 'agent_id' not in i or 'agent_label' not in i]
-    txdict = [i for i in txdict if 'agent_id' in i and 'agent_label' in i]
-    txdict.sort(key=operator.itemgetter("person_id", "agent_id", "agent_label"))
+	logging.info(f"Measurement - Final - records included - Total: {total - discarded}")
 
-    logging.info(f"Treatment - Original - Total: {len(txdict_orig)}")
-    logging.info(f"Treatment - Discarded - Total: {len([i for i in txdict_orig if 'agent_id' not in i or 'agent_label' not in i])}")
-    logging.info(f"Treatment - Final - Total: {len(txdict)}")
+def createListDictMeasurements(md, max_records = None):
+	return dict(iterListDictMeasurements(md, max_records))
 
-
-    # Fields lost from discarded entries (drug_type/interval_start/quantity are excluded because they are equivalent to total)
-    logging.info(f"Treatment - Discarded - route_of_administration: {len([i for i in txdict_discard if 'route_of_administration_id' in i])}")
-    logging.info(f"Treatment - Discarded - interval_end: {len([i for i in txdict_discard if 'interval_end' in i])}")
-    logging.info(f"Treatment - Discarded - schedule_frequency (missing agent): {len([i for i in txdict_discard if 'sched_freq' in i])}")
-
-    distinct_person_ids = set(item['person_id'] for item in txdict)
-
-    ilist_dict = {}
+def coalesce_exposures(entries, gap_days = 0):
+    """Input: the treatment entries of one agent, gap tolerance in days
+        Output: list of entries where exposures with the same quantity and sched_freq that overlap, touch or start at most 
+            gap_days after the end of the previous one of that dose are merged into one entry spanning both, also when 
+            exposures of other doses lie in between. 
+            Entries are ordered by interval_start; entries without interval_start are kept as they are, at the end.
+    """
+    gap = timedelta(days=gap_days)
+    dated = sorted((e for e in entries if 'interval_start' in e), key=operator.itemgetter('interval_start'))
+    merged = []
+    open_entries = {} # (quantity_value, quantity_id, sched_freq) -> [merged entry, its interval end], the last of that key
+    for e in dated:
+        key = (e.get('quantity_value'), e.get('quantity_id'), e.get('sched_freq'))
+        end = e.get('interval_end', e['interval_start'])
+        current = open_entries.get(key)
+        # Exposures of other doses in between do not close the interval of this one
+        if current is not None and e['interval_start'] <= current[1] + gap:
+            if end > current[1]:
+                current[1] = end
+                current[0]['interval_end'] = end
+            continue
+        # A merged entry is a copy, the parsed record is left as it is; it keeps its place in start order
+        open_entries[key] = [dict(e), end]
+        merged.append(open_entries[key][0])
+    merged.extend(e for e in entries if 'interval_start' not in e)
+    return merged
+
+def iterListDictTreatment(txdict, max_records = None, drug_types = None, frequencies = None, coalesce_gap_days = None):
+    """Yields (person_id, list of treatment entries) in person_id order, one entry per agent with a DoseInterval per drug_exposure. 
+        txdict is streamed through external_group sorted by 'person_id', 'agent_id' and 'agent_label', so at most 
+        max_records rows are held in memory at a time. 
+        drug_types and frequencies are the code mappings (see get_code_mappings), DRUG_TYPES and SCHEDULE_FREQUENCIES by default.
+        With coalesce_gap_days, repeated exposures of an agent are merged into one DoseInterval (see coalesce_exposures).
+    """
+    drug_types = DRUG_TYPES if drug_types is None else drug_types
+    frequencies = SCHEDULE_FREQUENCIES if frequencies is None else frequencies
 
     # Variables for logging 
+    original = 0
+    discarded = 0
+    discarded_route_of_administration = 0
+    discarded_interval_end = 0
+    discarded_sched_freq = 0
+
     drug_type_present = 0
     route_of_administration_present = 0 
     schedule_freq_present = 0
     interval_end_present = 0 
     quantity_present = 0 
     schedule_freq_discard = 0 
+    coalesced = 0
+
+    def valid_entries():
+        nonlocal original, discarded, discarded_route_of_administration, discarded_interval_end, discarded_sched_freq
+        for i in txdict:
+            original += 1
+            if 'agent_id' in i and 'agent_label' in i:
+                yield i
+                continue
+            # Fields lost from discarded entries (drug_type/interval_start/quantity are excluded because they are equivalent to total)
+            discarded += 1
+            discarded_route_of_administration += ('route_of_administration_id' in i)
+            discarded_interval_end += ('interval_end' in i)
+            discarded_sched_freq += ('sched_freq' in i)
 
-    for person_id in distinct_person_ids:
-        ilist = []
-        idx = 0
-        total = len(txdict)
-
-        while idx < total:
-            agent_id = txdict[idx]['agent_id']
-            agent_label = txdict[idx]['agent_label']
+    groups = external_group(valid_entries(), sort_key=operator.itemgetter("person_id", "agent_id", "agent_label"),
+                            group_key=operator.itemgetter("person_id", "agent_id"), max_records=max_records)
 
-            # Check if the current entry belongs to the current person_id
-            if txdict[idx]['person_id'] != person_id:
-                idx += 1
-                continue
+    for person_id, agents in itertools.groupby(groups, key=lambda g: g[0][0]):
+        ilist = []
 
+        for (pid, agent_id), entries in agents:
             tempdict = {
-                'agent': {'id': agent_id, 'label': agent_label},
+                'agent': {'id': agent_id, 'label': entries[0]['agent_label']},
                 'route_of_administration': None,  # Initialize as None, will set it if found
                 'drug_type': None,  # Initialize as None, will set it if found
                 'dose_intervals': []
             }
 
             # Retrieve entries for the current agent
-            for k in range(idx, total):
-
-                # Check if it's the current person 
-                if txdict[k]['agent_id'] != agent_id:
-                    break
-
-                route_of_administration_present += ('route_of_administration_id' in txdict[k])
-                drug_type_present += ('drug_type_id' in txdict[k])
-                interval_end_present += ('interval_end' in txdict[k])
-                schedule_freq_present += txdict[k]['sched_freq'] <= 4 if 'sched_freq' in txdict[k] else False
-                schedule_freq_discard += txdict[k]['sched_freq'] > 4 if 'sched_freq' in txdict[k] else False
-
-                if tempdict['route_of_administration'] is None and 'route_of_administration_id' in txdict[k]:
+            for entry in entries:
+                route_of_administration_present += ('route_of_administration_id' in entry)
+                drug_type_present += ('drug_type_id' in entry)
+                interval_end_present += ('interval_end' in entry)
+                quantity_present += ('quantity_value' in entry)
+                if 'sched_freq' in entry:
+                    mapped = entry['sched_freq'] in frequencies
+                    schedule_freq_present += mapped
+                    schedule_freq_discard += not mapped
+
+                if tempdict['route_of_administration'] is None and 'route_of_administration_id' in entry:
                     tempdict['route_of_administration'] = {
-                        'id': txdict[k]['route_of_administration_id'],
-                        'label': txdict[k]['route_of_administration_label']
+                        'id': entry['route_of_administration_id'],
+                        'label': entry['route_of_administration_label']
                     }
 
                 if tempdict['drug_type'] is None:
-                    if 'drug_type_id' in txdict[k]:
-                        drug_type_id = txdict[k]['drug_type_id']
-                        if drug_type_id == 32879:
-                            tempdict['drug_type'] = 'ADMINISTRATION_RELATED_TO_PROCEDURE'
-                        elif drug_type_id == 32839:
-                            tempdict['drug_type'] = 'PRESCRIPTION'
-                        elif drug_type_id in (32833, 32825, 32821, 32818):
-                            tempdict['drug_type'] = 'EHR_MEDICATION_LIST'
-                        else:
-                            tempdict['drug_type'] = 'UNKNOWN_DRUG_TYPE'
-                    else:
-                        tempdict['drug_type'] = 'UNKNOWN_DRUG_TYPE'
-
-                dose = createDoseInterval(txdict[k])
-                tempdict['dose_intervals'].append(dose)
-
+                    tempdict['drug_type'] = drug_types.get(entry.get('drug_type_id'), 'UNKNOWN_DRUG_TYPE')
 
-                idx += 1
+            if coalesce_gap_days is not None:
+                doses = coalesce_exposures(entries, coalesce_gap_days)
+                coalesced += len(entries) - len(doses)
+            else:
+                doses = entries
+            tempdict['dose_intervals'] = [createDoseInterval(entry, frequencies) for entry in doses]
 
-        
             if(tempdict['route_of_administration'] is None): del tempdict['route_of_administration']
             if(tempdict['drug_type'] is None): del tempdict['drug_type']
 
-
             ilist.append(tempdict)
 
-        ilist_dict[person_id] = ilist  # Add processed data for the current person_id to the main list
+        yield person_id, ilist
+
+    logging.info(f"Treatment - Original - Total: {original}")
+    logging.info(f"Treatment - Discarded - Total: {discarded}")
+    logging.info(f"Treatment - Final - Total: {original - discarded}")
 
     # Fields lost from discarded entries (drug_type/interval_start/quantity are excluded because they are equivalent to total)
+    logging.info(f"Treatment - Discarded - route_of_administration: {discarded_route_of_administration}")
+    logging.info(f"Treatment - Discarded - interval_end: {discarded_interval_end}")
+    logging.info(f"Treatment - Discarded - schedule_frequency (missing agent): {discarded_sched_freq}")
+
     logging.info(f"Treatment - Final - route_of_administration: {route_of_administration_present}")
     logging.info(f"Treatment - Final - drug_type: {drug_type_present}")
     logging.info(f"Treatment - Final - interval_end: {interval_end_present}")
     logging.info(f"Treatment - Final - schedule_frequency: {schedule_freq_present}")
     logging.info(f"Treatment - Final - quantity: {quantity_present}")
-    logging.info(f"Treatment - Discard - schedule_frequency (sched_freq > 4): {schedule_freq_discard}")
-
-    return ilist_dict
-
-def createListDictProcedures(md):
-	ilist = []
-	ilist_dict = {}
+    logging.info(f"Treatment - Discard - schedule_frequency (sched_freq without mapping): {schedule_freq_discard}")
+    if coalesce_gap_days is not None:
+        logging.info(f"Treatment - Coalesced - dose intervals merged into a previous one: {coalesced}")
+
+def createListDictTreatment(txdict, max_records = None, drug_types = None, frequencies = None, coalesce_gap_days = None):
+    return dict(iterListDictTreatment(txdict, max_records, drug_types, frequencies, coalesce_gap_days))
+
+def iterListDictProcedures(groups):
+	"""Yields (person_id, list of Procedure entries) in person_id order, from parse_Procedures records grouped by person 
+		in person_id order (see group_by_person). Every group gives an entry list, empty when it has no records.
+	"""
+	original = 0
 	discarded = 0 
 	body_site = 0
 
-	for m in md:
-
-		pid = m['person_id']
+	for pid, md in groups:
+		ilist = []
+		for m in md:
+			original += 1
 
-		if(pid not in ilist_dict):
-			ilist_dict[pid] = []
+			if not('code_id' in m):
+				ilist.append({'discarded':'yes'})
+				discarded += 1
 
-		if not('code_id' in m):
-			ilist_dict[pid].append({'discarded':'yes'})
-			ilist.append({'discarded':'yes'})
-			discarded += 1
+				continue
 
-			continue
-
-		tempdict = {}
-		tempdict['code'] = {'id':m['code_id'],'label':m['code_label']}
+			tempdict = {}
+			tempdict['code'] = {'id':m['code_id'],'label':m['code_label']}
 
-		if ('body_site_id' in m):
-			tempdict['body_site'] = {'id':m['body_site_id'],'label':m['body_site_label']}
-			body_site += 1
+			if ('body_site_id' in m):
+				tempdict['body_site'] = {'id':m['body_site_id'],'label':m['body_site_label']}
+				body_site += 1
 		
-		timestamp_temp = convert_time(m['performed_timestamp'])
-		tempdict['performed'] = {'age':{'iso8601duration':m['performed_age']},'timestamp':timestamp_temp}
+			timestamp_temp = convert_time(m['performed_timestamp'])
+			tempdict['performed'] = {'timestamp':timestamp_temp}
+			if('performed_age' in m):
+				tempdict['performed']['age'] = {'iso8601duration':m['performed_age']}
 
-		ilist.append(tempdict)
-		ilist_dict[pid].append(tempdict)
+			ilist.append(tempdict)
 
-	logging.info(f"Procedure - Original - records fetched - Total: {len(ilist)}")
+		yield pid, ilist
+
+	logging.info(f"Procedure - Original - records fetched - Total: {original}")
 	logging.info(f"Procedure - Discarded - based on absence of - code: {discarded}")    
-	logging.info(f"Procedure - Final - records included - Total: {len([i for i in ilist if 'discarded' not in i])}")
+	logging.info(f"Procedure - Final - records included - Total: {original - discarded}")
 	logging.info(f"Procedure - Final - records with completed - body_site: {body_site}")
 
-	if not((len(ilist) - discarded) == (len([i for i in ilist if 'discarded' not in i]))):
-		logging.info(f"Discrepancy in counts for Procedure")
-
-
-	return ilist_dict
+def createListDictProcedures(md):
+	return dict(iterListDictProcedures(group_by_person(md)))
 
 # CREATE PHENOPACKET
 def createPhenoIndividual(individualdict):
@@ -1047,6 +1203,16 @@ def createPheno(myid,meta_data,subject=None,phenotypic_features=None,measurement
 	return Phenopacket(**pheno)
 
 # HELPER FUNCTIONS 
+def temp_path(path):
+    # Name of the temporary file written before an atomic os.replace onto path; unique across the nodes sharing a mount
+    return path + f'.{socket.gethostname()}.{os.getpid()}.tmp'
+
+def write_json_atomic(path, obj):
+    tmp = temp_path(path)
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
 def convert_time(time_datetime):
 	return datetime.strftime(time_datetime, '%Y-%m-%dT%H:%M:%S.%fZ')
 
@@ -1054,19 +1220,137 @@ def convert_time_toseconds(time_string):
 	dt=datetime.strptime(time_string,'%Y-%m-%dT%H:%M:%S.%fZ')
 	return int(datetime.timestamp(dt))
 
-def createDoseInterval(entryDict):
+def birth_index(mydict):
+    """Input: parse_Individual output
+        Output: dict of person_id -> birth datetime, used to compute the performed ages of procedures
+    """
+    return {i['id']: i['date_of_birth'] for i in mydict if 'date_of_birth' in i}
+
+def iso8601_ages(births, events):
+    """Input: two equal-length sequences of birth and event datetimes
+        Output: list of completed years at each event as ISO8601 durations ('P64Y'), None where a date is missing or the event precedes birth
+    """
+    if len(births) == 0:
+        return []
+    b = pd.to_datetime(pd.Series(births), errors='coerce')
+    e = pd.to_datetime(pd.Series(events), errors='coerce')
+    # one year less when the birthday has not yet come round in the event year
+    before_birthday = (e.dt.month * 100 + e.dt.day) < (b.dt.month * 100 + b.dt.day)
+    years = (e.dt.year - b.dt.year - before_birthday.astype('Int64')).astype('Int64')
+    ages = ('P' + years.astype('string') + 'Y').astype(object)
+    ages[years.isna() | (years < 0)] = None
+    return ages.tolist()
+
+def add_ages(records, births, time_key, age_key):
+    """Sets record[age_key] from record[time_key] and the person's birth date for a list of parsed records (e.g. parse_Procedures output)"""
+    rows = [r for r in records if time_key in r and r['person_id'] in births]
+    ages = iso8601_ages([births[r['person_id']] for r in rows], [r[time_key] for r in rows])
+    for r, age in zip(rows, ages):
+        if age is not None:
+            r[age_key] = age
+    return records
+
+def iter_births(records, births):
+    # Passes parsed Individual records through, recording person_id -> birth datetime in births (see birth_index)
+    for i in records:
+        if 'date_of_birth' in i:
+            births[i['id']] = i['date_of_birth']
+        yield i
+
+def iter_ages(records, births, time_key, age_key, batch_size = 5000):
+    # add_ages over a stream of parsed records, batch_size records at a time
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        yield from add_ages(batch, births, time_key, age_key)
+
+# combination product rule -> how the dose of a multi-ingredient drug is taken from its drug_strength rows
+DRUG_STRENGTH_RULES = ('first', 'sum', 'none')
+
+def build_drug_strength_index(records, rule = 'first'):
+    """Input: 
+            - records: get_drug_strength_query rows
+            - rule: dose of combination products (more than one ingredient)
+                - first: the ingredient with the lowest concept_id
+                - sum: the summed amounts when all ingredients share a unit, otherwise as first
+                - none: no dose
+        Output: dict of drug_concept_id -> (amount, unit id, unit label)
+    """
+    by_drug = {}
+    for drug_concept_id, ingredient_concept_id, amount, unit_id, unit_label in records:
+        by_drug.setdefault(int(drug_concept_id), []).append((int(ingredient_concept_id), float(amount), unit_id, unit_label))
+
+    index = {}
+    for drug_concept_id, ingredients in by_drug.items():
+        ingredients.sort()
+        if(len(ingredients) > 1 and rule == 'none'):
+            continue
+        amount, unit_id, unit_label = ingredients[0][1:]
+        if(len(ingredients) > 1 and rule == 'sum' and len({i[2] for i in ingredients}) == 1):
+            amount = sum(i[1] for i in ingredients)
+        index[drug_concept_id] = (amount, unit_id, unit_label)
+
+    logging.info(f"Drug strength - {len(index)} drugs indexed ({sum(len(i) > 1 for i in by_drug.values())} combination products, rule: {rule})")
+    return index
+
+_drug_strength_indexes = {} # (vocabulary version, rule) -> index, loaded once per process
+
+def get_drug_strength_index(cur, opts):
+    """Returns the drug strength index for opts['vocabulary_version'] and opts['drug_strength_rule']: from memory, 
+        from the file persisted in opts['drug_strength_dir'], or built from the vocabulary (and then persisted)
+    """
+    key = (opts['vocabulary_version'], opts['drug_strength_rule'])
+    if key in _drug_strength_indexes:
+        return _drug_strength_indexes[key]
+
+    path = None
+    if(opts['drug_strength_dir'] is not None and opts['vocabulary_version'] is not None):
+        version = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in str(opts['vocabulary_version']))
+        path = os.path.join(os.path.expanduser(opts['drug_strength_dir']), f"drug_strength_{version}_{opts['drug_strength_rule']}.pkl")
+
+    if path is not None and os.path.exists(path):
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    else:
+        cur.execute(get_drug_strength_query(opts['ohdsi_db']))
+        index = build_drug_strength_index(cur.fetchall(), opts['drug_strength_rule'])
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = temp_path(path)
+            with open(tmp, 'wb') as f:
+                pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+
+    _drug_strength_indexes[key] = index
+    return index
+
+def iter_drug_strength(records, index):
+    """Yields parsed treatment records (parse_Treatments output) with quantity_value, quantity_id and quantity_unit_label 
+        set from their drug_concept_id
+    """
+    for r in records:
+        dose = index.get(r.get('drug_concept_id'))
+        if dose is not None:
+            r['quantity_value'], r['quantity_id'], r['quantity_unit_label'] = dose
+        yield r
+
+def add_drug_strength(records, index):
+    for r in iter_drug_strength(records, index):
+        pass
+    return records
+
+def createDoseInterval(entryDict, frequencies = None):
     i = entryDict
     dose = {}
+    frequencies = SCHEDULE_FREQUENCIES if frequencies is None else frequencies
 
     if('sched_freq' in i.keys()):
-        if(i['sched_freq'] == 1):
-            dose['schedule_frequency'] = OntologyClass(id = 'ncit:C125004', label = 'Once Daily')
-        elif(i['sched_freq'] == 2):
-            dose['schedule_frequency'] = OntologyClass(id = 'ncit:C64496', label = 'Twice Daily')
-        elif(i['sched_freq'] == 3):
-           dose['schedule_frequency'] = OntologyClass(id = 'ncit:C64527', label = 'Three Times Daily')
-        elif(i['sched_freq'] == 4):
-            dose['schedule_frequency'] = OntologyClass(id = 'ncit:C64530', label = 'Four Times Daily')
+        # The prebuilt OntologyClass is copied into the DoseInterval
+        frequency = frequencies.get(i['sched_freq'])
+        if frequency is not None:
+            dose['schedule_frequency'] = frequency
     
     if('quantity_value' in i.keys()):
         unit = OntologyClass(id=i['quantity_id'],label=i['quantity_unit_label'])
@@ -1109,6 +1393,143 @@ def get_sem_mapping(sem_mapping_file):
 	
     return phefeatures
 
+def get_cohort_def(cohort_def_file):
+    """Input: a concept set CSV exported from ATLAS/Athena (e.g. SupplementalFiles/AD_cohort_def.csv) with the columns: 
+            - Concept ID (e.g., 715997)
+            - Domain ID (e.g., Drug)
+            - Standard Concept (S for standard concepts)
+        Output: 
+            - concepts: list of dicts with concept_id, domain_id and standard
+    """
+    cohort_def = pd.read_csv(cohort_def_file, encoding='utf-8-sig')
+    concepts = []
+    for concept_id, domain_id, standard in zip(cohort_def['Concept ID'], cohort_def['Domain ID'], cohort_def['Standard Concept']):
+        concepts.append({'concept_id': int(concept_id), 'domain_id': domain_id, 'standard': standard == 'S'})
+
+    return concepts
+
+# CODE MAPPINGS
+# Lookup tables applied per record: sex code of get_individual_query -> Sex name, drug_type_concept_id -> DrugType name, 
+# sched_freq (doses per day) -> prebuilt NCIt OntologyClass. get_code_mappings replaces the last two from the 
+# SupplementalFiles CSVs.
+SEX_CODES = {0: 'UNKNOWN_SEX', 1: 'FEMALE', 2: 'MALE', 3: 'OTHER_SEX'}
+
+DRUG_TYPES = {
+    32879: 'ADMINISTRATION_RELATED_TO_PROCEDURE',
+    32839: 'PRESCRIPTION',
+    32833: 'EHR_MEDICATION_LIST',
+    32825: 'EHR_MEDICATION_LIST',
+    32821: 'EHR_MEDICATION_LIST',
+    32818: 'EHR_MEDICATION_LIST',
+}
+
+SCHEDULE_FREQUENCIES = {
+    1: OntologyClass(id = 'ncit:C125004', label = 'Once Daily'),
+    2: OntologyClass(id = 'ncit:C64496', label = 'Twice Daily'),
+    3: OntologyClass(id = 'ncit:C64527', label = 'Three Times Daily'),
+    4: OntologyClass(id = 'ncit:C64530', label = 'Four Times Daily'),
+}
+
+# 'Phenopacket Drug Type' labels of DrugType_Mapping.csv -> DrugType names (the names themselves are accepted too)
+DRUG_TYPE_LABELS = {
+    'inpatient/ehr medication list': 'EHR_MEDICATION_LIST',
+    'outpatient/prescription': 'PRESCRIPTION',
+    'administration related to one time procedure': 'ADMINISTRATION_RELATED_TO_PROCEDURE',
+}
+
+def get_drug_type_mapping(drug_type_file):
+    """Input: a CSV with the columns 'OMOP Concept ID' and 'Phenopacket Drug Type' (e.g. SupplementalFiles/DrugType_Mapping.csv) 
+        Output: dict of drug_type_concept_id -> DrugType name
+    """
+    mapping = pd.read_csv(drug_type_file, encoding='utf-8-sig')
+    drug_types = {}
+    for concept_id, label in zip(mapping['OMOP Concept ID'], mapping['Phenopacket Drug Type']):
+        name = label.strip() if label.strip() in DrugType.keys() else DRUG_TYPE_LABELS.get(label.strip().lower())
+        if name is None:
+            raise ValueError(f"{drug_type_file}: unknown Phenopacket Drug Type '{label}', expected one of {DrugType.keys()}")
+        drug_types[int(concept_id)] = name
+    return drug_types
+
+def get_schedule_frequency_mapping(schedule_frequency_file):
+    """Input: a CSV of doses per day (quantity / days_supply), NCIT term and NCIT identifier columns 
+            (e.g. SupplementalFiles/scheduleFrequency_mapping.csv)
+        Output: dict of doses per day -> OntologyClass
+    """
+    mapping = pd.read_csv(schedule_frequency_file, encoding='utf-8-sig')
+    return {int(n): OntologyClass(id = ncit_id.strip(), label = term.strip()) for n, term, ncit_id in mapping.iloc[:, :3].itertuples(index=False)}
+
+_code_mappings = {}
+
+def get_code_mappings(opts):
+    """Output: the (drug_types, frequencies) lookup tables of a run, read once per process from 
+        opts['drug_type_mapping_file'] and opts['schedule_frequency_mapping_file'] when set
+    """
+    key = (opts['drug_type_mapping_file'], opts['schedule_frequency_mapping_file'])
+    if key not in _code_mappings:
+        _code_mappings[key] = (
+            DRUG_TYPES if key[0] is None else get_drug_type_mapping(key[0]),
+            SCHEDULE_FREQUENCIES if key[1] is None else get_schedule_frequency_mapping(key[1]))
+    return _code_mappings[key]
+
+# extract_chunk domain -> column lists of its queries
+DOMAIN_COLUMNS = {
+    'individual': (INDIVIDUAL_COLUMNS, VITAL_STATUS_COLUMNS),
+    'conditions': (CONDITION_COLUMNS,),
+    'features': (PHENOFEATURE_COLUMNS,),
+    'measurements': (MEASUREMENT_COLUMNS,),
+    'treatments': (TREATMENT_COLUMNS,),
+    'procedures': (PROCEDURE_COLUMNS,),
+}
+
+# field_mapping.csv section -> domain, and misspelled field names of the file
+FIELD_MAPPING_SECTIONS = {'Subject': 'individual', 'Diseases': 'conditions', 'PhenotypicFeatures': 'features',
+                          'Measurements': 'measurements', 'Treatment': 'treatments', 'Procedure': 'procedures'}
+FIELD_MAPPING_ALIASES = {'routeofadminsitration': 'routeofadministration'}
+
+def _field_name(name):
+    # Field names compare without case and underscores (scheduleFrequency == schedule_frequency)
+    name = name.strip().lower().replace('_', '').replace(' ', '')
+    return FIELD_MAPPING_ALIASES.get(name, name)
+
+def get_profile(field_mapping_file = None, domains = None, omit_fields = ()):
+    """Input: 
+            - field_mapping_file: SupplementalFiles/field_mapping.csv or a copy; fields whose rows are all 'Unmapped' are not extracted
+            - domains: the domains to extract (see DOMAIN_COLUMNS), None for all; individual is always extracted
+            - omit_fields: 'domain.field' names not to extract, e.g. 'measurements.measurement_value.reference_range'
+        Output: 
+            - domains: set of domains to extract
+            - fields: dict of domain -> set of enabled profile fields (the fields named in its column lists)
+        Condition-derived PhenotypicFeatures come from the condition query and follow the conditions fields.
+    """
+    fields = {d: {f for columns in cols for name, expr, f in columns if f} for d, cols in DOMAIN_COLUMNS.items()}
+
+    if(field_mapping_file is not None):
+        mapping = pd.read_csv(field_mapping_file, encoding='utf-8-sig', header=None, skiprows=1, dtype=str).fillna('')
+        mapped = {}
+        for section, field, subfield, source, mapping_type in mapping.iloc[:, :5].itertuples(index=False):
+            domain = FIELD_MAPPING_SECTIONS.get(section.strip())
+            if domain is None or not field.strip():
+                continue
+            name = _field_name(field) + ('.' + _field_name(subfield) if subfield.strip() and ',' not in subfield else '')
+            mapped[(domain, name)] = mapped.get((domain, name), False) or mapping_type.strip() != 'Unmapped'
+        for domain in fields:
+            fields[domain] = {f for f in fields[domain]
+                              if mapped.get((domain, '.'.join(_field_name(p) for p in f.split('.'))), True)}
+
+    for name in omit_fields:
+        domain, _, field = name.partition('.')
+        if domain not in fields or field not in fields[domain]:
+            raise ValueError(f"Unknown field {name}, expected one of: " +
+                             ", ".join(sorted(d + '.' + f for d in fields for f in fields[d])))
+        fields[domain].discard(field)
+
+    selected = set(DOMAIN_COLUMNS) if domains is None else set(domains) | {'individual'}
+    unknown = selected - set(DOMAIN_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown domains {sorted(unknown)}, expected some of: {', '.join(DOMAIN_COLUMNS)}")
+
+    return selected, fields
+
 def createMetadata(myname):
 	metadata={}
 	metadata['created']=Timestamp(seconds=int(time.time()))
@@ -1159,3 +1580,2024 @@ def createMetadata(myname):
 	metadata['phenopacket_schema_version']='2.0'
 	logging.debug(f'metadata: {metadata}')
 	return metadata
+
+# EXTERNAL SORT
+# Maximum number of spilled runs merged at once, more runs are first merged into one larger run
+SORT_MAX_FANIN = 64
+
+def _spill_run(run, tmp_dir = None):
+    # Writes sorted records to an anonymous temporary file
+    f = tempfile.TemporaryFile(dir=tmp_dir)
+    for r in run:
+        pickle.dump(r, f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def _read_run(f):
+    try:
+        while True:
+            yield pickle.load(f)
+    except EOFError:
+        pass
+    finally:
+        f.close()
+
+def external_sort(records, key, max_records = None, tmp_dir = None):
+    """Yields records in key order (stable, like sorted). 
+        With max_records set, at most max_records records are held in memory: each full buffer is sorted and spilled to a 
+        temporary file, and the runs are merged back as a stream.
+    """
+    if max_records is None:
+        yield from sorted(records, key=key)
+        return
+
+    runs = []
+    buffer = []
+    for r in records:
+        buffer.append(r)
+        if len(buffer) >= max_records:
+            buffer.sort(key=key)
+            runs.append(_spill_run(buffer, tmp_dir))
+            buffer = []
+            if len(runs) >= SORT_MAX_FANIN:
+                runs = [_spill_run(heapq.merge(*(_read_run(f) for f in runs), key=key), tmp_dir)]
+    buffer.sort(key=key)
+
+    if runs:
+        logging.debug(f"External sort - merging {len(runs)} spilled runs")
+    yield from heapq.merge(*(_read_run(f) for f in runs), buffer, key=key)
+
+def group_by_person(records, key = 'person_id', max_records = None):
+    # external_group of parsed records by their person_id (the key field): (person_id, records in input order) in person_id order
+    return external_group(records, sort_key=operator.itemgetter(key), max_records=max_records)
+
+def external_group(records, sort_key, group_key = None, max_records = None, tmp_dir = None):
+    """Yields (group key, list of records) for consecutive records with the same group_key (sort_key when None), 
+        in sort_key order. Only one group plus the external_sort buffer is held in memory.
+    """
+    group_key = group_key or sort_key
+    for k, group in itertools.groupby(external_sort(records, sort_key, max_records, tmp_dir), key=group_key):
+        yield k, list(group)
+
+# PROFILING
+# With opts['profile_dir'], each chunk runs under a StageProfiler: one cProfile.Profile per stage, of which only the 
+# innermost stage entered is enabled, so every call is counted in exactly one stage. The stages are the domains of 
+# extract_chunk (parse_* and createListDict*), 'query' (cursor execute and fetches), 'create' (createPheno* and 
+# assemblePheno), 'serialize' (encoding and writing the Phenopackets) and 'columnar'. Without profile_dir no profiler 
+# is created and the profile_* helpers return at once.
+class StageProfiler:
+    def __init__(self):
+        self.profiles = {}
+        self.stack = []
+
+    def enter(self, name):
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+        profile = self.profiles.get(name)
+        if profile is None:
+            profile = self.profiles[name] = cProfile.Profile()
+        self.stack.append(name)
+        profile.enable()
+
+    def exit(self):
+        self.profiles[self.stack.pop()].disable()
+        if self.stack:
+            self.profiles[self.stack[-1]].enable()
+
+    def close(self):
+        # Leaves every stage, e.g. after an exception
+        while self.stack:
+            self.exit()
+
+    def dump(self, profile_dir, prefix):
+        # Output: list of files written, one <prefix>_<stage>.pstats per stage
+        written = []
+        for name, profile in self.profiles.items():
+            path = os.path.join(profile_dir, f"{prefix}_{name}.pstats")
+            profile.dump_stats(path)
+            written.append(path)
+        return written
+
+def profile_enter(profiler, name):
+    if profiler is not None:
+        profiler.enter(name)
+
+def profile_exit(profiler):
+    if profiler is not None:
+        profiler.exit()
+
+@contextlib.contextmanager
+def profile_stage(profiler, name):
+    profile_enter(profiler, name)
+    try:
+        yield
+    finally:
+        profile_exit(profiler)
+
+def profile_iter(profiler, name, iterable):
+    # Profiles each step of a lazy stream (e.g. iter_packets) as stage name
+    if profiler is None:
+        return iterable
+    return _profiled_iter(profiler, name, iter(iterable))
+
+def _profiled_iter(profiler, name, it):
+    end = object()
+    while True:
+        with profile_stage(profiler, name):
+            item = next(it, end)
+        if item is end:
+            return
+        yield item
+
+class ProfiledCursor:
+    """Cursor proxy that profiles execute and the fetches as stage 'query'"""
+    def __init__(self, cur, profiler):
+        self.cur = cur
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+    def execute(self, *args):
+        with profile_stage(self.profiler, 'query'):
+            return self.cur.execute(*args)
+
+    def fetchmany(self, size):
+        with profile_stage(self.profiler, 'query'):
+            return self.cur.fetchmany(size)
+
+    def fetchall(self):
+        with profile_stage(self.profiler, 'query'):
+            return self.cur.fetchall()
+
+def summarize_profiles(profile_dir, top = 20):
+    """Merges the chunk<n>_<stage>.pstats files of profile_dir into one <stage>.pstats per stage and writes 
+        profile_summary.txt: the time of each stage and its top functions by internal time 
+        Output: dict of stage -> seconds, slowest first
+    """
+    files = {}
+    for f in sorted(os.listdir(profile_dir)):
+        m = re.match(r'chunk\d+_(.+)\.pstats$', f)
+        if m:
+            files.setdefault(m.group(1), []).append(os.path.join(profile_dir, f))
+
+    summary = io.StringIO()
+    seconds = {}
+    merged = {}
+    for stage, paths in files.items():
+        merged[stage] = pstats.Stats(*paths, stream=summary)
+        path = os.path.join(profile_dir, stage + '.pstats')
+        merged[stage].dump_stats(temp_path(path))
+        os.replace(temp_path(path), path)
+        seconds[stage] = merged[stage].total_tt
+    seconds = dict(sorted(seconds.items(), key=operator.itemgetter(1), reverse=True))
+
+    total = sum(seconds.values())
+    for stage, s in seconds.items():
+        summary.write(f"{stage:<15} {s:10.3f} s {100 * s / total if total else 0:5.1f} %\n")
+        logging.info(f"Profile - {stage}: {s:.2f} s")
+    for stage in seconds:
+        summary.write(f"\n==== {stage}\n")
+        merged[stage].sort_stats('tottime').print_stats(top)
+    path = os.path.join(profile_dir, 'profile_summary.txt')
+    with open(temp_path(path), 'w') as f:
+        f.write(summary.getvalue())
+    os.replace(temp_path(path), path)
+    return seconds
+
+# PIPELINE
+DEFAULT_OPTIONS = {
+    'db': '',
+    'ohdsi_db': '',
+    'sem_mapping_file': None,
+    'name': 'omop2pheno',
+    'output_path': '.',
+    'chunk_size': 1000,
+    'workers': 1,
+    'fetch_size': 5000,
+    'output_format': 'json',
+    'compression': 'none',
+    'checkpoint_dir': None,
+    'metrics_file': None,
+    'export_parquet': False,
+    'cache_dir': None,
+    'cache_max_bytes': None,
+    'vocabulary_version': None,
+    'cohort_def_file': None,
+    'include_descendants': False,
+    'cohort_table': '##omop2pheno_cohort',
+    'balance_chunks': False,
+    'chunk_rows': None,
+    'sort_buffer_records': None,
+    'drug_strength_rule': 'first',
+    'drug_strength_dir': '~/.omop2pheno',
+    'prepare_statements': True,
+    'pool_size': 4,
+    'pool_check_seconds': 60,
+    'field_mapping_file': None,
+    'domains': None,
+    'omit_fields': (),
+    'drug_type_mapping_file': None,
+    'schedule_frequency_mapping_file': None,
+    'event_start': None,
+    'event_end': None,
+    'include_concepts_file': None,
+    'exclude_concepts_file': None,
+    'visit_concepts': None,
+    'filter_table_min': 1000,
+    'coalesce_gap_days': None,
+    'service_cache_size': 10000,
+    'service_batch_ms': 10,
+    'service_max_batch': 500,
+    'service_fresh_seconds': 0,
+    'profile_dir': None,
+    'profile_top': 20,
+    'verify': None,
+    'verify_sample': 0.01,
+    'verify_workers': 2,
+}
+
+# compression name -> (opener, file suffix)
+COMPRESSION_OPENERS = {
+    'none': (open, ''),
+    'gzip': (gzip.open, '.gz'),
+    'bz2': (bz2.open, '.bz2'),
+    'xz': (lzma.open, '.xz'),
+}
+
+def connect_db(conn_args):
+    """Input: keyword arguments for pymssql.connect, or a dict holding a 'connect' callable plus its keyword arguments 
+            (and optionally the driver's 'paramstyle', see driver_paramstyle)
+        Output: an open DB-API connection
+    """
+    conn_args = dict(conn_args)
+    conn_args.pop('paramstyle', None)
+    connect = conn_args.pop('connect', None)
+    if(connect is None):
+        import pymssql
+        connect = pymssql.connect
+    return connect(**conn_args)
+
+def format_pid(pids):
+    # Renders person_ids as the '(1,2,3)' tuple string spliced into the get_*_query functions
+    return '(' + ','.join(str(int(p)) for p in pids) + ')'
+
+def iter_records(cur, query, fetch_size, params = None):
+    # Streams a result set in fetch_size batches instead of a single fetchall
+    if params is None:
+        cur.execute(query)
+    else:
+        cur.execute(query, params)
+    while True:
+        batch = cur.fetchmany(fetch_size)
+        if not batch:
+            break
+        yield from batch
+
+def read_pids(pid_file):
+    """Input: a text file with one person_id per line (blank lines, '#' comments and a non-numeric header are skipped)
+        Output: list of person_ids in file order, without duplicates
+    """
+    pids = []
+    seen = set()
+    with open(pid_file) as f:
+        for line in f:
+            line = line.split('#')[0].strip().split(',')[0].strip()
+            if not line.isdigit():
+                continue
+            p = int(line)
+            if p not in seen:
+                seen.add(p)
+                pids.append(p)
+    return pids
+
+def read_cohort_pids(cur, cohort_query, fetch_size = 5000):
+    # The first column of every row returned by the cohort query is taken as a person_id
+    return [int(r[0]) for r in iter_records(cur, cohort_query, fetch_size)]
+
+def chunk_pids(pids, chunk_size):
+    return [pids[i:i + chunk_size] for i in range(0, len(pids), chunk_size)]
+
+def assemblePheno(pid, meta_data, domains):
+    """Input: a person_id, the metadata dict and a dict of domain name -> {person_id: list of Phenopacket entities}
+            (domains: individual, features, measurements, conditions, treatments, procedures)
+        Output: the Phenopacket for that person
+    """
+    medical_act_args = {
+        'txpheno': domains['treatments'].get(pid),
+        'procpheno': domains['procedures'].get(pid)
+    }
+    medicalactpheno = createPhenoMedicalAction(**medical_act_args)
+
+    pheno_args = {
+        'myid': str(pid),
+        'meta_data': meta_data,
+        'subject': domains['individual'].get(pid),
+        'phenotypic_features': domains['features'].get(pid),
+        'measurements': domains['measurements'].get(pid),
+        'diseases': domains['conditions'].get(pid),
+        'medical_actions': medicalactpheno if (len(medicalactpheno) > 0) else None
+    }
+
+    return createPheno(**pheno_args)
+
+# SCHEDULING
+def estimate_person_rows(cur, pids, opts):
+    """Input: a cursor and the person_ids of the run
+        Output: dict of person_id -> domain rows (0 for persons without any), counted on the server in chunk_size batches
+    """
+    rows = {int(p): 0 for p in pids}
+    for batch in chunk_pids(pids, opts['chunk_size']):
+        for pid, n in iter_records(cur, get_row_count_query(format_pid(batch), opts['db']), opts['fetch_size']):
+            rows[int(pid)] = int(n)
+    return rows
+
+def plan_target(total_weight, n_persons, chunk_size, chunk_rows = None):
+    # Weight per chunk: chunk_rows when given, otherwise the total spread over as many chunks as fixed-size chunking would use
+    if chunk_rows is not None:
+        return max(int(chunk_rows), 1)
+    n_chunks = max(-(-n_persons // chunk_size), 1)
+    return max(-(-total_weight // n_chunks), 1)
+
+def plan_chunks(person_rows, chunk_size, chunk_rows = None):
+    """Input: 
+            - person_rows: dict of person_id -> estimated domain rows
+            - chunk_size: maximum persons per chunk
+            - chunk_rows: weight per chunk, derived from chunk_size when None
+        Output: list of chunks (sorted person_id lists), heaviest first. A person weighs 1 + rows; persons weighing 
+            at least the target get their own chunk, the others are bin-packed (largest first into the lightest chunk).
+    """
+    weights = {p: 1 + n for p, n in person_rows.items()}
+    target = plan_target(sum(weights.values()), len(weights), chunk_size, chunk_rows)
+
+    heavy = sorted((p for p, w in weights.items() if w >= target), key=lambda p: (-weights[p], p))
+    light = sorted((p for p, w in weights.items() if w < target), key=lambda p: (-weights[p], p))
+    light_total = sum(weights[p] for p in light)
+
+    n_bins = max(-(-light_total // target), -(-len(light) // chunk_size), 1) if light else 0
+    bins = [[] for _ in range(n_bins)]
+    heap = [(0, i) for i in range(n_bins)]
+    for p in light:
+        load, i = heapq.heappop(heap)
+        bins[i].append(p)
+        if len(bins[i]) < chunk_size:
+            heapq.heappush(heap, (load + weights[p], i))
+        elif not heap: # every chunk is full
+            bins.append([])
+            heap.append((0, len(bins) - 1))
+
+    chunks = [[p] for p in heavy] + [b for b in bins if b]
+    chunks.sort(key=lambda c: -sum(weights[p] for p in c))
+    chunks = [sorted(c) for c in chunks]
+
+    loads = [sum(weights[p] for p in c) for c in chunks]
+    if loads:
+        logging.info(f"Plan - {len(chunks)} chunks ({len(heavy)} single-person), target weight {target}, "
+                     f"weight per chunk min {min(loads)} / mean {sum(loads) / len(loads):.0f} / max {max(loads)}")
+    return chunks
+
+def balance_cohort_table(conn, opts):
+    """Weights the persons of the cohort table on the server and reassigns its chunk_id (see get_cohort_balance_query) 
+        Output: list of (chunk_id, number of persons, membership), see read_cohort_chunks
+    """
+    cur = conn.cursor()
+    alter, update, totals = get_cohort_weight_queries(opts['cohort_table'], opts['db'])
+    cur.execute(alter)
+    conn.commit()
+    cur.execute(update)
+    cur.execute(totals)
+    n_persons, total_weight = cur.fetchall()[0]
+    target = plan_target(int(total_weight or 0), int(n_persons), opts['chunk_size'], opts['chunk_rows'])
+    cur.execute(get_cohort_balance_query(opts['cohort_table'], target, opts['chunk_size']))
+    conn.commit()
+    chunks = read_cohort_chunks(cur, opts['cohort_table'])
+    logging.info(f"Plan - {len(chunks)} chunks, target weight {target}")
+    return chunks
+
+# EXTRACTION CACHE
+# Raw result sets are stored per domain and chunk as Arrow IPC files named after a hash of the query text, 
+# the vocabulary version and the chunk, so transforms can be re-run without the database. The files are written and 
+# read one record batch (fetch_size rows) at a time. pyarrow is only needed when opts['cache_dir'] is set.
+def cache_key(query, vocabulary_version, pid, membership = None):
+    # membership: fingerprint of the persons of a cohort table chunk (see read_cohort_chunks), whose pid only names the chunk
+    h = hashlib.sha256()
+    parts = (query, str(vocabulary_version), pid) if membership is None else (query, str(vocabulary_version), pid, membership)
+    for part in parts:
+        h.update(part.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def cache_file(cache_dir, key):
+    return os.path.join(cache_dir, key + '.arrow')
+
+def read_cache(path):
+    """Yields the cached rows as tuples, one record batch of a memory-mapped Arrow IPC file at a time"""
+    import pyarrow as pa
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            columns = [col.to_pylist() for col in reader.get_batch(i).columns]
+            yield from zip(*columns)
+
+class CacheWriter:
+    """Writes rows to an Arrow IPC file, one record batch per write, under a temporary name until commit. 
+        A column whose type changes between batches (e.g. all nulls, then values) is promoted: the batches written so 
+        far are copied to the wider schema one at a time.
+    """
+    def __init__(self, path, metadata):
+        self.path = path
+        self.tmp = temp_path(path)
+        self.metadata = {k: str(v) for k, v in metadata.items()}
+        self.schema = None
+        self.sink = None
+        self.writer = None
+
+    def open(self, schema):
+        import pyarrow as pa
+        self.schema = schema.with_metadata(self.metadata)
+        self.sink = pa.OSFile(self.tmp, 'wb')
+        self.writer = pa.ipc.new_file(self.sink, self.schema)
+
+    def close_file(self):
+        self.writer.close()
+        self.sink.close()
+
+    def write(self, rows):
+        import pyarrow as pa
+        if not rows:
+            return
+        batch = pa.RecordBatch.from_arrays([pa.array([r[i] for r in rows]) for i in range(len(rows[0]))], 
+                                           names=[f"c{i}" for i in range(len(rows[0]))])
+        if self.writer is None:
+            self.open(batch.schema)
+        elif not batch.schema.equals(self.schema, check_metadata=False):
+            try:
+                batch = batch.cast(self.schema)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                self.promote(batch.schema)
+                batch = batch.cast(self.schema)
+        self.writer.write_batch(batch)
+
+    def promote(self, schema):
+        import pyarrow as pa
+        self.close_file()
+        written = self.tmp + '.promote'
+        os.replace(self.tmp, written)
+        self.open(pa.unify_schemas([self.schema.remove_metadata(), schema], promote_options='permissive'))
+        with pa.memory_map(written) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                self.writer.write_batch(reader.get_batch(i).cast(self.schema))
+        os.remove(written)
+
+    def commit(self):
+        import pyarrow as pa
+        if self.writer is None: # no rows
+            self.open(pa.schema([]))
+        self.close_file()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.close_file()
+            os.remove(self.tmp)
+
+def evict_cache(cache_dir, max_bytes):
+    # Removes the least recently used files (hits refresh the modification time) until the cache fits max_bytes
+    files = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.arrow'):
+            st = os.stat(os.path.join(cache_dir, f))
+            files.append((st.st_mtime, st.st_size, f))
+    total = sum(size for mtime, size, f in files)
+    evicted = 0
+    for mtime, size, f in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, f))
+        except FileNotFoundError: # already evicted by another worker
+            pass
+        total -= size
+        evicted += 1
+    if evicted:
+        logging.info(f"Cache - evicted {evicted} files, {total / 1e9:.2f} GB left")
+    return evicted
+
+def invalidate_cache(cache_dir, domain = None, vocabulary_version = None):
+    """Removes cached result sets, all of them or only those of a domain and/or vocabulary version 
+        Output: number of files removed
+    """
+    import pyarrow as pa
+    removed = 0
+    for f in os.listdir(cache_dir):
+        if not f.endswith('.arrow'):
+            continue
+        path = os.path.join(cache_dir, f)
+        if domain is not None or vocabulary_version is not None:
+            with pa.memory_map(path) as source:
+                metadata = pa.ipc.open_file(source).schema.metadata or {}
+            if domain is not None and metadata.get(b'domain') != domain.encode():
+                continue
+            if vocabulary_version is not None and metadata.get(b'vocabulary_version') != str(vocabulary_version).encode():
+                continue
+        os.remove(path)
+        removed += 1
+    logging.info(f"Cache - invalidated {removed} files in {cache_dir}")
+    return removed
+
+def fetch_records(cur, query, opts, domain, pid, params = None, membership = None):
+    """Rows of a domain query for one chunk, from the extraction cache when opts['cache_dir'] is set, otherwise streamed from cur 
+        (pid identifies the persons of the chunk in the cache key, together with membership for cohort table chunks, see cache_key; 
+        params are the query parameters, see batch_pid). Cached rows are streamed too: a miss writes the fetch_size 
+        batches of cur to the cache as they pass, a hit reads the cache file one record batch at a time.
+    """
+    if(opts['cache_dir'] is None):
+        return iter_records(cur, query, opts['fetch_size'], params)
+
+    path = cache_file(opts['cache_dir'], cache_key(query, opts['vocabulary_version'], pid, membership))
+    if os.path.exists(path):
+        os.utime(path)
+        return _read_cached(path, domain)
+    return _write_cached(cur, query, opts, domain, pid, params, path)
+
+def _read_cached(path, domain):
+    n = 0
+    for row in read_cache(path):
+        n += 1
+        yield row
+    logging.info(f"Cache - {domain} - {n} records read from cache")
+
+def _write_cached(cur, query, opts, domain, pid, params, path):
+    # The file is only committed once every row was read, a stream closed early leaves no cache file
+    writer = CacheWriter(path, {'domain': domain, 'vocabulary_version': opts['vocabulary_version'], 'pid': pid})
+    try:
+        if params is None:
+            cur.execute(query)
+        else:
+            cur.execute(query, params)
+        while True:
+            batch = cur.fetchmany(opts['fetch_size'])
+            if not batch:
+                break
+            writer.write(batch)
+            yield from batch
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+    if(opts['cache_max_bytes'] is not None):
+        evict_cache(opts['cache_dir'], opts['cache_max_bytes'])
+
+class LazyCursor:
+    """DB-API cursor that only connects on its first execute, so chunks served from the extraction cache never open a connection"""
+    def __init__(self, conn_args):
+        self.conn_args = conn_args
+        self.conn = None
+        self.cur = None
+
+    def execute(self, *args):
+        if self.conn is None:
+            self.conn = connect_db(self.conn_args)
+            self.cur = self.conn.cursor()
+        return self.cur.execute(*args)
+
+    def fetchmany(self, size):
+        return self.cur.fetchmany(size)
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+# EXTRACTION FILTERS
+# domain -> (table alias, event date column, standard concept column, source concept column, OMOP domain in concept set files)
+FILTER_COLUMNS = {
+    'conditions': ('co', 'condition_start_date', 'condition_concept_id', 'condition_source_concept_id', 'Condition'),
+    'features': ('obs', 'observation_date', 'observation_concept_id', 'observation_source_concept_id', 'Observation'),
+    'measurements': ('m', 'measurement_date', 'measurement_concept_id', 'measurement_source_concept_id', 'Measurement'),
+    'treatments': ('de', 'drug_exposure_start_date', 'drug_concept_id', 'drug_source_concept_id', 'Drug'),
+    'procedures': ('po', 'procedure_date', 'procedure_concept_id', 'procedure_source_concept_id', 'Procedure'),
+}
+FILTER_TABLE_PREFIX = '#omop2pheno_'
+
+_concept_sets = {}
+
+def get_concept_set(concept_file):
+    # (OMOP domain, standard) -> sorted concept_ids of a concept set CSV (see get_cohort_def), read once per process
+    if concept_file not in _concept_sets:
+        sets = {}
+        for c in get_cohort_def(concept_file):
+            sets.setdefault((c['domain_id'], c['standard']), set()).add(c['concept_id'])
+        _concept_sets[concept_file] = {d: sorted(ids) for d, ids in sets.items()}
+    return _concept_sets[concept_file]
+
+def sql_date(value):
+    # Validated 'YYYY-MM-DD' literal
+    return "'" + datetime.strptime(str(value)[:10], '%Y-%m-%d').strftime('%Y-%m-%d') + "'"
+
+def get_filter_table_queries(table, concept_ids):
+    # (Re)creates a session temp table of concept_ids; T-SQL takes at most 1000 rows per insert ... values
+    queries = ["if object_id('tempdb.." + table + "') is not null drop table " + table + ";",
+               "create table " + table + " (concept_id bigint primary key);"]
+    for i in range(0, len(concept_ids), 1000):
+        queries.append("insert into " + table + " values " + ",".join("(" + str(int(c)) + ")" for c in concept_ids[i:i + 1000]) + ";")
+    return queries
+
+def get_event_filters(domain, opts):
+    """Input: an event domain (see FILTER_COLUMNS) and run options: 
+            - event_start, event_end: keep events dated within these days (inclusive)
+            - include_concepts_file, exclude_concepts_file: concept set CSVs (see get_cohort_def); a domain is only 
+              restricted by the concepts of its own OMOP domain, standard concepts are matched against its standard 
+              concept column and non-standard ones (e.g. ICD9CM) against its source concept column, as in get_cohort_table_query
+            - visit_concepts: keep events of visits with these visit_concept_ids (e.g. 9201 inpatient)
+        Output: 
+            - filters: SQL conditions appended to the where clause of the domain query ('' without filters)
+            - tables: list of (temp table, concept_ids) the filters read; concept sets larger than opts['filter_table_min'] 
+              are loaded into temp tables instead of being spliced into every query
+    """
+    alias, date_column, concept_column, source_column, omop_domain = FILTER_COLUMNS[domain]
+    conditions, tables = [], []
+
+    if(opts['event_start'] is not None):
+        conditions.append(alias + "." + date_column + " >= " + sql_date(opts['event_start']))
+    if(opts['event_end'] is not None):
+        conditions.append(alias + "." + date_column + " <= " + sql_date(opts['event_end']))
+
+    for kind, concept_file in (('include', opts['include_concepts_file']), ('exclude', opts['exclude_concepts_file'])):
+        if concept_file is None:
+            continue
+        members = []
+        for standard, column in ((True, concept_column), (False, source_column)):
+            concept_ids = get_concept_set(concept_file).get((omop_domain, standard))
+            if not concept_ids:
+                continue
+            if(len(concept_ids) > opts['filter_table_min']):
+                # Named after the concept set, so query texts (and extraction cache keys) change with its content
+                table = FILTER_TABLE_PREFIX + kind + '_' + domain + ('' if standard else '_source') + '_' + hashlib.sha1(",".join(map(str, concept_ids)).encode()).hexdigest()[:12]
+                tables.append((table, concept_ids))
+                concept_set = "(select concept_id from " + table + ")"
+            else:
+                concept_set = "(" + ",".join(str(int(c)) for c in concept_ids) + ")"
+            # Source concept columns are nullable, a null must not turn 'not (...)' unknown
+            member = alias + "." + column + " in " + concept_set
+            members.append(member if standard else "(" + alias + "." + column + " is not null and " + member + ")")
+        if members:
+            matched = " or ".join(members)
+            conditions.append(("(" + matched + ")") if kind == 'include' else ("not (" + matched + ")"))
+
+    if opts['visit_concepts']:
+        conditions.append(alias + ".visit_occurrence_id in (select vf.visit_occurrence_id from " + opts['db'] + "visit_occurrence vf where vf.visit_concept_id in (" + 
+                          ",".join(str(int(c)) for c in opts['visit_concepts']) + "))")
+
+    return "".join("\n    and " + c for c in conditions), tables
+
+def prepare_filter_tables(cur, tables):
+    # Temp tables are created once per pooled connection (PooledCursor), or right away on other cursors
+    for table, concept_ids in tables:
+        queries = get_filter_table_queries(table, concept_ids)
+        if hasattr(cur, 'add_setup'):
+            cur.add_setup(table, queries)
+        else:
+            for q in queries:
+                cur.execute(q)
+
+# CONNECTION POOL
+# DB-API paramstyle -> marker of the person batch parameter
+PARAM_MARKERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s', 'numeric': ':1', 'named': ':pids'}
+
+def driver_paramstyle(conn_args):
+    # pymssql when no 'connect' callable is given, otherwise the paramstyle of the callable's module unless set in conn_args
+    if(conn_args.get('paramstyle')):
+        return conn_args['paramstyle']
+    connect = conn_args.get('connect')
+    if connect is None:
+        return 'pyformat'
+    return getattr(sys.modules.get(getattr(connect, '__module__', None)), 'paramstyle', 'qmark')
+
+def batch_pid(pids, opts, paramstyle = 'pyformat'):
+    """Input: a chunk of person_ids (or a pid SQL expression), run options and the driver paramstyle 
+        Output: 
+            - the pid expression spliced into the get_*_query functions
+            - the query parameters, or None when the person_ids are spliced in as literals
+        With opts['prepare_statements'] the person_ids are sent as one comma separated parameter, so the text of each 
+        domain query is the same for every chunk and the server compiles it once (string_split needs SQL Server 2016).
+    """
+    if isinstance(pids, str) or not opts['prepare_statements']:
+        return (pids if isinstance(pids, str) else format_pid(pids)), None
+    batch = ','.join(str(int(p)) for p in pids)
+    params = {'pids': batch} if paramstyle == 'named' else (batch,)
+    return "(select cast(value as bigint) from string_split(" + PARAM_MARKERS[paramstyle] + ", ','))", params
+
+class ConnectionPool:
+    """Keeps up to max_size open connections of one process for reuse across chunks and domains. 
+        Each pooled connection keeps one cursor per parameterized statement, so drivers that prepare on the server (e.g. pyodbc) 
+        prepare each domain query once per connection. A connection idle for more than check_seconds is checked with 
+        'select 1' before it is handed out, and replaced when it was dropped.
+    """
+    def __init__(self, conn_args, max_size = 4, check_seconds = 60):
+        self.conn_args = conn_args
+        self.max_size = max_size
+        self.check_seconds = check_seconds
+        self.paramstyle = driver_paramstyle(conn_args)
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stats = {'connects': 0, 'reconnects': 0, 'checks': 0, 'prepares': 0, 'executions': 0}
+
+    def connect(self):
+        # A pooled connection: [connection, default cursor, statement -> cursor, last used, setup keys run on it]
+        conn = connect_db(self.conn_args)
+        with self.lock:
+            self.stats['connects'] += 1
+        return [conn, conn.cursor(), {}, time.time(), set()]
+
+    def alive(self, entry):
+        with self.lock:
+            self.stats['checks'] += 1
+        try:
+            cur = entry[0].cursor()
+            cur.execute("select 1;")
+            cur.fetchall()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        with self.lock:
+            entry = self.idle.pop() if self.idle else None
+        if entry is not None and time.time() - entry[3] > self.check_seconds and not self.alive(entry):
+            entry = self.reconnect(entry)
+        return entry if entry is not None else self.connect()
+
+    def reconnect(self, entry):
+        try:
+            entry[0].close()
+        except Exception:
+            pass
+        with self.lock:
+            self.stats['reconnects'] += 1
+        return self.connect()
+
+    def release(self, entry):
+        entry[3] = time.time()
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append(entry)
+                return
+        entry[0].close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for entry in idle:
+            entry[0].close()
+
+_POOLS = {}
+
+def get_pool(conn_args, opts):
+    """The connection pool of this process for conn_args (a forked worker process does not reuse its parent's connections)"""
+    key = repr(sorted((k, repr(v)) for k, v in conn_args.items()))
+    pool = _POOLS.get(key)
+    if pool is None or pool.pid != os.getpid():
+        pool = _POOLS[key] = ConnectionPool(conn_args, opts['pool_size'], opts['pool_check_seconds'])
+    return pool
+
+def close_pools():
+    # Closes the idle connections of every pool of this process
+    for pool in _POOLS.values():
+        if pool.pid == os.getpid():
+            pool.close()
+    _POOLS.clear()
+
+class PooledCursor:
+    """DB-API cursor on a pooled connection, taken from the pool on the first execute and returned by close. 
+        A statement that fails on a dropped connection is retried once on a new connection. 
+        Setup statements (add_setup) run once per pooled connection, before its first query that needs them.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.paramstyle = pool.paramstyle
+        self.entry = None
+        self.cur = None
+        self.setup = []
+
+    def add_setup(self, key, statements):
+        self.setup.append((key, statements))
+
+    def execute(self, query, params = None):
+        if self.entry is None:
+            self.entry = self.pool.acquire()
+        try:
+            return self._execute(query, params)
+        except Exception:
+            if self.pool.alive(self.entry):
+                raise
+            self.entry = self.pool.reconnect(self.entry)
+            return self._execute(query, params)
+
+    def _execute(self, query, params):
+        conn, default_cur, statements, done = self.entry[0], self.entry[1], self.entry[2], self.entry[4]
+        for key, setup in self.setup:
+            if key not in done:
+                for statement in setup:
+                    default_cur.execute(statement)
+                conn.commit()
+                done.add(key)
+        with self.pool.lock:
+            self.pool.stats['executions'] += 1
+        if params is None:
+            self.cur = default_cur
+            return self.cur.execute(query)
+        self.cur = statements.get(query)
+        if self.cur is None:
+            self.cur = statements[query] = conn.cursor()
+            with self.pool.lock:
+                self.pool.stats['prepares'] += 1
+        return self.cur.execute(query, params)
+
+    def fetchmany(self, size):
+        return self.cur.fetchmany(size)
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def close(self):
+        if self.entry is not None:
+            self.pool.release(self.entry)
+            self.entry = None
+            self.cur = None
+
+def extract_chunk(cur, pids, opts, phefeatures, stream = False, profiler = None, membership = None):
+    """Runs the extract, parse and transform steps of every domain for one chunk of person_ids 
+        (only the domains and fields of the extraction profile, see get_profile)
+        Output: 
+            - lists: dict of domain -> iterator of (person_id, entries) in person_id order (see iter_packets), empty for 
+              skipped domains. The rows of every domain are already read from cur, held only by the external sort 
+              (opts['sort_buffer_records']), and transformed one person at a time while the iterators are consumed. 
+              With stream = False, dicts of person_id -> entries (createDict*/createListDict* output) instead.
+            - timings: dict of domain -> seconds spent (with stream only the extraction and sort)
+        profiler: a StageProfiler (see PROFILING) or None
+        membership: fingerprint of the persons of a cohort table chunk (see read_cohort_chunks), for the extraction cache
+    """
+    opts = dict(DEFAULT_OPTIONS, **opts)
+    pid = pids if isinstance(pids, str) else format_pid(pids)
+    qpid, params = batch_pid(pids, opts, getattr(cur, 'paramstyle', 'pyformat'))
+    db, ohdsi_db = opts['db'], opts['ohdsi_db']
+    max_records = opts['sort_buffer_records']
+    domains, fields = get_profile(opts['field_mapping_file'], opts['domains'], opts['omit_fields'])
+    lists = {domain: {} for domain in DOMAIN_COLUMNS}
+    timings = {}
+    if profiler is not None:
+        cur = ProfiledCursor(cur, profiler)
+
+    def records(domain, query, columns, field_list, values_nono = None):
+        # Parsed records of a domain query; each domain is sorted (read from cur) before the next query runs, see primed
+        rows = fetch_records(cur, query, opts, domain, pid, params, membership)
+        columns = [c for c, e in query_columns(columns, field_list)]
+        return iterParse(rows, columns) if values_nono is None else iterParse(rows, columns, values_nono)
+
+    def finish(domain, items):
+        lists[domain] = profile_iter(profiler, domain, items) if stream else dict(items)
+
+    filters = {}
+    for domain in FILTER_COLUMNS:
+        filters[domain], tables = get_event_filters(domain, opts)
+        if domain in domains or (domain == 'conditions' and 'features' in domains):
+            prepare_filter_tables(cur, tables)
+
+    # Individual and Vitals
+    t1 = time.time()
+    profile_enter(profiler, 'individual')
+    births = {} # person_id -> birth datetime, for the procedure ages
+    individuals = records('individual', get_individual_query(qpid, db, fields['individual']), INDIVIDUAL_COLUMNS, fields['individual'], (None,))
+    individuals = primed(group_by_person(iter_births(individuals, births), 'id', max_records))
+    vitals = iter(())
+    if('vital_status' in fields['individual']):
+        vitals = records('vital_status', get_vitalstatus_query(qpid, db, fields['individual']), VITAL_STATUS_COLUMNS, fields['individual'], (None,))
+        vitals = primed(group_by_person(vitals, 'person_id', max_records))
+    finish('individual', iterDictIndividual(individuals, vitals))
+    profile_exit(profiler)
+    timings['individual'] = time.time() - t1
+
+    # Conditions (also the source of condition-derived PhenotypicFeatures)
+    condition_features = None
+    if('conditions' in domains or 'features' in domains):
+        t1 = time.time()
+        profile_enter(profiler, 'conditions')
+        rows = fetch_records(cur, get_condition_query(qpid, db, ohdsi_db, fields['conditions'], filters['conditions']), opts, 'conditions', pid, params, membership)
+        groups = primed(external_group(iterParseConditions(rows, phefeatures, fields['conditions']), 
+                                       sort_key=lambda r: r[1]['person_id'], max_records=max_records))
+        # Both domains read the same sorted rows; they are consumed in step by the merge of iter_packets, so the 
+        # tee holds about one person
+        if('conditions' in domains and 'features' in domains):
+            groups, feature_groups = itertools.tee(groups)
+        else:
+            feature_groups = groups
+        if('conditions' in domains):
+            finish('conditions', iterListDictConditions((p, [r for f, r in rows if not f]) for p, rows in groups))
+        if('features' in domains):
+            condition_features = iterListDictPhenoFeature(((p, [r for f, r in rows if f]) for p, rows in feature_groups), flag = 'condition')
+        profile_exit(profiler)
+        timings['conditions'] = time.time() - t1
+
+    # PhenotypicFeatures
+    if('features' in domains):
+        t1 = time.time()
+        profile_enter(profiler, 'features')
+        features = records('features', get_phenofeature_query(qpid, db, ohdsi_db, fields['features'], filters['features']), PHENOFEATURE_COLUMNS, fields['features'])
+        observation_features = iterListDictPhenoFeature(primed(group_by_person(features, max_records = max_records)), flag = 'observation')
+        finish('features', iterCombined(condition_features, observation_features))
+        profile_exit(profiler)
+        timings['features'] = time.time() - t1
+
+    # Measurement
+    if('measurements' in domains):
+        t1 = time.time()
+        profile_enter(profiler, 'measurements')
+        measurements = records('measurements', get_measurement_query(qpid, db, ohdsi_db, fields['measurements'], filters['measurements']), MEASUREMENT_COLUMNS, fields['measurements'])
+        finish('measurements', primed(iterListDictMeasurements(measurements, max_records)))
+        profile_exit(profiler)
+        timings['measurements'] = time.time() - t1
+
+    # Treatment
+    if('treatments' in domains):
+        t1 = time.time()
+        profile_enter(profiler, 'treatments')
+        drug_types, frequencies = get_code_mappings(opts)
+        txdict = records('treatments', get_treatment_query(qpid, db, ohdsi_db, fields['treatments'], filters['treatments']), TREATMENT_COLUMNS, fields['treatments'])
+        if('dose_intervals.quantity' in fields['treatments']):
+            txdict = iter_drug_strength(txdict, get_drug_strength_index(cur, opts))
+        finish('treatments', primed(iterListDictTreatment(txdict, max_records, drug_types, frequencies, opts['coalesce_gap_days'])))
+        profile_exit(profiler)
+        timings['treatments'] = time.time() - t1
+
+    # Procedure
+    if('procedures' in domains):
+        t1 = time.time()
+        profile_enter(profiler, 'procedures')
+        procedures = records('procedures', get_procedure_query(qpid, db, ohdsi_db, fields['procedures'], filters['procedures']), PROCEDURE_COLUMNS, fields['procedures'])
+        # performed_age is kept in the transformed record and the columnar export; the Phenopacket's performed TimeElement 
+        # holds one of age and timestamp, and keeps the timestamp
+        procedures = iter_ages(procedures, births, 'performed_timestamp', 'performed_age', opts['fetch_size'])
+        finish('procedures', iterListDictProcedures(primed(group_by_person(procedures, max_records = max_records))))
+        profile_exit(profiler)
+        timings['procedures'] = time.time() - t1
+
+    return lists, timings
+
+# domain -> createPheno* function applied to each person's entries
+DOMAIN_CREATORS = {
+    'individual': createPhenoIndividual,
+    'conditions': createPhenoConditions,
+    'features': createPhenoFeature,
+    'measurements': createPhenoMeasurement,
+    'treatments': createPhenoTreatment,
+    'procedures': createPhenoProcedure,
+}
+
+def create_chunk(lists, meta_data):
+    """Input: the extract_chunk lists of one chunk and the metadata dict 
+        Output: dict of person_id -> Phenopacket (one per person with Individual data)
+    """
+    domains = {}
+    for domain, creator in DOMAIN_CREATORS.items():
+        domains[domain] = {key: creator(value) for key, value in lists[domain].items()}
+
+    return {p: assemblePheno(p, meta_data, domains) for p in domains['individual'].keys()}
+
+def primed(stream):
+    # Runs a generator up to its first item, so the rows it reads (e.g. from a cursor) are consumed before the next query
+    first = next(stream, None)
+    return iter(()) if first is None else itertools.chain([first], stream)
+
+def _tagged(domain, stream):
+    for pid, entries in stream:
+        yield pid, domain, entries
+
+def merge_domains(streams):
+    """Input: dict of domain -> iterable of (person_id, entries) sorted by person_id 
+        Output: yields (person_id, dict of domain -> entries) in person_id order (k-way merge of the streams)
+    """
+    merged = heapq.merge(*(_tagged(domain, stream) for domain, stream in streams.items()), key=operator.itemgetter(0))
+    for pid, group in itertools.groupby(merged, key=operator.itemgetter(0)):
+        yield pid, {domain: entries for p, domain, entries in group}
+
+def domain_streams(lists):
+    # extract_chunk lists as iterators of (person_id, entries) in person_id order, for merge_domains
+    return {domain: iter(sorted(entries.items())) if isinstance(entries, dict) else entries for domain, entries in lists.items()}
+
+def iter_packets(lists, meta_data, columnar = None):
+    """Input: the extract_chunk lists of one chunk (dicts of person_id -> entries, or iterators of (person_id, entries) 
+            sorted by person_id), the metadata dict and optionally a ColumnarWriter
+        Output: yields (person_id, Phenopacket) in person_id order for every person with Individual data. A packet is 
+            built as soon as every domain has passed its person, so the Phenopacket entities of one person are held at a time. 
+            With columnar, every person's transformed records are also added to the Parquet tables.
+    """
+    for pid, entries in merge_domains(domain_streams(lists)):
+        if columnar is not None:
+            columnar.add(pid, entries)
+        if 'individual' not in entries:
+            continue
+        domains = {domain: {pid: creator(entries[domain])} if domain in entries else {} for domain, creator in DOMAIN_CREATORS.items()}
+        yield pid, assemblePheno(pid, meta_data, domains)
+
+# COLUMNAR EXPORT
+# table -> (column -> pandas dtype); fixed dtypes keep the schema identical across partitions
+COLUMNAR_TABLES = {
+    'individuals': {
+        'person_id': 'int64', 'date_of_birth': 'datetime64[us]', 'time_at_last_encounter': 'datetime64[us]',
+        'sex': 'string', 'vital_status': 'string', 'time_of_death': 'datetime64[us]'},
+    'diseases': {
+        'person_id': 'int64', 'term_id': 'string', 'term_label': 'string', 'onset': 'datetime64[us]',
+        'resolution': 'datetime64[us]', 'primary_site_id': 'string', 'primary_site_label': 'string'},
+    'phenotypic_features': {
+        'person_id': 'int64', 'type_id': 'string', 'type_label': 'string', 'modifier_id': 'string',
+        'modifier_label': 'string', 'onset': 'datetime64[us]', 'resolution': 'datetime64[us]', 'description': 'string'},
+    'measurements': {
+        'person_id': 'int64', 'assay_id': 'string', 'assay_label': 'string', 'time_observed': 'datetime64[us]',
+        'value': 'float64', 'unit_id': 'string', 'unit_label': 'string', 'value_id': 'string', 'value_label': 'string',
+        'range_low': 'float64', 'range_high': 'float64'},
+    'dose_intervals': {
+        'person_id': 'int64', 'agent_id': 'string', 'agent_label': 'string', 'route_of_administration_id': 'string',
+        'route_of_administration_label': 'string', 'drug_type': 'string', 'quantity_value': 'float64',
+        'quantity_unit_id': 'string', 'quantity_unit_label': 'string', 'schedule_frequency_id': 'string',
+        'schedule_frequency_label': 'string', 'interval_start': 'datetime64[us]', 'interval_end': 'datetime64[us]'},
+    'procedures': {
+        'person_id': 'int64', 'code_id': 'string', 'code_label': 'string', 'body_site_id': 'string',
+        'body_site_label': 'string', 'performed': 'datetime64[us]', 'performed_age': 'string'},
+}
+
+# Parquet has no bz2/xz codec, zstd is used in their place
+PARQUET_COMPRESSION = {'none': None, 'gzip': 'gzip', 'bz2': 'zstd', 'xz': 'zstd'}
+
+# Rows buffered per table before they are written as a Parquet row group
+COLUMNAR_BATCH_ROWS = 50000
+
+# The flatten* functions take (person_id, entries) pairs, e.g. the items of a createListDict* dict
+def _timestamp(d, key):
+    # {'timestamp': '...'} entries produced by the createListDict* functions
+    return d[key]['timestamp'] if key in d else None
+
+def _ontology(d, key):
+    return (d[key]['id'], d[key]['label']) if key in d else (None, None)
+
+def flattenIndividuals(items):
+    rows = []
+    for pid, i in items:
+        vs = i.get('vital_status', {})
+        rows.append((pid, i.get('date_of_birth'), i.get('time_at_last_encounter'), i.get('sex'),
+                     vs.get('status'), vs.get('time_of_death')))
+    return rows
+
+def flattenDiseases(items):
+    rows = []
+    for pid, ilist in items:
+        for i in ilist:
+            if('discarded' in i):
+                continue
+            rows.append((pid, *_ontology(i, 'term'), _timestamp(i, 'onset'), _timestamp(i, 'resolution'), *_ontology(i, 'primary_site')))
+    return rows
+
+def flattenFeatures(items):
+    rows = []
+    for pid, ilist in items:
+        for i in ilist:
+            if('discarded' in i):
+                continue
+            rows.append((pid, *_ontology(i, 'type'), *_ontology(i, 'modifiers'), _timestamp(i, 'onset'),
+                         _timestamp(i, 'resolution'), i.get('description')))
+    return rows
+
+def flattenMeasurements(items):
+    rows = []
+    for pid, ilist in items:
+        for i in ilist:
+            if('discarded' in i):
+                continue
+            value = unit_id = unit_label = value_id = value_label = None
+            if('quantity' in i['value']):
+                value = i['value']['quantity']['value']
+                unit_id, unit_label = _ontology(i['value']['quantity'], 'unit')
+            else:
+                value_id, value_label = i['value']['id'], i['value']['label']
+            ref = i.get('reference_range', {})
+            rows.append((pid, *_ontology(i, 'assay'), i.get('time_observed'), value, unit_id, unit_label,
+                         value_id, value_label, ref.get('low'), ref.get('high')))
+    return rows
+
+def flattenDoseIntervals(items):
+    # One row per DoseInterval, the treatment fields are repeated on each
+    rows = []
+    for pid, ilist in items:
+        for i in ilist:
+            if('discarded' in i):
+                continue
+            treatment = (pid, *_ontology(i, 'agent'), *_ontology(i, 'route_of_administration'), i.get('drug_type'))
+            for d in i['dose_intervals']:
+                quantity = (d.quantity.value, d.quantity.unit.id, d.quantity.unit.label) if d.HasField('quantity') else (None, None, None)
+                frequency = (d.schedule_frequency.id, d.schedule_frequency.label) if d.HasField('schedule_frequency') else (None, None)
+                start = d.interval.start.ToDatetime() if d.interval.HasField('start') else None
+                end = d.interval.end.ToDatetime() if d.interval.HasField('end') else None
+                rows.append(treatment + quantity + frequency + (start, end))
+    return rows
+
+def flattenProcedures(items):
+    rows = []
+    for pid, ilist in items:
+        for i in ilist:
+            if('discarded' in i):
+                continue
+            performed = i.get('performed', {})
+            rows.append((pid, *_ontology(i, 'code'), *_ontology(i, 'body_site'), performed.get('timestamp'),
+                         performed.get('age', {}).get('iso8601duration')))
+    return rows
+
+# table -> (extract_chunk domain, flatten function)
+COLUMNAR_SOURCES = {
+    'individuals': ('individual', flattenIndividuals),
+    'diseases': ('conditions', flattenDiseases),
+    'phenotypic_features': ('features', flattenFeatures),
+    'measurements': ('measurements', flattenMeasurements),
+    'dose_intervals': ('treatments', flattenDoseIntervals),
+    'procedures': ('procedures', flattenProcedures),
+}
+
+def columnar_frame(table, rows):
+    """Input: a COLUMNAR_TABLES name and the rows of its flatten function 
+        Output: a pandas DataFrame with the table's dtypes, sorted by person_id
+    """
+    dtypes = COLUMNAR_TABLES[table]
+    df = pd.DataFrame.from_records(rows, columns=list(dtypes))
+    for col, dtype in dtypes.items():
+        if dtype.startswith('datetime64'):
+            # ISO strings from convert_time ('...Z') and naive UTC datetimes both parse to naive UTC
+            df[col] = pd.to_datetime(df[col], utc=True).dt.tz_localize(None).astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    return df.sort_values('person_id', kind='stable').reset_index(drop=True)
+
+class ColumnarWriter:
+    """Writes the transformed domain records of one chunk to Parquet tables under opts['output_path']/parquet/<table>/chunk=<chunk_id>/ 
+        (a hive-style partitioned dataset, readable at once with pd.read_parquet(output_path + '/parquet/<table>')). 
+        The records are added one person at a time (add) and written as row groups of batch_rows rows per table, so 
+        only those rows are held; close writes the rest and returns dict of table -> rows written.
+    """
+    def __init__(self, chunk_id, opts, profiler = None, batch_rows = COLUMNAR_BATCH_ROWS):
+        self.chunk_id = chunk_id
+        self.opts = opts
+        self.profiler = profiler
+        self.batch_rows = batch_rows
+        self.rows = {table: [] for table in COLUMNAR_TABLES}
+        self.counts = {table: 0 for table in COLUMNAR_TABLES}
+        self.writers = {}
+        self.seconds = 0.0
+
+    def add(self, pid, entries):
+        # entries: dict of domain -> one person's extract_chunk entries, before createPheno* converts them in place
+        t1 = time.time()
+        with profile_stage(self.profiler, 'columnar'):
+            for table, (domain, flatten) in COLUMNAR_SOURCES.items():
+                if domain in entries:
+                    self.rows[table].extend(flatten([(pid, entries[domain])]))
+                    if len(self.rows[table]) >= self.batch_rows:
+                        self.flush(table)
+        self.seconds += time.time() - t1
+
+    def flush(self, table):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        rows, self.rows[table] = self.rows[table], []
+        if not rows:
+            return
+        frame = pa.Table.from_pandas(columnar_frame(table, rows), preserve_index=False)
+        writer = self.writers.get(table)
+        if writer is None:
+            partition = os.path.join(self.opts['output_path'], 'parquet', table, f"chunk={self.chunk_id:05d}")
+            os.makedirs(partition, exist_ok=True)
+            writer = self.writers[table] = pq.ParquetWriter(os.path.join(partition, 'part-0.parquet'), frame.schema, 
+                                                            compression=PARQUET_COMPRESSION[self.opts['compression']] or 'none')
+        writer.write_table(frame.cast(writer.schema))
+        self.counts[table] += len(rows)
+
+    def close(self):
+        t1 = time.time()
+        with profile_stage(self.profiler, 'columnar'):
+            for table in COLUMNAR_TABLES:
+                self.flush(table)
+            for writer in self.writers.values():
+                writer.close()
+            self.writers = {}
+        self.seconds += time.time() - t1
+        return dict(self.counts)
+
+def write_columnar(lists, chunk_id, opts, profiler = None):
+    """Writes the extract_chunk lists of one chunk (dicts or person_id ordered streams) with a ColumnarWriter
+        Output: dict of table -> rows written
+    """
+    writer = ColumnarWriter(chunk_id, opts, profiler)
+    for pid, entries in merge_domains(domain_streams(lists)):
+        writer.add(pid, entries)
+    return writer.close()
+
+# JSON SERIALIZATION
+# PhenopacketToJson produces the same JSON as MessageToJson without its per-field reflection: the conversion of each 
+# field is compiled once from its descriptor and reused for every message.
+_json_converters = {} # field descriptor -> function converting the field value to its JSON object
+
+# Well-known types with their own JSON representation (MessageToDict handles the rest, e.g. Any, Struct, wrappers)
+_JSON_STRING_TYPES = ('google.protobuf.Timestamp', 'google.protobuf.Duration', 'google.protobuf.FieldMask')
+
+def _json_double(value):
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if math.isnan(value):
+        return 'NaN'
+    return value
+
+def _json_float(value):
+    if math.isinf(value) or math.isnan(value):
+        return _json_double(value)
+    return type_checkers.ToShortestFloat(value)
+
+def _json_value_converter(field):
+    # Converter of a single (non-repeated) value of field
+    if field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+        full_name = field.message_type.full_name
+        if full_name in _JSON_STRING_TYPES:
+            return lambda m: m.ToJsonString()
+        if full_name.startswith('google.protobuf.'):
+            return MessageToDict
+        return message_to_json_object
+    if field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        names = {v.number: v.name for v in field.enum_type.values}
+        return lambda v: names.get(v, v)
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return lambda v: base64.b64encode(v).decode('utf-8')
+    if field.cpp_type in (FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT64):
+        return str
+    if field.cpp_type == FieldDescriptor.CPPTYPE_DOUBLE:
+        return _json_double
+    if field.cpp_type == FieldDescriptor.CPPTYPE_FLOAT:
+        return _json_float
+    return None # strings, bools and 32-bit integers are used as they are
+
+def _json_converter(field):
+    conv = _json_converters.get(field)
+    if conv is not None:
+        return conv
+
+    if field.message_type is not None and field.message_type.GetOptions().map_entry:
+        key_field = field.message_type.fields_by_name['key']
+        value_conv = _json_value_converter(field.message_type.fields_by_name['value']) or (lambda v: v)
+        if key_field.cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+            conv = lambda m: {('true' if k else 'false'): value_conv(m[k]) for k in m}
+        else:
+            conv = lambda m: {str(k): value_conv(m[k]) for k in m}
+    else:
+        single = _json_value_converter(field)
+        # is_repeated replaces the deprecated label in newer protobuf releases
+        repeated = field.is_repeated if hasattr(field, 'is_repeated') else field.label == FieldDescriptor.LABEL_REPEATED
+        if repeated:
+            conv = list if single is None else (lambda vs: [single(v) for v in vs])
+        else:
+            conv = (lambda v: v) if single is None else single
+
+    _json_converters[field] = conv
+    return conv
+
+def message_to_json_object(message):
+    """Output: the JSON object of a message (same as MessageToDict), fields in field number order"""
+    return {field.json_name: _json_converter(field)(value) for field, value in message.ListFields()}
+
+def PhenopacketToJson(pheno, indent = 2):
+    """Input: a Phenopacket (or any message without extensions)
+        Output: JSON identical to MessageToJson(pheno, indent=indent). For compact output (indent None) orjson is used 
+            when it is installed, which only differs in whitespace and by writing non-ASCII characters unescaped.
+    """
+    js = message_to_json_object(pheno)
+    if indent is None and orjson is not None:
+        return orjson.dumps(js).decode('utf-8')
+    return json.dumps(js, indent=indent)
+
+# Doubles whose JSON text is easy to get wrong: shortest repr, exponents, signed zero, subnormals, non-finite values
+JSON_GOLDEN_DOUBLES = [0.1, 1/3, -0.0, 1e21, 1e-7, 123456789.125, 2.0**53 + 2, 5e-324, 1.7976931348623157e308, 
+                       float('inf'), float('-inf'), float('nan')]
+
+def golden_phenopacket():
+    """Output: a hand-built Phenopacket covering the JSON edge cases of PhenopacketToJson: non-ASCII and escaped labels, 
+        int64 and uint64 fields, timestamps before 1970 and with milli-, micro- and nanoseconds, JSON_GOLDEN_DOUBLES, 
+        enums, bools, repeated and nested messages (its MessageToJson output is a golden file of tests/test_json.py)
+    """
+    pheno = Phenopacket(id='golden-\u00e9\u00e8 "quoted" \\ back\tslash')
+    pheno.subject.id = '1'
+    pheno.subject.date_of_birth.CopyFrom(Timestamp(seconds=-1234567890, nanos=1))
+    pheno.subject.time_at_last_encounter.timestamp.CopyFrom(Timestamp(seconds=-1, nanos=999999999))
+    pheno.subject.sex = Sex.Value('FEMALE')
+    pheno.subject.vital_status.status = VitalStatus.Status.Value('DECEASED')
+    pheno.subject.vital_status.time_of_death.timestamp.CopyFrom(Timestamp(seconds=1700000000, nanos=123000))
+    pheno.subject.taxonomy.CopyFrom(OntologyClass(id='NCBITaxon:9606', label='human'))
+    labels = ['Sj\u00f6gren syndrome', '\u7cd6\u5c3f\u75c5', 'DNA \U0001f9ec', 'line\u2028separator', 'nul\x00 and \x7f', '']
+    for n, label in enumerate(labels):
+        pheno.diseases.add(term=OntologyClass(id=f'X:{n}', label=label), excluded=bool(n % 2), 
+                           onset=TimeElement(timestamp=Timestamp(seconds=-2208988800 + n, nanos=1000000 * n)))
+    feature = pheno.phenotypic_features.add(type=OntologyClass(id='HP:0000001', label='\u00c4\u00df\u00e7'), excluded=True, 
+                                            description='\u043e\u043f\u0438\u0441\u0430\u043d\u0438\u0435')
+    feature.modifiers.add(id='HP:0000002', label='mild')
+    feature.modifiers.add(id='HP:0000003', label='\u00b5g')
+    for n, value in enumerate(JSON_GOLDEN_DOUBLES):
+        quantity = Quantity(unit=OntologyClass(id='UCUM:mg', label='\u00b5g'), value=value)
+        quantity.reference_range.CopyFrom(ReferenceRange(unit=OntologyClass(id='UCUM:mg', label='mg'), low=-value, high=value))
+        pheno.measurements.add(assay=OntologyClass(id=f'LOINC:{n}', label='assay'), value=Value(quantity=quantity), 
+                               time_observed=TimeElement(timestamp=Timestamp(seconds=-86400 * n, nanos=n)))
+    treatment = pheno.medical_actions.add().treatment
+    treatment.agent.CopyFrom(OntologyClass(id='RxNorm:6809', label='metformin'))
+    treatment.drug_type = DrugType.Value('PRESCRIPTION')
+    treatment.dose_intervals.add(quantity=Quantity(unit=OntologyClass(id='UCUM:mg', label='mg'), value=0.5), 
+                                 interval=TimeInterval(start=Timestamp(seconds=-100), end=Timestamp(seconds=100, nanos=10)))
+    record = pheno.interpretations.add(id='i').diagnosis.genomic_interpretations.add().variant_interpretation.variation_descriptor
+    record.vcf_record.pos = 2**64 - 1
+    record.vcf_record.chrom = 'chr\u00e9'
+    record.variation.allele.sequence_location.sequence_interval.start_number.value = 2**63 + 1
+    record.variation.allele.sequence_location.simple_interval.end = 2**53 + 1
+    pheno.meta_data.created.CopyFrom(Timestamp(seconds=253402300799, nanos=999999999))
+    pheno.meta_data.created_by = 'omop2pheno'
+    pheno.meta_data.phenopacket_schema_version = '2.0'
+    return pheno
+
+def benchmark_json(packets):
+    """Input: a list of Phenopackets
+        Output: throughput of MessageToJson and PhenopacketToJson on them (their output is compared by tests/test_json.py)
+    """
+    results = {'packets': len(packets)}
+    for name, encode in (('MessageToJson', MessageToJson), ('PhenopacketToJson', PhenopacketToJson)):
+        t1 = time.perf_counter()
+        for pheno in packets:
+            encode(pheno)
+        seconds = time.perf_counter() - t1
+        results[name] = {'seconds': seconds, 'packets_per_second': len(packets) / seconds if seconds else None}
+        logging.info(f"JSON - {name} - {results[name]['packets_per_second']:.0f} packets/s")
+    results['speedup'] = results['MessageToJson']['seconds'] / results['PhenopacketToJson']['seconds'] if results['PhenopacketToJson']['seconds'] else None
+    return results
+
+# PHENOPACKET STORE
+# A store directory holds one data file per chunk (chunk<n>.pb, the serialized Phenopackets back to back) and 
+# index files with the layout: header (magic, version, count) | person_id int64[count] | offset uint64[count] | 
+# length uint32[count] | chunk uint32[count], sorted by person_id. Each chunk writes its own chunk<n>.idx, 
+# build_store_index merges them into index.idx for the reader.
+STORE_MAGIC = b'PPIX'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('<4sIQ')
+
+def store_data_file(store_dir, chunk_id):
+    return os.path.join(store_dir, f"chunk{chunk_id:05d}.pb")
+
+def write_store_index(path, ids, offsets, lengths, chunks):
+    order = np.argsort(np.asarray(ids, dtype=np.int64), kind='stable')
+    tmp = temp_path(path)
+    with open(tmp, 'wb') as f:
+        f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(order)))
+        f.write(np.asarray(ids, dtype='<i8')[order].tobytes())
+        f.write(np.asarray(offsets, dtype='<u8')[order].tobytes())
+        f.write(np.asarray(lengths, dtype='<u4')[order].tobytes())
+        f.write(np.asarray(chunks, dtype='<u4')[order].tobytes())
+    os.replace(tmp, path)
+
+def read_store_index(path):
+    """Output: the (person_id, offset, length, chunk) numpy arrays of an index file"""
+    with open(path, 'rb') as f:
+        buf = f.read()
+    magic, version, n = STORE_HEADER.unpack_from(buf)
+    if(magic != STORE_MAGIC or version != STORE_VERSION):
+        raise ValueError(f"{path} is not a Phenopacket store index")
+    pos = STORE_HEADER.size
+    arrays = []
+    for dtype, size in (('<i8', 8), ('<u8', 8), ('<u4', 4), ('<u4', 4)):
+        arrays.append(np.frombuffer(buf, dtype=dtype, count=n, offset=pos))
+        pos += size * n
+    return arrays
+
+def write_store_chunk(packets, chunk_id, store_dir):
+    """Writes the data file of one chunk and its sorted index 
+        Output: list of files written
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    data_file = store_data_file(store_dir, chunk_id)
+    ids, offsets, lengths = [], [], []
+    offset = 0
+    with open(data_file, 'wb') as f:
+        for pid, pheno in packet_items(packets):
+            data = pheno.SerializeToString()
+            f.write(data)
+            ids.append(int(pid))
+            offsets.append(offset)
+            lengths.append(len(data))
+            offset += len(data)
+    index_file = os.path.join(store_dir, f"chunk{chunk_id:05d}.idx")
+    write_store_index(index_file, ids, offsets, lengths, [chunk_id] * len(ids))
+    return [data_file, index_file]
+
+def build_store_index(store_dir):
+    """Merges every chunk<n>.idx of a store directory into index.idx 
+        Output: number of Phenopackets indexed
+    """
+    parts = [read_store_index(os.path.join(store_dir, f)) for f in sorted(os.listdir(store_dir))
+             if f.startswith('chunk') and f.endswith('.idx')]
+    if parts:
+        ids, offsets, lengths, chunks = (np.concatenate(a) for a in zip(*parts))
+    else:
+        ids, offsets, lengths, chunks = [], [], [], []
+    write_store_index(os.path.join(store_dir, 'index.idx'), ids, offsets, lengths, chunks)
+    logging.info(f"Store - {len(ids)} phenopackets indexed in {store_dir}")
+    return len(ids)
+
+class PhenopacketStore:
+    """Random access reader for a store directory written with output_format 'store'. 
+        The index and the data files are memory-mapped, a lookup is a binary search over the sorted person_ids 
+        and returns a slice of the mapped data file without copying it.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.idx'), 'rb') as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n = STORE_HEADER.unpack_from(self._index)
+        if(magic != STORE_MAGIC or version != STORE_VERSION):
+            raise ValueError(f"{store_dir} is not a Phenopacket store")
+        self._n = n
+        view = memoryview(self._index)
+        pos = STORE_HEADER.size
+        self._ids = view[pos:pos + 8 * n].cast('q')
+        self._offsets = view[pos + 8 * n:pos + 16 * n].cast('Q')
+        self._lengths = view[pos + 16 * n:pos + 20 * n].cast('I')
+        self._chunks = view[pos + 20 * n:pos + 24 * n].cast('I')
+        self._views = [view, self._ids, self._offsets, self._lengths, self._chunks]
+        self._data = {} # chunk_id -> (mmap, memoryview), opened on first use
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, pid):
+        return self._find(pid) is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _find(self, pid):
+        pid = int(pid)
+        lo, hi = 0, self._n
+        ids = self._ids
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ids[mid] < pid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n and ids[lo] == pid:
+            return lo
+        return None
+
+    def _chunk_view(self, chunk_id):
+        if chunk_id not in self._data:
+            with open(store_data_file(self.store_dir, chunk_id), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data[chunk_id] = (mm, memoryview(mm))
+        return self._data[chunk_id][1]
+
+    def ids(self):
+        return self._ids.tolist()
+
+    def get_bytes(self, pid):
+        """Output: memoryview of the serialized Phenopacket of pid (valid until close), or None"""
+        i = self._find(pid)
+        if i is None:
+            return None
+        offset = self._offsets[i]
+        return self._chunk_view(self._chunks[i])[offset:offset + self._lengths[i]]
+
+    def get(self, pid):
+        """Output: the Phenopacket of pid, or None"""
+        data = self.get_bytes(pid)
+        if data is None:
+            return None
+        pheno = Phenopacket()
+        pheno.ParseFromString(data)
+        return pheno
+
+    def get_json(self, pid):
+        pheno = self.get(pid)
+        return None if pheno is None else PhenopacketToJson(pheno)
+
+    def close(self):
+        for mm, view in self._data.values():
+            view.release()
+            mm.close()
+        self._data = {}
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._index.close()
+
+def benchmark_store(store_dir, samples = 10000, seed = 0):
+    """Times random lookups in a store: raw bytes (get_bytes), parsed message (get) and JSON (get_json) 
+        Output: dict of lookup kind -> latency statistics in microseconds
+    """
+    results = {}
+    with PhenopacketStore(store_dir) as store:
+        ids = store.ids()
+        if not ids:
+            raise ValueError(f"{store_dir} has no phenopackets")
+        rng = random.Random(seed)
+        sample = [rng.choice(ids) for _ in range(samples)]
+
+        for kind, lookup in (('bytes', store.get_bytes), ('message', store.get), ('json', store.get_json)):
+            latencies = []
+            for pid in sample:
+                t1 = time.perf_counter()
+                lookup(pid)
+                latencies.append((time.perf_counter() - t1) * 1e6)
+            latencies.sort()
+            results[kind] = {
+                'lookups': samples,
+                'mean_us': sum(latencies) / samples,
+                'p50_us': latencies[samples // 2],
+                'p95_us': latencies[int(samples * 0.95)],
+                'p99_us': latencies[int(samples * 0.99)],
+                'max_us': latencies[-1]
+            }
+            logging.info(f"Store - {kind} lookup - p50 {results[kind]['p50_us']:.1f} us, p99 {results[kind]['p99_us']:.1f} us")
+        results['persons'] = len(ids)
+    return results
+
+def packet_items(packets):
+    # (person_id, Phenopacket) pairs of a dict or of an iterable such as iter_packets
+    return packets.items() if isinstance(packets, dict) else packets
+
+def count_packets(packets, written_ids):
+    for pid, pheno in packets:
+        written_ids.append(pid)
+        yield pid, pheno
+
+def write_packets(packets, chunk_id, opts):
+    """Writes one chunk of Phenopackets (a dict or an iterable of (person_id, Phenopacket)) to opts['output_path']
+        - output_format 'json': one pretty-printed file per person (as in the notebook)
+        - output_format 'ndjson': one file per chunk with one compact Phenopacket per line
+        - output_format 'store': serialized Phenopackets in output_path/store, see write_store_chunk
+        (output_format 'parquet' writes no Phenopackets, see write_columnar)
+        Output: list of files written
+    """
+    opener, suffix = COMPRESSION_OPENERS[opts['compression']]
+    output_path = opts['output_path']
+    datestamp = time.strftime("%Y%m%d")
+    written = []
+
+    if(opts['output_format'] == 'json'):
+        for pid, pheno in packet_items(packets):
+            outputfile = os.path.join(output_path, "phenopacket_" + datestamp + '_' + str(pid) + '.json' + suffix)
+            with opener(outputfile, 'wt') as of:
+                of.write(PhenopacketToJson(pheno))
+            written.append(outputfile)
+    elif(opts['output_format'] == 'ndjson'):
+        outputfile = os.path.join(output_path, f"phenopackets_{datestamp}_chunk{chunk_id:05d}.ndjson" + suffix)
+        with opener(outputfile, 'wt') as of:
+            for pid, pheno in packet_items(packets):
+                of.write(PhenopacketToJson(pheno, indent=None))
+                of.write('\n')
+        written.append(outputfile)
+    elif(opts['output_format'] == 'store'):
+        # The store is memory-mapped by its reader, so it is never compressed
+        written = write_store_chunk(packets, chunk_id, os.path.join(output_path, 'store'))
+    else:
+        raise ValueError(f"Unknown output format: {opts['output_format']}")
+
+    return written
+
+# VERIFICATION
+# With opts['verify'], the files of each chunk (a shard) are read back by a pool of verify_workers processes while the 
+# next chunks are converted. Each checked Phenopacket is parsed with json_format.Parse (store shards: FromString and a 
+# JSON round-trip), its required fields are checked and its entries are counted against the counts recorded when it 
+# was written. 'full' checks every Phenopacket, 'sample' a random verify_sample fraction of each shard. 
+# A report per shard is written to <output>/verification/chunk<n>.json.
+VERIFY_MODES = ('full', 'sample')
+# Entries counted per Phenopacket, see packet_counts
+PACKET_COUNTS = ('phenotypic_features', 'diseases', 'measurements', 'treatments', 'procedures', 'dose_intervals')
+# Messages kept per shard report
+VERIFY_MAX_ERRORS = 10
+
+def packet_counts(pheno):
+    actions = pheno.medical_actions
+    return [len(pheno.phenotypic_features), len(pheno.diseases), len(pheno.measurements),
+            sum(a.HasField('treatment') for a in actions), sum(a.HasField('procedure') for a in actions),
+            sum(len(a.treatment.dose_intervals) for a in actions)]
+
+def missing_fields(pheno):
+    """Output: list of the required fields (phenopacket-schema v2) a Phenopacket leaves unset, once per entry"""
+    missing = []
+    if not pheno.id: missing.append('id')
+    if not pheno.subject.id: missing.append('subject.id')
+    if not pheno.meta_data.HasField('created'): missing.append('meta_data.created')
+    if not pheno.meta_data.created_by: missing.append('meta_data.created_by')
+    if not pheno.meta_data.phenopacket_schema_version: missing.append('meta_data.phenopacket_schema_version')
+    missing += ['phenotypic_features.type' for f in pheno.phenotypic_features if not f.type.id]
+    missing += ['diseases.term' for d in pheno.diseases if not d.term.id]
+    for m in pheno.measurements:
+        if not m.assay.id: missing.append('measurements.assay')
+        if m.WhichOneof('measurement_value') is None: missing.append('measurements.measurement_value')
+    for a in pheno.medical_actions:
+        action = a.WhichOneof('action')
+        if action is None: missing.append('medical_actions.action')
+        elif action == 'treatment' and not a.treatment.agent.id: missing.append('medical_actions.treatment.agent')
+        elif action == 'procedure' and not a.procedure.code.id: missing.append('medical_actions.procedure.code')
+    return missing
+
+def expect_packets(packets, expected, fraction = 1.0, seed = 0):
+    # Records [position, person_id, packet_counts] of the Phenopackets verify_shard checks: all, or a random fraction
+    rng = random.Random(seed)
+    for position, (pid, pheno) in enumerate(packets):
+        if fraction >= 1 or rng.random() < fraction:
+            expected.append([position, pid, packet_counts(pheno)])
+        yield pid, pheno
+
+def _opener_for(path):
+    for opener, suffix in COMPRESSION_OPENERS.values():
+        if suffix and path.endswith(suffix):
+            return opener
+    return open
+
+def iter_shard(files, output_format, positions):
+    """Input: the files write_packets wrote for a chunk, its output format and the positions (write order) to read 
+        Output: yields (position, JSON text or serialized bytes) of those Phenopackets in file order
+    """
+    if(output_format == 'json'):
+        for position in sorted(positions):
+            with _opener_for(files[position])(files[position], 'rt') as f:
+                yield position, f.read()
+    elif(output_format == 'ndjson'):
+        with _opener_for(files[0])(files[0], 'rt') as f:
+            for position, line in enumerate(f):
+                if position in positions:
+                    yield position, line
+    elif(output_format == 'store'):
+        data_file, index_file = files
+        ids, offsets, lengths, chunks = read_store_index(index_file)
+        order = np.argsort(offsets, kind='stable')
+        with open(data_file, 'rb') as f:
+            data = f.read()
+        for position in sorted(positions):
+            i = order[position]
+            yield position, data[int(offsets[i]):int(offsets[i]) + int(lengths[i])]
+    else:
+        raise ValueError(f"No Phenopackets to verify in output format {output_format}")
+
+def parse_packet(payload):
+    if isinstance(payload, bytes):
+        pheno = Phenopacket.FromString(payload)
+        if Parse(PhenopacketToJson(pheno), Phenopacket()) != pheno:
+            raise ValueError("JSON round-trip changed the Phenopacket")
+        return pheno
+    return Parse(payload, Phenopacket())
+
+def verify_shard(chunk_id, files, output_format, expected, report_dir):
+    """Checks the expected Phenopackets (see expect_packets) of one chunk's files and writes the shard report 
+        Output: report dict; 'ok' is True when every expected Phenopacket was read, parsed, complete and counted alike
+    """
+    t1 = time.time()
+    report = {'chunk_id': chunk_id, 'expected': len(expected), 'checked': 0, 'parse_errors': 0, 'unread': 0,
+              'id_mismatches': 0, 'missing_fields': {}, 'count_mismatches': {}, 'errors': []}
+
+    def error(message):
+        if len(report['errors']) < VERIFY_MAX_ERRORS:
+            report['errors'].append(message)
+
+    wanted = {e[0]: e for e in expected}
+    read = 0
+    try:
+        for position, payload in iter_shard(files, output_format, wanted):
+            read += 1
+            position, pid, counts = wanted[position]
+            try:
+                pheno = parse_packet(payload)
+            except Exception as e:
+                report['parse_errors'] += 1
+                error(f"person_id {pid}: {e}")
+                continue
+            report['checked'] += 1
+            for field in missing_fields(pheno):
+                report['missing_fields'][field] = report['missing_fields'].get(field, 0) + 1
+            if pheno.id != str(pid):
+                report['id_mismatches'] += 1
+                error(f"person_id {pid}: Phenopacket id is '{pheno.id}'")
+            for name, written, found in zip(PACKET_COUNTS, counts, packet_counts(pheno)):
+                if written != found:
+                    report['count_mismatches'][name] = report['count_mismatches'].get(name, 0) + 1
+                    error(f"person_id {pid}: {found} {name}, {written} written")
+    except Exception as e:
+        error(f"reading {', '.join(files)}: {e}")
+    report['unread'] = len(wanted) - read
+    report['ok'] = (report['checked'] == len(wanted) and not report['id_mismatches'] and not report['missing_fields'] 
+                    and not report['count_mismatches'])
+    report['seconds'] = time.time() - t1
+
+    write_json_atomic(os.path.join(report_dir, f"chunk{chunk_id:05d}.json"), report)
+    if not report['ok']:
+        logging.warning(f"Verification - chunk {chunk_id} failed: {report['errors'][:1]}")
+    return report
+
+class ShardVerifier:
+    """Verifies each converted chunk (see verify_shard) in a process pool, overlapping with the conversion of later chunks"""
+    def __init__(self, opts):
+        self.opts = opts
+        self.report_dir = os.path.join(opts['output_path'], 'verification')
+        os.makedirs(self.report_dir, exist_ok=True)
+        self.pool = ProcessPoolExecutor(max_workers=opts['verify_workers'])
+        self.futures = []
+
+    def submit(self, metrics):
+        # Takes the files and expected counts run_chunk left in metrics['verify']
+        verify = metrics.pop('verify', None)
+        if verify is not None:
+            self.futures.append(self.pool.submit(verify_shard, metrics['chunk_id'], verify['files'], self.opts['output_format'],
+                                                 verify['expected'], self.report_dir))
+
+    def finish(self):
+        """Waits for every shard 
+            Output: summary of the shard reports
+        """
+        reports = sorted((f.result() for f in self.futures), key=operator.itemgetter('chunk_id'))
+        self.close()
+        summary = {
+            'mode': self.opts['verify'],
+            'shards': len(reports),
+            'checked': sum(r['checked'] for r in reports),
+            'parse_errors': sum(r['parse_errors'] for r in reports),
+            'unread': sum(r['unread'] for r in reports),
+            'id_mismatches': sum(r['id_mismatches'] for r in reports),
+            'missing_fields': sum(sum(r['missing_fields'].values()) for r in reports),
+            'count_mismatches': sum(sum(r['count_mismatches'].values()) for r in reports),
+            'failed_shards': [r['chunk_id'] for r in reports if not r['ok']]
+        }
+        logging.info(f"Verification - {summary['checked']} phenopackets checked in {summary['shards']} shards, {len(summary['failed_shards'])} shards failed")
+        return summary
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+def checkpoint_file(opts, chunk_id):
+    return os.path.join(opts['checkpoint_dir'], f"chunk{chunk_id:05d}.done")
+
+def checkpoint_key(pids, membership = None):
+    # person_id list, or the pid SQL expression for chunks selected on the server with the membership fingerprint of a 
+    # cohort table chunk (see read_cohort_chunks), so a chunk holding other persons is not skipped
+    if isinstance(pids, str):
+        return pids if membership is None else {'pid': pids, 'membership': membership}
+    return [int(p) for p in pids]
+
+def is_chunk_done(opts, chunk_id, pids, membership = None):
+    # A chunk is only skipped if its checkpoint was written for exactly the same person_ids
+    if(opts['checkpoint_dir'] is None):
+        return False
+    path = checkpoint_file(opts, chunk_id)
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path) as f:
+            done = json.load(f)
+    except ValueError:
+        logging.warning(f"Checkpoint {path} is unreadable, chunk {chunk_id} is converted again")
+        return False
+    return done.get('pids') == checkpoint_key(pids, membership)
+
+def read_vocabulary_version(cur, opts):
+    rows = list(iter_records(cur, get_vocabulary_version_query(opts['ohdsi_db']), 1))
+    return rows[0][0] if rows else None
+
+def create_cohort_table(conn, opts):
+    """Creates the server-side cohort table from opts['cohort_def_file'] 
+        Output: list of (chunk_id, number of persons, membership), see read_cohort_chunks
+    """
+    concepts = get_cohort_def(opts['cohort_def_file'])
+    cur = conn.cursor()
+    cur.execute(get_cohort_table_query(concepts, opts['db'], opts['ohdsi_db'], opts['cohort_table'], opts['chunk_size'], opts['include_descendants']))
+    conn.commit()
+    return read_cohort_chunks(cur, opts['cohort_table'])
+
+def read_cohort_chunks(cur, table):
+    """Output: list of (chunk_id, number of persons, membership) of the cohort table, where membership is a fingerprint 
+        of the chunk's persons ('<n> persons <first>-<last> checksum <c>') that changes when another set of persons 
+        falls in the chunk, e.g. after a change of chunk size, balancing or cohort definition
+    """
+    cur.execute(get_cohort_chunks_query(table))
+    return [(int(r[0]), int(r[1]), f"{int(r[1])} persons {r[2]}-{r[3]} checksum {r[4]}") for r in cur.fetchall()]
+
+def run_chunk(chunk_id, pids, conn_args, opts, phefeatures, meta_data, membership = None):
+    """Converts and writes one chunk on its own connection. Module-level so it can run in a worker process. 
+        membership: fingerprint of the persons of a cohort table chunk, see read_cohort_chunks
+        Output: metrics dict for the chunk
+    """
+    t1 = time.time()
+    # The packets are assembled by a merge of the domain streams while they are written; the columnar export takes each 
+    # person's transformed records from the same merge
+    pool = get_pool(conn_args, opts)
+    db_stats = dict(pool.stats)
+    profiler = StageProfiler() if opts['profile_dir'] is not None else None
+    cur = PooledCursor(pool)
+    try:
+        lists, timings = extract_chunk(cur, pids, opts, phefeatures, stream = True, profiler = profiler, membership = membership)
+    finally:
+        cur.close()
+    db_stats = {k: pool.stats[k] - db_stats[k] for k in db_stats}
+
+    columnar = None
+    if(opts['export_parquet'] and opts['output_format'] != 'parquet'):
+        columnar = ColumnarWriter(chunk_id, opts, profiler)
+
+    packets, written = [], [] # person_ids and files written
+    expected = [] # Phenopackets to verify, see expect_packets
+    columnar_rows = {}
+    try:
+        if(opts['output_format'] == 'parquet'):
+            t2 = time.time()
+            columnar_rows = write_columnar(lists, chunk_id, opts, profiler)
+            timings['columnar'] = time.time() - t2
+        else:
+            t2 = time.time()
+            items = iter_packets(lists, meta_data, columnar)
+            if(opts['verify'] is not None):
+                items = expect_packets(items, expected, 1.0 if opts['verify'] == 'full' else opts['verify_sample'], chunk_id)
+            # Whatever write_packets does between two packets is serialization and writing
+            with profile_stage(profiler, 'serialize'):
+                written = write_packets(count_packets(profile_iter(profiler, 'create', items), packets), chunk_id, opts)
+            if columnar is not None:
+                columnar_rows = columnar.close()
+                timings['columnar'] = columnar.seconds
+            timings['create_write'] = time.time() - t2
+    finally:
+        if profiler is not None:
+            profiler.close()
+
+    metrics = {
+        'chunk_id': chunk_id,
+        'persons_requested': None if isinstance(pids, str) else len(pids),
+        'packets_written': len(packets),
+        'files_written': len(written),
+        'columnar_rows': columnar_rows,
+        'seconds': time.time() - t1,
+        'stages': timings,
+        'db': db_stats
+    }
+    if profiler is not None:
+        metrics['profiles'] = profiler.dump(opts['profile_dir'], f"chunk{chunk_id:05d}")
+
+    if(opts['checkpoint_dir'] is not None):
+        # Written atomically: a checkpoint cut short by a crash would otherwise fail every later resume
+        write_json_atomic(checkpoint_file(opts, chunk_id), dict(metrics, pids=checkpoint_key(pids, membership)))
+
+    # Taken by ShardVerifier.submit, so the checkpoint and the run metrics do not hold it
+    if(opts['verify'] is not None and opts['output_format'] != 'parquet'):
+        metrics['verify'] = {'files': written, 'expected': expected}
+
+    logging.info(f"Chunk {chunk_id} - {len(packets)} phenopackets written in {metrics['seconds']:.1f} s")
+    return metrics
+
+def prepare_run(conn_args, opts):
+    """Creates the output directories and loads what every chunk of a run shares 
+        (sets opts['vocabulary_version'] when it was not given)
+        Output: 
+            - phefeatures: the semantic type mapping (see get_sem_mapping)
+            - meta_data: the metadata dict (see createMetadata)
+    """
+    os.makedirs(opts['output_path'], exist_ok=True)
+    if(opts['checkpoint_dir'] is not None):
+        os.makedirs(opts['checkpoint_dir'], exist_ok=True)
+    if(opts['cache_dir'] is not None):
+        os.makedirs(opts['cache_dir'], exist_ok=True)
+    if(opts['profile_dir'] is not None):
+        os.makedirs(opts['profile_dir'], exist_ok=True)
+
+    phefeatures = get_sem_mapping(opts['sem_mapping_file']) if opts['sem_mapping_file'] else []
+    meta_data = createMetadata(opts['name'])
+    # Raises on unknown domains, fields or mapped codes before any chunk runs
+    domains, fields = get_profile(opts['field_mapping_file'], opts['domains'], opts['omit_fields'])
+    get_code_mappings(opts)
+    for domain in FILTER_COLUMNS:
+        get_event_filters(domain, opts)
+
+    # The drug strength index is built (or loaded) once here, workers then load the persisted file
+    cur = LazyCursor(conn_args)
+    try:
+        if(opts['vocabulary_version'] is None):
+            opts['vocabulary_version'] = read_vocabulary_version(cur, opts)
+        if('treatments' in domains and 'dose_intervals.quantity' in fields['treatments']):
+            get_drug_strength_index(cur, opts)
+    finally:
+        cur.close()
+
+    return phefeatures, meta_data
+
+def plan_pid_chunks(pids, conn_args, opts):
+    # Person_id chunks of a run, balanced by row volume when opts['balance_chunks'] is set
+    if not opts['balance_chunks']:
+        return chunk_pids(pids, opts['chunk_size'])
+    conn = connect_db(conn_args)
+    try:
+        person_rows = estimate_person_rows(conn.cursor(), pids, opts)
+    finally:
+        conn.close()
+    return plan_chunks(person_rows, opts['chunk_size'], opts['chunk_rows'])
+
+def finish_run(opts):
+    # Steps that need every chunk written
+    if(opts['output_format'] == 'store'):
+        build_store_index(os.path.join(opts['output_path'], 'store'))
+    if(opts['profile_dir'] is not None):
+        summarize_profiles(opts['profile_dir'], opts['profile_top'])
+
+def run_conversion(pids, conn_args, opts):
+    """Input: 
+            - pids: list of person_ids to convert, or None to select the cohort on the server from opts['cohort_def_file']
+            - conn_args: connection arguments (see connect_db)
+            - opts: run options, missing keys are taken from DEFAULT_OPTIONS
+        Output: run metrics (also written to opts['metrics_file'] when set)
+    """
+    opts = dict(DEFAULT_OPTIONS, **opts)
+    t1 = time.time()
+
+    phefeatures, meta_data = prepare_run(conn_args, opts)
+
+    # The cohort connection stays open for the whole run, the cohort table lives as long as its session
+    cohort_conn = None
+    if pids is None:
+        cohort_conn = connect_db(conn_args)
+        cohort_chunks = create_cohort_table(cohort_conn, opts)
+        if(opts['balance_chunks']):
+            cohort_chunks = balance_cohort_table(cohort_conn, opts)
+        chunks = [(cohort_pid(opts['cohort_table'], chunk_id), membership) for chunk_id, n, membership in cohort_chunks]
+        n_persons = sum(n for chunk_id, n, membership in cohort_chunks)
+    else:
+        chunks = [(c, None) for c in plan_pid_chunks(pids, conn_args, opts)]
+        n_persons = len(pids)
+
+    verifier = ShardVerifier(opts) if opts['verify'] is not None and opts['output_format'] != 'parquet' else None
+    verification = None
+    try:
+        pending = [(i, c, m) for i, (c, m) in enumerate(chunks) if not is_chunk_done(opts, i, c, m)]
+        logging.info(f"Conversion - {n_persons} persons in {len(chunks)} chunks, {len(chunks) - len(pending)} already checkpointed")
+
+        chunk_metrics = []
+        def chunk_done(m):
+            # Verification of a chunk starts as soon as it is written
+            if verifier is not None:
+                verifier.submit(m)
+            chunk_metrics.append(m)
+
+        if(opts['workers'] <= 1):
+            for chunk_id, c, m in pending:
+                chunk_done(run_chunk(chunk_id, c, conn_args, opts, phefeatures, meta_data, m))
+        else:
+            with ProcessPoolExecutor(max_workers=opts['workers']) as pool:
+                futures = [pool.submit(run_chunk, chunk_id, c, conn_args, opts, phefeatures, meta_data, m) for chunk_id, c, m in pending]
+                for f in as_completed(futures):
+                    chunk_done(f.result())
+        chunk_metrics.sort(key=operator.itemgetter('chunk_id'))
+
+        finish_run(opts)
+        if verifier is not None:
+            verification = verifier.finish()
+    finally:
+        close_pools()
+        if verifier is not None:
+            verifier.close()
+        if cohort_conn is not None:
+            cohort_conn.cursor().execute("drop table " + opts['cohort_table'] + ";")
+            cohort_conn.commit()
+            cohort_conn.close()
+
+    metrics = {
+        'persons': n_persons,
+        'chunks': len(chunks),
+        'chunks_skipped': len(chunks) - len(pending),
+        'packets_written': sum(m['packets_written'] for m in chunk_metrics),
+        'seconds': time.time() - t1,
+        'db': {k: sum(m['db'][k] for m in chunk_metrics) for k in ('connects', 'reconnects', 'checks', 'prepares', 'executions')},
+        'chunk_metrics': chunk_metrics
+    }
+    if verification is not None:
+        metrics['verification'] = verification
+    logging.info(f"Conversion - {metrics['packets_written']} phenopackets written in {metrics['seconds'] / 60:.1f} min")
+    logging.info(f"Conversion - {metrics['db']['executions']} queries on {metrics['db']['connects']} connections, {metrics['db']['prepares']} statements prepared")
+
+    if(opts['metrics_file'] is not None):
+        with open(opts['metrics_file'], 'w') as f:
+            json.dump(metrics, f, indent=2)
+
+    return metrics
+
+if __name__ == '__main__':
+    # The commands live in omop2pheno.cli, `python -m convertPheno` is kept as an alias of `python -m omop2pheno`
+    from omop2pheno.cli import main
+    sys.exit(main())
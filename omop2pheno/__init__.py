@@ -0,0 +1,4 @@
+"""
+omop2pheno runs convertPheno at scale: the work queue of distributed runs (workqueue), the conversion service (service) 
+and the command line (cli, `python -m omop2pheno`)
+"""
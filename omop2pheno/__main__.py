@@ -0,0 +1,5 @@
+import sys
+
+from omop2pheno.cli import main
+
+sys.exit(main())
@@ -0,0 +1,285 @@
+"""
+Command line of the conversion: `python -m omop2pheno <command>` (`python -m convertPheno <command>` is an alias)
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+
+from convertPheno import COMPRESSION_OPENERS, DEFAULT_OPTIONS, DOMAIN_COLUMNS, DRUG_STRENGTH_RULES, VERIFY_MODES, \
+    PhenopacketStore, benchmark_json, benchmark_store, connect_db, invalidate_cache, plan_pid_chunks, read_cohort_pids, \
+    read_pids, run_conversion, summarize_profiles
+from omop2pheno.service import benchmark_service, serve
+from omop2pheno.workqueue import DEFAULT_LEASE_SECONDS, create_queue, queue_status, run_worker
+
+# COMMAND LINE
+def add_connection_args(parser, required=True):
+    conn = parser.add_argument_group('database connection')
+    conn.add_argument('--server', required=required)
+    conn.add_argument('--user')
+    conn.add_argument('--password', help='defaults to the OMOP2PHENO_PASSWORD environment variable')
+    conn.add_argument('--database')
+    conn.add_argument('--db', default='', help="prefix of the patient tables, e.g. 'DATABASENAME.dbo.'")
+    conn.add_argument('--ohdsi-db', default='', help="prefix of the vocabulary tables, e.g. 'OHDSI_DATABASENAME.dbo.'")
+
+def add_run_args(parser, output = True):
+    run = parser.add_argument_group('run options')
+    run.add_argument('--sem-mapping', dest='sem_mapping_file', help='semantic type mapping CSV (see get_sem_mapping)')
+    run.add_argument('--name', default=DEFAULT_OPTIONS['name'], help='metadata created_by')
+    run.add_argument('--chunk-size', type=int, default=DEFAULT_OPTIONS['chunk_size'], help='persons per chunk')
+    run.add_argument('--balance-chunks', action='store_true', help='plan chunks of about equal row volume from per-person row counts')
+    run.add_argument('--chunk-rows', type=int, help='row volume per balanced chunk (default: derived from --chunk-size)')
+    run.add_argument('--sort-buffer', dest='sort_buffer_records', type=int,
+                     help='treatment/measurement rows held in memory while grouping; more are sorted on disk')
+    run.add_argument('--drug-strength-rule', choices=DRUG_STRENGTH_RULES, default=DEFAULT_OPTIONS['drug_strength_rule'],
+                     help='dose of combination products: first ingredient, summed amounts (same unit) or none')
+    filters = parser.add_argument_group('event filters (applied on the server to conditions, observations, measurements, drug exposures and procedures)')
+    filters.add_argument('--event-start', help='first event date kept, YYYY-MM-DD')
+    filters.add_argument('--event-end', help='last event date kept, YYYY-MM-DD')
+    filters.add_argument('--include-concepts', dest='include_concepts_file', help='concept set CSV; events of a domain listed in it must have one of its concepts')
+    filters.add_argument('--exclude-concepts', dest='exclude_concepts_file', help='concept set CSV of concepts whose events are dropped')
+    filters.add_argument('--visit-concepts', type=lambda v: [int(c) for c in v.split(',') if c.strip()],
+                         help='comma separated visit_concept_ids (e.g. 9201,9203); only events of these visit types are kept')
+    run.add_argument('--drug-type-mapping', dest='drug_type_mapping_file',
+                     help='drug type concept mapping CSV (e.g. SupplementalFiles/DrugType_Mapping.csv) instead of the built-in table')
+    run.add_argument('--schedule-frequency-mapping', dest='schedule_frequency_mapping_file',
+                     help='doses per day to NCIT mapping CSV (e.g. SupplementalFiles/scheduleFrequency_mapping.csv) instead of the built-in table')
+    run.add_argument('--coalesce-doses', dest='coalesce_gap_days', type=int, metavar='GAP_DAYS',
+                     help='merge repeated exposures of a drug with the same dose and frequency that are at most GAP_DAYS apart into one dose interval')
+    run.add_argument('--field-mapping', dest='field_mapping_file',
+                     help="field mapping CSV (e.g. SupplementalFiles/field_mapping.csv); fields marked 'Unmapped' are not queried")
+    run.add_argument('--domains', type=lambda v: [d.strip() for d in v.split(',') if d.strip()],
+                     help='comma separated domains to extract: ' + ', '.join(DOMAIN_COLUMNS) + ' (individual is always extracted)')
+    run.add_argument('--omit-field', dest='omit_fields', action='append', default=[],
+                     help="field not to query, as domain.field (e.g. measurements.measurement_value.reference_range); repeatable")
+    run.add_argument('--no-prepare', dest='prepare_statements', action='store_false',
+                     help='splice person_ids into the query text instead of sending them as a parameter (servers before SQL Server 2016)')
+    run.add_argument('--pool-size', type=int, default=DEFAULT_OPTIONS['pool_size'], help='idle connections kept open per process')
+    run.add_argument('--drug-strength-dir', default=DEFAULT_OPTIONS['drug_strength_dir'],
+                     help='where the drug strength index is persisted per vocabulary version')
+    run.add_argument('--workers', type=int, default=DEFAULT_OPTIONS['workers'], help='parallel worker processes')
+    run.add_argument('--fetch-size', type=int, default=DEFAULT_OPTIONS['fetch_size'], help='rows per cursor fetch')
+    if not output:
+        return
+
+    out = parser.add_argument_group('output')
+    out.add_argument('--output', dest='output_path', required=True, help='directory to store Phenopackets')
+    out.add_argument('--format', dest='output_format', default=DEFAULT_OPTIONS['output_format'], choices=['json', 'ndjson', 'store', 'parquet'],
+                     help="store writes a memory-mappable packed store, parquet writes only the columnar tables")
+    out.add_argument('--export-parquet', action='store_true', help='also write the columnar tables next to the Phenopackets')
+    out.add_argument('--compression', default=DEFAULT_OPTIONS['compression'], choices=sorted(COMPRESSION_OPENERS))
+    cache = parser.add_argument_group('extraction cache')
+    cache.add_argument('--cache-dir', help='directory of cached query results; cached chunks are transformed without querying the database')
+    cache.add_argument('--cache-max-gb', type=float, help='evict least recently used cache files above this size')
+    cache.add_argument('--vocabulary-version', help="part of the cache key, read from the vocabulary table when not given")
+
+    out.add_argument('--checkpoint-dir', help='directory of per-chunk checkpoints; completed chunks are skipped on rerun')
+    out.add_argument('--metrics', dest='metrics_file', help='JSON file for run metrics')
+    out.add_argument('--verify', choices=VERIFY_MODES, help='read the written Phenopackets back and check them, all or a sample of each chunk')
+    out.add_argument('--verify-sample', type=float, default=DEFAULT_OPTIONS['verify_sample'], help='fraction checked with --verify sample')
+    out.add_argument('--verify-workers', type=int, default=DEFAULT_OPTIONS['verify_workers'], help='processes verifying written chunks')
+    out.add_argument('--profile-dir', help='profile every chunk and write per-stage .pstats files and profile_summary.txt here')
+    out.add_argument('--profile-top', type=int, default=DEFAULT_OPTIONS['profile_top'], help='functions listed per stage in profile_summary.txt')
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog='omop2pheno', description='Convert OMOP CDM patient data to Phenopackets')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    convert = commands.add_parser('convert', help='convert a cohort to Phenopackets')
+    add_connection_args(convert)
+    cohort = convert.add_argument_group('person selection')
+    selection = cohort.add_mutually_exclusive_group(required=True)
+    selection.add_argument('--pid-file', help='file with one person_id per line')
+    selection.add_argument('--cohort-query', help='SQL query whose first column is person_id')
+    selection.add_argument('--cohort-def', dest='cohort_def_file', help='concept set CSV (e.g. SupplementalFiles/AD_cohort_def.csv), resolved on the server')
+    cohort.add_argument('--include-descendants', action='store_true', help='expand --cohort-def concepts through concept_ancestor')
+    cohort.add_argument('--cohort-table', default=DEFAULT_OPTIONS['cohort_table'], help='server-side person table created for --cohort-def')
+    add_run_args(convert)
+
+    clear = commands.add_parser('cache-clear', help='invalidate extraction cache files')
+    clear.add_argument('cache_dir')
+    clear.add_argument('--domain', help='only this domain (individual, vital_status, conditions, features, measurements, treatments, procedures)')
+    clear.add_argument('--vocabulary-version', help='only files cached for this vocabulary version')
+
+    jbench = commands.add_parser('json-bench', help='compare the throughput of MessageToJson and PhenopacketToJson on the Phenopackets of a store')
+    jbench.add_argument('store_dir', help="the 'store' directory written with --format store")
+    jbench.add_argument('--limit', type=int, default=10000, help='number of Phenopackets to encode')
+
+    coordinate = commands.add_parser('coordinate', help='write the work queue of a run shared by several worker nodes')
+    coordinate.add_argument('queue_dir', help='queue directory on a mount shared by all nodes')
+    add_connection_args(coordinate, required=False)
+    selection = coordinate.add_argument_group('person selection').add_mutually_exclusive_group(required=True)
+    selection.add_argument('--pid-file', help='file with one person_id per line')
+    selection.add_argument('--cohort-query', help='SQL query whose first column is person_id (needs --server)')
+    add_run_args(coordinate)
+
+    worker = commands.add_parser('worker', help='convert chunks from a work queue until it is finished')
+    worker.add_argument('queue_dir')
+    add_connection_args(worker)
+    worker.add_argument('--worker-id', help='default: hostname-pid')
+    worker.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS,
+                        help='a chunk whose worker has not renewed its lease for this long is handed to another worker')
+    worker.add_argument('--poll-seconds', type=int, default=30, help='wait between claims while other workers hold the last chunks')
+
+    status = commands.add_parser('queue-status', help='count finished, leased and pending chunks of a work queue')
+    status.add_argument('queue_dir')
+    status.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS)
+
+    service = commands.add_parser('serve', help='convert single patients on request over HTTP')
+    add_connection_args(service)
+    add_run_args(service, output=False)
+    http = service.add_argument_group('service')
+    http.add_argument('--host', default='127.0.0.1')
+    http.add_argument('--port', type=int, default=8080)
+    http.add_argument('--cache-size', dest='service_cache_size', type=int, default=DEFAULT_OPTIONS['service_cache_size'],
+                      help='Phenopackets kept in the LRU cache')
+    http.add_argument('--batch-ms', dest='service_batch_ms', type=float, default=DEFAULT_OPTIONS['service_batch_ms'],
+                      help='requests arriving within this window are converted as one batch')
+    http.add_argument('--max-batch', dest='service_max_batch', type=int, default=DEFAULT_OPTIONS['service_max_batch'],
+                      help='persons per batch')
+    http.add_argument('--fresh-seconds', dest='service_fresh_seconds', type=float, default=DEFAULT_OPTIONS['service_fresh_seconds'],
+                      help='serve a cached Phenopacket without checking the database if it was checked this recently')
+
+    sbench = commands.add_parser('service-bench', help='measure latency and throughput of a running service')
+    sbench.add_argument('--host', default='127.0.0.1')
+    sbench.add_argument('--port', type=int, default=8080)
+    sbench.add_argument('--pid-file', required=True, help='person_ids to request (one per line)')
+    sbench.add_argument('--requests', type=int, default=1000)
+    sbench.add_argument('--concurrency', type=int, default=16, help='concurrent client connections')
+
+    profile = commands.add_parser('profile-summary', help='merge the chunk profiles of --profile-dir and list the hotspots of each stage')
+    profile.add_argument('profile_dir')
+    profile.add_argument('--top', type=int, default=DEFAULT_OPTIONS['profile_top'])
+
+    bench = commands.add_parser('store-bench', help='measure lookup latency of a Phenopacket store')
+    bench.add_argument('store_dir', help="the 'store' directory written with --format store")
+    bench.add_argument('--samples', type=int, default=10000)
+
+    return parser
+
+def conn_args_from(args):
+    conn_args = {'server': args.server}
+    password = args.password or os.environ.get('OMOP2PHENO_PASSWORD')
+    if(args.user): conn_args['user'] = args.user
+    if(password): conn_args['password'] = password
+    if(args.database): conn_args['database'] = args.database
+    return conn_args
+
+def opts_from(args):
+    opts = {k: getattr(args, k) for k in DEFAULT_OPTIONS if hasattr(args, k)}
+    if(getattr(args, 'cache_max_gb', None) is not None):
+        opts['cache_max_bytes'] = int(args.cache_max_gb * 1e9)
+    return opts
+
+def cmd_convert(args):
+    conn_args = conn_args_from(args)
+    opts = opts_from(args)
+
+    if(args.pid_file):
+        pids = read_pids(args.pid_file)
+    elif(args.cohort_def_file):
+        pids = None
+    else:
+        conn = connect_db(conn_args)
+        try:
+            pids = read_cohort_pids(conn.cursor(), args.cohort_query, args.fetch_size)
+        finally:
+            conn.close()
+
+    if pids is not None and not pids:
+        logging.info("No person_ids selected, nothing to convert")
+        return 0
+
+    metrics = run_conversion(pids, conn_args, opts)
+    return 1 if metrics.get('verification', {}).get('failed_shards') else 0
+
+def cmd_coordinate(args):
+    opts = dict(DEFAULT_OPTIONS, **opts_from(args))
+    # Every node resolves these paths, they must point into the shared mount
+    for k in ('output_path', 'checkpoint_dir', 'cache_dir', 'profile_dir'):
+        if(opts[k] is not None):
+            opts[k] = os.path.abspath(opts[k])
+
+    if((args.cohort_query or opts['balance_chunks']) and not args.server):
+        raise SystemExit("--cohort-query and --balance-chunks need --server")
+    conn_args = conn_args_from(args)
+
+    if(args.pid_file):
+        pids = read_pids(args.pid_file)
+    else:
+        conn = connect_db(conn_args)
+        try:
+            pids = read_cohort_pids(conn.cursor(), args.cohort_query, args.fetch_size)
+        finally:
+            conn.close()
+
+    if not pids:
+        logging.info("No person_ids selected, nothing to convert")
+        return 0
+
+    chunks = plan_pid_chunks(pids, conn_args, opts)
+    create_queue(args.queue_dir, chunks, opts)
+    return 0
+
+def cmd_worker(args):
+    run_worker(args.queue_dir, conn_args_from(args), args.worker_id, args.lease_seconds, args.poll_seconds)
+    return 0
+
+def cmd_queue_status(args):
+    print(json.dumps(queue_status(args.queue_dir, args.lease_seconds), indent=2))
+    return 0
+
+def cmd_cache_clear(args):
+    invalidate_cache(args.cache_dir, args.domain, args.vocabulary_version)
+    return 0
+
+def cmd_json_bench(args):
+    with PhenopacketStore(args.store_dir) as store:
+        packets = [store.get(pid) for pid in store.ids()[:args.limit]]
+    print(json.dumps(benchmark_json(packets), indent=2))
+    return 0
+
+def cmd_profile_summary(args):
+    summarize_profiles(args.profile_dir, args.top)
+    with open(os.path.join(args.profile_dir, 'profile_summary.txt')) as f:
+        print(f.read())
+    return 0
+
+def cmd_store_bench(args):
+    print(json.dumps(benchmark_store(args.store_dir, args.samples), indent=2))
+    return 0
+
+def cmd_serve(args):
+    try:
+        asyncio.run(serve(conn_args_from(args), opts_from(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def cmd_service_bench(args):
+    results = asyncio.run(benchmark_service(args.host, args.port, read_pids(args.pid_file), args.requests, args.concurrency))
+    print(json.dumps(results, indent=2))
+    return 0
+
+COMMANDS = {
+    'convert': cmd_convert,
+    'coordinate': cmd_coordinate,
+    'worker': cmd_worker,
+    'queue-status': cmd_queue_status,
+    'cache-clear': cmd_cache_clear,
+    'json-bench': cmd_json_bench,
+    'store-bench': cmd_store_bench,
+    'profile-summary': cmd_profile_summary,
+    'serve': cmd_serve,
+    'service-bench': cmd_service_bench,
+}
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    return COMMANDS[args.command](args)
+
+if __name__ == '__main__':
+    sys.exit(main())
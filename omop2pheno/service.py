@@ -0,0 +1,340 @@
+"""
+Conversion service: converts single patients on request over HTTP with convertPheno.extract_chunk 
+(`python -m omop2pheno serve` / `service-bench`)
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import operator
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from convertPheno import DEFAULT_OPTIONS, PhenopacketToJson, PooledCursor, batch_pid, close_pools, extract_chunk, \
+    get_freshness_query, get_pool, iter_packets, iter_records, prepare_run
+
+# CONVERSION SERVICE
+# `python -m omop2pheno serve` converts single patients on request over HTTP: 
+#   GET /phenopackets/<person_id>       one Phenopacket (404 when the person does not exist)
+#   GET /phenopackets?pid=1,2,3         a JSON object of person_id -> Phenopacket
+#   GET /stats, GET /health
+# Requests arriving within service_batch_ms of each other are converted as one batch by extract_chunk, on the pooled 
+# connections. Built packets are kept as JSON in an LRU cache; before a cached packet is served, the person's record 
+# fingerprint (get_freshness_query) is compared with the one it was built from, unless it was checked less than 
+# service_fresh_seconds ago. Added or deleted rows, new visits and edits of the person's birth date, gender or death date 
+# change the fingerprint; other rows updated in place do not, '?refresh=1' rebuilds the packet regardless.
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+def read_fingerprints(cur, pids, opts):
+    """Output: dict of person_id -> record fingerprint (see get_freshness_query) for the persons of pids that exist"""
+    qpid, params = batch_pid(pids, opts, getattr(cur, 'paramstyle', 'pyformat'))
+    rows = {}
+    for table, pid, n, version in iter_records(cur, get_freshness_query(qpid, opts['db']), opts['fetch_size'], params):
+        rows.setdefault(int(pid), []).append((table, int(n), version))
+    return {pid: tuple(sorted(r, key=operator.itemgetter(0))) for pid, r in rows.items()}
+
+class PacketCache:
+    """LRU of person_id -> (record fingerprint, Phenopacket JSON, time of the last freshness check) 
+        holding at most max_entries packets. Shared by the event loop and the extraction threads.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, pid):
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry is not None:
+                self.entries.move_to_end(pid)
+            return entry
+
+    def put(self, pid, fingerprint, packet, checked):
+        with self.lock:
+            self.entries[pid] = (fingerprint, packet, checked)
+            self.entries.move_to_end(pid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+class ConversionService:
+    """Converts persons on request: concurrent requests are coalesced into batches of at most service_max_batch persons, 
+        converted on up to pool_size threads, and the packets are cached (see PacketCache). 
+        A person requested again while its batch is pending or running waits for that batch.
+    """
+    def __init__(self, conn_args, opts):
+        self.conn_args = conn_args
+        self.opts = dict(DEFAULT_OPTIONS, **opts)
+        self.phefeatures, self.meta_data = prepare_run(conn_args, self.opts)
+        self.cache = PacketCache(self.opts['service_cache_size'])
+        self.executor = ThreadPoolExecutor(max_workers=self.opts['pool_size'])
+        self.pending = {} # person_id -> future of the batch being collected
+        self.refresh = set()
+        self.running = {} # person_id -> future of a batch being converted
+        self.batch = None
+        self.flush_handle = None
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'persons': 0, 'cache_hits': 0, 'fresh_hits': 0, 'built': 0, 'missing': 0, 
+                      'batches': 0, 'batch_persons': 0, 'errors': 0}
+
+    def count(self, key, n = 1):
+        with self.lock:
+            self.stats[key] += n
+
+    async def get(self, pids, refresh = False):
+        """Output: dict of person_id -> Phenopacket JSON for the persons of pids that exist"""
+        self.count('persons', len(pids))
+        now = time.time()
+        found, waiting = {}, {}
+        for pid in pids:
+            entry = None if refresh else self.cache.get(pid)
+            if entry is not None and now - entry[2] < self.opts['service_fresh_seconds']:
+                self.count('cache_hits')
+                found[pid] = entry[1]
+            else:
+                waiting[pid] = self.request(pid, refresh)
+        for pid, future in waiting.items():
+            packets = await future
+            if pid in packets:
+                found[pid] = packets[pid]
+        return found
+
+    def request(self, pid, refresh = False):
+        # Future of the batch converting pid, adding pid to the batch being collected when it is neither pending nor running
+        future = self.pending.get(pid)
+        if future is None and not refresh:
+            future = self.running.get(pid)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self.pending:
+                self.batch = loop.create_future()
+                self.flush_handle = loop.call_later(self.opts['service_batch_ms'] / 1000, self.flush)
+            future = self.pending[pid] = self.batch
+        if refresh and pid in self.pending:
+            self.refresh.add(pid)
+        if len(self.pending) >= self.opts['service_max_batch']:
+            self.flush_handle.cancel()
+            self.flush()
+        return future
+
+    def flush(self):
+        # Hands the collected batch to an extraction thread, its future resolves to the batch's dict of packets
+        pending, refresh, future = self.pending, self.refresh, self.batch
+        self.pending, self.refresh, self.batch = {}, set(), None
+        if not pending:
+            return
+        pids = list(pending)
+        self.running.update(pending)
+        self.count('batches')
+        self.count('batch_persons', len(pids))
+        task = asyncio.get_running_loop().run_in_executor(self.executor, self.build, pids, refresh)
+
+        def done(task):
+            for pid in pids:
+                if self.running.get(pid) is future:
+                    del self.running[pid]
+            if task.exception() is not None:
+                self.count('errors')
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        task.add_done_callback(done)
+
+    def build(self, pids, refresh = ()):
+        """Runs in an extraction thread: checks the fingerprints of a batch and converts the persons without a fresh packet 
+            Output: dict of person_id -> Phenopacket JSON
+        """
+        cur = PooledCursor(get_pool(self.conn_args, self.opts))
+        try:
+            fingerprints = read_fingerprints(cur, pids, self.opts)
+            now = time.time()
+            packets, stale = {}, []
+            for pid in pids:
+                if pid not in fingerprints:
+                    continue
+                entry = self.cache.get(pid)
+                if pid not in refresh and entry is not None and entry[0] == fingerprints[pid]:
+                    self.cache.put(pid, entry[0], entry[1], now)
+                    packets[pid] = entry[1]
+                else:
+                    stale.append(pid)
+            self.count('missing', sum(pid not in fingerprints for pid in pids))
+            self.count('fresh_hits', len(packets))
+
+            if stale:
+                lists, timings = extract_chunk(cur, sorted(stale), self.opts, self.phefeatures, stream=True)
+                for pid, pheno in iter_packets(lists, self.meta_data):
+                    packets[pid] = PhenopacketToJson(pheno, indent=None)
+                    self.cache.put(pid, fingerprints[pid], packets[pid], now)
+                self.count('built', len(stale))
+        finally:
+            cur.close()
+        return packets
+
+    def statistics(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['cache_entries'] = len(self.cache)
+        stats['cache_evictions'] = self.cache.evictions
+        stats['mean_batch'] = stats['batch_persons'] / stats['batches'] if stats['batches'] else 0
+        stats['db'] = dict(get_pool(self.conn_args, self.opts).stats)
+        return stats
+
+    async def route(self, method, target):
+        # Output: (HTTP status, JSON body)
+        if method != 'GET':
+            return 405, json.dumps({'error': 'only GET is supported'})
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        if url.path == '/health':
+            return 200, json.dumps({'status': 'ok'})
+        if url.path == '/stats':
+            return 200, json.dumps(self.statistics())
+        if parts[0] != 'phenopackets' or len(parts) > 2:
+            return 404, json.dumps({'error': f'unknown path {url.path}'})
+
+        try:
+            if len(parts) == 2:
+                pids = [int(parts[1])]
+            else:
+                pids = list(dict.fromkeys(int(p) for v in query.get('pid', []) for p in v.split(',') if p.strip()))
+        except ValueError:
+            return 400, json.dumps({'error': 'person_ids must be integers'})
+        if not pids:
+            return 400, json.dumps({'error': 'no person_id given'})
+
+        self.count('requests')
+        try:
+            packets = await self.get(pids, query.get('refresh', ['0'])[0] not in ('', '0'))
+        except Exception as e:
+            logging.exception(f"Service - conversion of {len(pids)} persons failed")
+            return 500, json.dumps({'error': str(e)})
+        if len(parts) == 2:
+            if pids[0] not in packets:
+                return 404, json.dumps({'error': f'person_id {pids[0]} not found'})
+            return 200, packets[pids[0]]
+        return 200, '{' + ','.join(f'"{pid}":{packets[pid]}' for pid in pids if pid in packets) + '}'
+
+    async def handle(self, reader, writer):
+        # One HTTP/1.1 connection, kept alive between requests unless the client asks to close it
+        try:
+            while True:
+                try:
+                    request = await read_http_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    await write_http_response(writer, 400, json.dumps({'error': 'malformed request'}), False)
+                    break
+                if request is None:
+                    break
+                method, target, version, headers = request
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                status, body = await self.route(method, target)
+                await write_http_response(writer, status, body, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        close_pools()
+
+async def read_http_request(reader):
+    # Output: (method, target, version, headers), or None when the client closed the connection
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, version = line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length:
+        await reader.readexactly(length)
+    return method, target, version, headers
+
+async def write_http_response(writer, status, body, keep_alive = True):
+    body = body.encode('utf-8')
+    writer.write((f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                  f"Content-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n"
+                  f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1') + body)
+    await writer.drain()
+
+async def serve(conn_args, opts, host = '127.0.0.1', port = 8080, ready = None):
+    """Runs the conversion service until cancelled (see ConversionService); ready, if given, is set once it listens"""
+    service = ConversionService(conn_args, opts)
+    try:
+        server = await asyncio.start_server(service.handle, host, port)
+        logging.info(f"Service - listening on {host}:{port}")
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+async def _bench_client(host, port, targets, latencies, statuses):
+    # Issues targets one after another on one keep-alive connection
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for target in targets:
+            t1 = time.perf_counter()
+            writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode('latin-1'))
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append((time.perf_counter() - t1) * 1e3)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+async def benchmark_service(host, port, pids, requests = 1000, concurrency = 16, seed = 0):
+    """Requests random single Phenopackets from a running service from concurrency connections, twice over the same 
+        sample: 'first' pass (cold, unless the service already cached the persons) and 'repeat' pass (served from its cache) 
+        Output: dict of pass -> latency statistics in milliseconds and throughput
+    """
+    rng = random.Random(seed)
+    targets = [f"/phenopackets/{rng.choice(pids)}" for _ in range(requests)]
+    results = {}
+    for phase in ('first', 'repeat'):
+        latencies, statuses = [], {}
+        t1 = time.perf_counter()
+        await asyncio.gather(*(_bench_client(host, port, targets[i::concurrency], latencies, statuses) for i in range(concurrency)))
+        seconds = time.perf_counter() - t1
+        latencies.sort()
+        results[phase] = {
+            'requests': requests,
+            'requests_per_second': requests / seconds,
+            'mean_ms': sum(latencies) / requests,
+            'p50_ms': latencies[requests // 2],
+            'p95_ms': latencies[int(requests * 0.95)],
+            'p99_ms': latencies[int(requests * 0.99)],
+            'max_ms': latencies[-1],
+            'status': statuses
+        }
+        logging.info(f"Service - {phase} pass - {results[phase]['requests_per_second']:.0f} requests/s, p50 {results[phase]['p50_ms']:.1f} ms, p99 {results[phase]['p99_ms']:.1f} ms")
+    return results
@@ -0,0 +1,189 @@
+"""
+Distributed runs: a work queue of chunks on a shared mount that any number of worker nodes convert with convertPheno.run_chunk 
+(`python -m omop2pheno coordinate` / `worker` / `queue-status`)
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from convertPheno import DEFAULT_OPTIONS, ShardVerifier, checkpoint_key, close_pools, finish_run, is_chunk_done, \
+    prepare_run, run_chunk, write_json_atomic
+
+# DISTRIBUTED RUNS
+# A work queue is a directory on a mount shared by all nodes: 
+#   run.json           the run options written by the coordinator
+#   tasks/<chunk>.json one task per chunk (chunk_id and person_ids)
+#   leases/<chunk>     claimed tasks; a lease expires when its modification time is older than lease_seconds
+#   done/<chunk>.json  the metrics of finished tasks
+#   done/verification-<worker>.json  the verification summary of a worker's chunks (with opts['verify'])
+#   finished           created by the one worker that runs finish_run
+# Claims rely on exclusive file creation and renames being atomic, so workers need no other coordination.
+DEFAULT_LEASE_SECONDS = 600
+
+def create_queue(queue_dir, chunks, opts):
+    """Writes the run options and one task per chunk to queue_dir. Tasks already done in queue_dir are kept.
+        Output: number of tasks
+    """
+    for d in ('tasks', 'leases', 'done'):
+        os.makedirs(os.path.join(queue_dir, d), exist_ok=True)
+    write_json_atomic(os.path.join(queue_dir, 'run.json'), opts)
+    for chunk_id, c in enumerate(chunks):
+        write_json_atomic(os.path.join(queue_dir, 'tasks', f"chunk{chunk_id:05d}.json"), {'chunk_id': chunk_id, 'pids': checkpoint_key(c)})
+    logging.info(f"Queue - {len(chunks)} tasks written to {queue_dir}")
+    return len(chunks)
+
+def _try_lease(lease, worker_id):
+    try:
+        fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(worker_id)
+    return True
+
+def claim_task(queue_dir, worker_id, lease_seconds = DEFAULT_LEASE_SECONDS):
+    """Claims the first task that is neither done nor under a live lease; an expired lease (crashed worker) is taken over
+        Output: (task dict, lease path), or (None, None) when nothing can be claimed now
+    """
+    for name in sorted(os.listdir(os.path.join(queue_dir, 'tasks'))):
+        if not name.endswith('.json'):
+            continue
+        chunk = name[:-len('.json')]
+        if os.path.exists(os.path.join(queue_dir, 'done', name)):
+            continue
+        lease = os.path.join(queue_dir, 'leases', chunk)
+        claimed = _try_lease(lease, worker_id)
+        if not claimed:
+            try:
+                expired = time.time() - os.stat(lease).st_mtime > lease_seconds
+            except FileNotFoundError: # released in the meantime
+                expired = True
+            if not expired:
+                continue
+            # Only one worker can rename the expired lease away, the others then fail to create the new one.
+            # A lease renamed away that turns out to be live (renewed or re-created meanwhile) is put back.
+            stale = lease + f'.expired.{worker_id}'
+            try:
+                os.rename(lease, stale)
+            except FileNotFoundError:
+                pass
+            else:
+                if time.time() - os.stat(stale).st_mtime > lease_seconds:
+                    os.remove(stale)
+                    logging.info(f"Queue - {worker_id} took over the expired lease of {chunk}")
+                else:
+                    os.rename(stale, lease)
+                    continue
+            claimed = _try_lease(lease, worker_id)
+        if claimed:
+            if os.path.exists(os.path.join(queue_dir, 'done', name)): # finished while the lease was being claimed
+                os.remove(lease)
+                continue
+            with open(os.path.join(queue_dir, 'tasks', name)) as f:
+                return json.load(f), lease
+    return None, None
+
+def _keep_lease(lease, interval, stop, worker_id):
+    # Heartbeat: refreshes the lease's modification time until stop is set or another worker has taken the lease over. 
+    # A missing lease is only renamed away for a moment by a worker checking whether it expired (see claim_task).
+    while not stop.wait(interval):
+        try:
+            with open(lease) as f:
+                owner = f.read()
+            if(owner and owner != worker_id):
+                logging.warning(f"Queue - {worker_id} lost the lease {lease} to {owner}")
+                return
+            os.utime(lease)
+        except FileNotFoundError:
+            continue
+
+def complete_task(queue_dir, task, lease, metrics):
+    write_json_atomic(os.path.join(queue_dir, 'done', f"chunk{task['chunk_id']:05d}.json"), metrics)
+    try:
+        os.remove(lease)
+    except FileNotFoundError:
+        pass
+
+def queue_status(queue_dir, lease_seconds = DEFAULT_LEASE_SECONDS):
+    """Output: dict with the number of tasks, done, leased (live leases), expired leases and pending tasks, whether the run 
+        was finished (see run_worker) and the chunks that failed verification
+    """
+    tasks = {n[:-len('.json')] for n in os.listdir(os.path.join(queue_dir, 'tasks')) if n.endswith('.json')}
+    done = {n[:-len('.json')] for n in os.listdir(os.path.join(queue_dir, 'done')) if n.endswith('.json')} & tasks
+    leased = expired = 0
+    now = time.time()
+    for n in os.listdir(os.path.join(queue_dir, 'leases')):
+        if n not in tasks or n in done:
+            continue
+        try:
+            if now - os.stat(os.path.join(queue_dir, 'leases', n)).st_mtime > lease_seconds:
+                expired += 1
+            else:
+                leased += 1
+        except FileNotFoundError:
+            pass
+    failed_shards = []
+    for n in sorted(os.listdir(os.path.join(queue_dir, 'done'))):
+        if n.startswith('verification-') and n.endswith('.json'):
+            with open(os.path.join(queue_dir, 'done', n)) as f:
+                failed_shards += json.load(f)['failed_shards']
+    return {'tasks': len(tasks), 'done': len(done), 'leased': leased, 'expired': expired,
+            'pending': len(tasks) - len(done) - leased, 'finished': os.path.exists(os.path.join(queue_dir, 'finished')),
+            'failed_shards': sorted(failed_shards)}
+
+def run_worker(queue_dir, conn_args, worker_id = None, lease_seconds = DEFAULT_LEASE_SECONDS, poll_seconds = 30):
+    """Claims and converts tasks from queue_dir until every task is done. Any number of workers can run on any node; 
+        the first worker to see the queue finished runs finish_run (it creates queue_dir/finished).
+        Output: list of metrics of the tasks this worker converted
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    with open(os.path.join(queue_dir, 'run.json')) as f:
+        opts = dict(DEFAULT_OPTIONS, **json.load(f))
+    phefeatures, meta_data = prepare_run(conn_args, opts)
+    verifier = ShardVerifier(opts) if opts['verify'] is not None and opts['output_format'] != 'parquet' else None
+
+    converted = []
+    while True:
+        task, lease = claim_task(queue_dir, worker_id, lease_seconds)
+        if task is None:
+            status = queue_status(queue_dir, lease_seconds)
+            if status['done'] == status['tasks']:
+                break
+            logging.info(f"Queue - {worker_id} waiting: {status}")
+            time.sleep(poll_seconds)
+            continue
+
+        pids = task['pids']
+        if(opts['checkpoint_dir'] is not None and is_chunk_done(opts, task['chunk_id'], pids)):
+            complete_task(queue_dir, task, lease, {'chunk_id': task['chunk_id'], 'checkpointed': True})
+            continue
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_keep_lease, args=(lease, lease_seconds / 3, stop, worker_id), daemon=True)
+        heartbeat.start()
+        try:
+            metrics = run_chunk(task['chunk_id'], pids, conn_args, opts, phefeatures, meta_data)
+        finally:
+            stop.set()
+            heartbeat.join()
+        metrics['worker'] = worker_id
+        if verifier is not None:
+            verifier.submit(metrics)
+        complete_task(queue_dir, task, lease, metrics)
+        converted.append(metrics)
+
+    close_pools()
+    if verifier is not None:
+        # Read back by queue_status, so failed shards of any worker show in the queue's status
+        write_json_atomic(os.path.join(queue_dir, 'done', f"verification-{worker_id}.json"), verifier.finish())
+    # One worker finishes the run, even when several see the queue drained at the same time
+    if _try_lease(os.path.join(queue_dir, 'finished'), worker_id):
+        finish_run(opts)
+    else:
+        logging.info(f"Queue - run already finished by another worker (remove {os.path.join(queue_dir, 'finished')} to finish it again)")
+    logging.info(f"Queue - {worker_id} finished, {len(converted)} tasks converted")
+    return converted
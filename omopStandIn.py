@@ -0,0 +1,362 @@
+"""
+omopStandIn is a local stand-in for the OMOP CDM SQL Server database convertPheno reads, to try the conversion service
+(and pid-list conversions) without a server.
+- connect is a DB-API connect on SQLite that accepts the T-SQL of the get_*_query functions (string_split, concat,
+  dateadd, ceiling, checksum, checksum_agg), for connect_db: conn_args = {'connect': omopStandIn.connect, 'database': path}
+- create_database writes the OMOP tables convertPheno reads, filled with synthetic persons and a small vocabulary
+- add_visit adds a visit to a person, which changes the person's record fingerprint (see get_freshness_query)
+Cohort tables and server-side filter tables (multi-statement T-SQL batches) are not supported.
+
+python omopStandIn.py create omop.db --persons 10000
+python omopStandIn.py serve omop.db --port 8080
+python omopStandIn.py bench omop.db --requests 2000 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import sqlite3
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+import convertPheno
+from omop2pheno import service
+
+paramstyle = 'qmark'
+
+# T-SQL pattern -> SQLite replacement, applied to every statement before it is run
+REWRITES = [
+    (re.compile(r"string_split\(([^,()]+), ','\)"), r"json_each('[' || \1 || ']')"),
+    (re.compile(r"dateadd\((\w+),", re.IGNORECASE), r"dateadd('\1',"),
+]
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# text values read back as datetime, as pymssql returns date and datetime columns
+TIME_VALUE = re.compile(r"\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?$")
+
+def _concat(*values):
+    # T-SQL concat: null arguments are empty strings
+    return ''.join('' if v is None else str(v) for v in values)
+
+def _dateadd(unit, n, value):
+    if n is None or value is None:
+        return None
+    return (_to_datetime(value) + timedelta(**{unit.lower() + 's': n})).strftime(TIME_FORMAT)
+
+def _ceiling(value):
+    return None if value is None else -int(-value // 1)
+
+def _checksum(*values):
+    return zlib.crc32(repr(values).encode('utf-8')) - 2**31
+
+class _ChecksumAgg:
+    # T-SQL checksum_agg: xor of the checksums of a group
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= value
+
+    def finalize(self):
+        return self.value
+
+def _to_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+def _read_value(value):
+    if isinstance(value, str) and TIME_VALUE.match(value):
+        return datetime.fromisoformat(value)
+    return value
+
+def translate(query):
+    for pattern, replacement in REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+class Cursor:
+    """DB-API cursor translating each statement (see translate) and returning date and datetime values as datetime"""
+    def __init__(self, cur):
+        self.cur = cur
+        self.arraysize = cur.arraysize
+
+    @property
+    def description(self):
+        return self.cur.description
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+    def execute(self, query, params = ()):
+        self.cur.execute(translate(query), params or ())
+        return self
+
+    def executemany(self, query, seq_of_params):
+        self.cur.executemany(translate(query), seq_of_params)
+        return self
+
+    def fetchone(self):
+        row = self.cur.fetchone()
+        return None if row is None else tuple(_read_value(v) for v in row)
+
+    def fetchmany(self, size = None):
+        return [tuple(_read_value(v) for v in row) for row in self.cur.fetchmany(size or self.arraysize)]
+
+    def fetchall(self):
+        return [tuple(_read_value(v) for v in row) for row in self.cur.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.cur.close()
+
+class Connection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return Cursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+def connect(database = ':memory:', **kwargs):
+    """Output: a DB-API connection to the SQLite file database; it can be used from any thread (the service pool
+        hands connections to its executor threads). Other keyword arguments (server, user, password) are ignored.
+    """
+    conn = sqlite3.connect(database, check_same_thread=False)
+    conn.create_function('concat', -1, _concat)
+    conn.create_function('dateadd', 3, _dateadd)
+    conn.create_function('ceiling', 1, _ceiling)
+    conn.create_function('checksum', -1, _checksum)
+    conn.create_aggregate('checksum_agg', 1, _ChecksumAgg)
+    return Connection(conn)
+
+# SCHEMA
+# The columns of the OMOP CDM tables convertPheno reads
+TABLES = {
+    'person': 'person_id integer primary key, gender_concept_id integer, birth_datetime text',
+    'death': 'person_id integer primary key, death_datetime text',
+    'visit_occurrence': 'visit_occurrence_id integer primary key, person_id integer, visit_concept_id integer, visit_start_date text',
+    'condition_occurrence': """condition_occurrence_id integer primary key, person_id integer, condition_concept_id integer,
+        condition_source_concept_id integer, condition_start_date text, condition_end_date text, visit_occurrence_id integer""",
+    'observation': """observation_id integer primary key, person_id integer, observation_concept_id integer,
+        observation_source_concept_id integer, value_as_concept_id integer, value_as_string text, observation_date text,
+        observation_datetime text, visit_occurrence_id integer""",
+    'measurement': """measurement_id integer primary key, person_id integer, measurement_concept_id integer,
+        measurement_source_concept_id integer, value_as_number real, value_as_concept_id integer, unit_concept_id integer,
+        range_low real, range_high real, measurement_date text, measurement_datetime text, visit_occurrence_id integer""",
+    'drug_exposure': """drug_exposure_id integer primary key, person_id integer, drug_concept_id integer,
+        drug_source_concept_id integer, route_concept_id integer, drug_exposure_start_date text, days_supply integer,
+        quantity real, drug_type_concept_id integer, visit_occurrence_id integer""",
+    'procedure_occurrence': """procedure_occurrence_id integer primary key, person_id integer, procedure_concept_id integer,
+        procedure_source_concept_id integer, procedure_date text, procedure_datetime text, visit_occurrence_id integer""",
+    'concept': """concept_id integer primary key, concept_name text, domain_id text, vocabulary_id text, concept_class_id text,
+        standard_concept text, concept_code text""",
+    'concept_relationship': 'concept_id_1 integer, concept_id_2 integer, relationship_id text',
+    'concept_ancestor': 'ancestor_concept_id integer, descendant_concept_id integer',
+    'drug_strength': """drug_concept_id integer, ingredient_concept_id integer, amount_value real, amount_unit_concept_id integer,
+        invalid_reason text""",
+    'vocabulary': 'vocabulary_id text primary key, vocabulary_name text, vocabulary_version text',
+}
+INDEXED_TABLES = ['death', 'visit_occurrence', 'condition_occurrence', 'observation', 'measurement', 'drug_exposure',
+                  'procedure_occurrence']
+
+# (concept_id, concept_name, domain_id, vocabulary_id, concept_code) of the synthetic vocabulary
+CONCEPTS = [
+    (8507, 'MALE', 'Gender', 'Gender', 'M'),
+    (8532, 'FEMALE', 'Gender', 'Gender', 'F'),
+    (9201, 'Inpatient Visit', 'Visit', 'Visit', 'IP'),
+    (9202, 'Outpatient Visit', 'Visit', 'Visit', 'OP'),
+    (201826, 'Type 2 diabetes mellitus', 'Condition', 'SNOMED', '44054006'),
+    (316866, 'Hypertensive disorder', 'Condition', 'SNOMED', '38341003'),
+    (255573, 'Chronic obstructive lung disease', 'Condition', 'SNOMED', '13645005'),
+    (4024659, 'Lung structure', 'Spec Anatomic Site', 'SNOMED', '39607008'),
+    (4058243, 'Smoker', 'Observation', 'SNOMED', '77176002'),
+    (4188539, 'Yes', 'Meas Value', 'SNOMED', '373066001'),
+    (3004410, 'Hemoglobin A1c', 'Measurement', 'LOINC', '4548-4'),
+    (3027018, 'Heart rate', 'Measurement', 'LOINC', '8867-4'),
+    (8554, 'percent', 'Unit', 'UCUM', '%'),
+    (8541, 'per minute', 'Unit', 'UCUM', '/min'),
+    (1503297, 'metformin', 'Drug', 'RxNorm', '6809'),
+    (1308216, 'lisinopril', 'Drug', 'RxNorm', '29046'),
+    (4128794, 'Oral', 'Route', 'SNOMED', '26643006'),
+    (8576, 'milligram', 'Unit', 'UCUM', 'mg'),
+    (38000177, 'Prescription written', 'Type Concept', 'Type Concept', 'OMOP4976890'),
+    (4230911, 'Spirometry', 'Procedure', 'SNOMED', '127783003'),
+]
+CONDITIONS = [201826, 316866, 255573]
+MEASUREMENTS = [(3004410, 8554, 4.0, 5.6), (3027018, 8541, 60.0, 100.0)]
+DRUGS = [1503297, 1308216]
+
+def create_schema(conn):
+    cur = conn.cursor()
+    for table, columns in TABLES.items():
+        cur.execute("create table if not exists " + table + " (" + columns + ")")
+    for table in INDEXED_TABLES:
+        cur.execute("create index if not exists ix_" + table + "_person on " + table + " (person_id)")
+    if cur.execute("select count(*) from vocabulary").fetchone()[0]:
+        return
+    cur.executemany("insert into concept values (?, ?, ?, ?, null, 'S', ?)", CONCEPTS)
+    cur.executemany("insert into concept_relationship values (?, 4024659, ?)",
+                    [(255573, 'Has finding site'), (4230911, 'Has proc site')])
+    cur.executemany("insert into drug_strength values (?, ?, ?, 8576, null)", [(1503297, 1503297, 500.0), (1308216, 1308216, 10.0)])
+    cur.execute("insert into vocabulary values ('None', 'OMOP Standardized Vocabularies', 'stand-in v1')")
+    conn.commit()
+
+def _time(rng, start, days):
+    return (start + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))).strftime(TIME_FORMAT)
+
+def create_database(database, persons = 1000, seed = 0, rows_per_person = 20):
+    """Creates the OMOP tables in database and adds persons synthetic persons with about rows_per_person event rows each
+        Output: list of the person_ids added
+    """
+    rng = random.Random(seed)
+    conn = connect(database)
+    create_schema(conn)
+    cur = conn.cursor()
+    first = (cur.execute("select coalesce(max(person_id), 0) from person").fetchone()[0] or 0) + 1
+    pids = list(range(first, first + persons))
+    ids = {table: (cur.execute("select coalesce(max(rowid), 0) from " + table).fetchone()[0] or 0) for table in INDEXED_TABLES}
+
+    def next_id(table):
+        ids[table] += 1
+        return ids[table]
+
+    rows = {table: [] for table in INDEXED_TABLES}
+    people = []
+    for pid in pids:
+        born = datetime(1930, 1, 1) + timedelta(days=rng.randrange(70 * 365))
+        people.append((pid, rng.choice([8507, 8532]), born.strftime(TIME_FORMAT)))
+        start = max(born, datetime(2000, 1, 1))
+        if rng.random() < 0.1:
+            rows['death'].append((pid, _time(rng, datetime(2020, 1, 1), 1000)))
+        for _ in range(max(1, int(rng.expovariate(1 / rows_per_person)))):
+            day = _time(rng, start, 8000)
+            visit = next_id('visit_occurrence')
+            rows['visit_occurrence'].append((visit, pid, rng.choice([9201, 9202]), day[:10]))
+            kind = rng.random()
+            if kind < 0.25:
+                rows['condition_occurrence'].append((next_id('condition_occurrence'), pid, rng.choice(CONDITIONS), 0,
+                                                     day[:10], None, visit))
+            elif kind < 0.35:
+                rows['observation'].append((next_id('observation'), pid, 4058243, 0, 4188539, None, day[:10], day, visit))
+            elif kind < 0.75:
+                concept, unit, low, high = rng.choice(MEASUREMENTS)
+                rows['measurement'].append((next_id('measurement'), pid, concept, 0, round(rng.uniform(low * 0.8, high * 1.2), 1),
+                                            None, unit, low, high, day[:10], day, visit))
+            elif kind < 0.95:
+                days = rng.choice([0, 30, 90])
+                rows['drug_exposure'].append((next_id('drug_exposure'), pid, rng.choice(DRUGS), 0, 4128794, day[:10], days,
+                                              days * rng.choice([1, 2]), 38000177, visit))
+            else:
+                rows['procedure_occurrence'].append((next_id('procedure_occurrence'), pid, 4230911, 0, day[:10], day, visit))
+    cur.executemany("insert into person values (?, ?, ?)", people)
+    for table, values in rows.items():
+        if values:
+            cur.executemany("insert into " + table + " values (" + ','.join('?' * len(values[0])) + ")", values)
+    conn.commit()
+    conn.close()
+    return pids
+
+def add_visit(database, pid, day = None):
+    """Adds an outpatient visit of person pid (today unless day is given), a change get_freshness_query detects"""
+    conn = connect(database)
+    cur = conn.cursor()
+    cur.execute("insert into visit_occurrence (person_id, visit_concept_id, visit_start_date) values (?, 9202, ?)",
+                (int(pid), (day or datetime.now()).strftime('%Y-%m-%d')))
+    conn.commit()
+    conn.close()
+
+def read_person_ids(database):
+    conn = connect(database)
+    pids = [r[0] for r in conn.cursor().execute("select person_id from person order by person_id").fetchall()]
+    conn.close()
+    return pids
+
+# COMMAND LINE
+def service_opts(args):
+    return {'service_cache_size': args.cache_size, 'service_batch_ms': args.batch_ms, 'service_max_batch': args.max_batch,
+            'service_fresh_seconds': args.fresh_seconds, 'pool_size': args.pool_size, 'drug_strength_dir': args.drug_strength_dir}
+
+async def _get_json(host, port, target):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    return json.loads(response.partition(b'\r\n\r\n')[2])
+
+async def bench(database, opts, host, port, requests, concurrency):
+    # Runs the service on the stand-in database, benchmarks it (see benchmark_service) and reads its counters
+    ready = asyncio.Event()
+    server = asyncio.ensure_future(service.serve({'connect': connect, 'database': database}, opts, host, port, ready))
+    await asyncio.wait([server, asyncio.ensure_future(ready.wait())], return_when=asyncio.FIRST_COMPLETED)
+    if server.done():
+        return server.result()
+    try:
+        results = await service.benchmark_service(host, port, read_person_ids(database), requests, concurrency)
+        results['stats'] = await _get_json(host, port, '/stats')
+    finally:
+        server.cancel()
+    return results
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(prog='omopStandIn', description='SQLite stand-in for the OMOP CDM database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='create a database of synthetic persons')
+    create.add_argument('database')
+    create.add_argument('--persons', type=int, default=1000)
+    create.add_argument('--rows-per-person', type=int, default=20)
+    create.add_argument('--seed', type=int, default=0)
+    visit = commands.add_parser('add-visit', help="add a visit to a person, changing the person's fingerprint")
+    visit.add_argument('database')
+    visit.add_argument('pid', type=int)
+    for name in ('serve', 'bench'):
+        command = commands.add_parser(name, help='run the conversion service' if name == 'serve' else
+                                      'run the conversion service and benchmark it')
+        command.add_argument('database')
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=8080)
+        command.add_argument('--cache-size', type=int, default=convertPheno.DEFAULT_OPTIONS['service_cache_size'])
+        command.add_argument('--batch-ms', type=float, default=convertPheno.DEFAULT_OPTIONS['service_batch_ms'])
+        command.add_argument('--max-batch', type=int, default=convertPheno.DEFAULT_OPTIONS['service_max_batch'])
+        command.add_argument('--fresh-seconds', type=float, default=convertPheno.DEFAULT_OPTIONS['service_fresh_seconds'])
+        command.add_argument('--pool-size', type=int, default=convertPheno.DEFAULT_OPTIONS['pool_size'])
+        command.add_argument('--drug-strength-dir', default=convertPheno.DEFAULT_OPTIONS['drug_strength_dir'])
+        if name == 'bench':
+            command.add_argument('--requests', type=int, default=1000)
+            command.add_argument('--concurrency', type=int, default=16)
+    return parser
+
+def main(argv = None):
+    args = build_arg_parser().parse_args(argv)
+    if args.command == 'create':
+        pids = create_database(args.database, args.persons, args.seed, args.rows_per_person)
+        print(f"{len(pids)} persons added to {args.database}")
+    elif args.command == 'add-visit':
+        add_visit(args.database, args.pid)
+    elif args.command == 'serve':
+        try:
+            asyncio.run(service.serve({'connect': connect, 'database': args.database}, service_opts(args), args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        results = asyncio.run(bench(args.database, service_opts(args), args.host, args.port, args.requests, args.concurrency))
+        print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# convertPheno.py, omopStandIn.py and omop2pheno live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import omopStandIn
+
+
+@pytest.fixture(scope='session')
+def standin_db(tmp_path_factory):
+    # A small synthetic OMOP database in the SQLite stand-in, shared by the tests of a session
+    database = str(tmp_path_factory.mktemp('omop') / 'omop.db')
+    omopStandIn.create_database(database, persons = 12, seed = 1, rows_per_person = 5)
+    return database
+
+
+@pytest.fixture
+def conn_args(standin_db):
+    return {'connect': omopStandIn.connect, 'database': standin_db}
@@ -0,0 +1,91 @@
+import itertools
+import operator
+import random
+
+import pytest
+
+import convertPheno
+
+
+def random_records(seed, n, keys):
+    # (key, position) pairs: keys repeat, the position shows whether equal keys kept their input order
+    rng = random.Random(seed)
+    return [(rng.randrange(keys), i) for i in range(n)]
+
+
+def count_spills(monkeypatch):
+    spills = []
+    spill_run = convertPheno._spill_run
+    def counted(run, tmp_dir = None):
+        spills.append(1)
+        return spill_run(run, tmp_dir)
+    monkeypatch.setattr(convertPheno, '_spill_run', counted)
+    return spills
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('n, max_records', [(0, 3), (1, 3), (50, 1), (50, 3), (50, 7), (50, 50), (50, None)])
+def test_external_sort_matches_sorted(seed, n, max_records):
+    records = random_records(seed, n, 10)
+    key = operator.itemgetter(0)
+    assert list(convertPheno.external_sort(iter(records), key, max_records)) == sorted(records, key=key)
+
+
+def test_external_sort_spills(monkeypatch, tmp_path):
+    spills = count_spills(monkeypatch)
+    records = random_records(0, 100, 10)
+    key = operator.itemgetter(0)
+    assert list(convertPheno.external_sort(iter(records), key, 8, str(tmp_path))) == sorted(records, key=key)
+    assert len(spills) == 100 // 8
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_external_sort_merges_more_runs_than_the_fanin(monkeypatch, seed):
+    spills = count_spills(monkeypatch)
+    n, max_records = 2 * convertPheno.SORT_MAX_FANIN * 3 + 5, 2
+    records = random_records(seed, n, 20)
+    key = operator.itemgetter(0)
+    assert list(convertPheno.external_sort(iter(records), key, max_records)) == sorted(records, key=key)
+    runs = n // max_records
+    # Every SORT_MAX_FANIN runs are merged into one run that is spilled as well
+    assert runs > convertPheno.SORT_MAX_FANIN
+    assert len(spills) > runs
+
+
+def expected_groups(records, sort_key, group_key = None):
+    return [(k, list(g)) for k, g in itertools.groupby(sorted(records, key=sort_key), key=group_key or sort_key)]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('max_records', [1, 2, 5, None])
+def test_external_group_matches_groupby(seed, max_records):
+    records = random_records(seed, 200, 7)
+    key = operator.itemgetter(0)
+    groups = list(convertPheno.external_group(iter(records), key, max_records = max_records))
+    assert groups == expected_groups(records, key)
+
+
+def test_external_group_spans_runs():
+    # Few keys and tiny buffers: every group is made of records from many spilled runs
+    records = random_records(1, 3 * convertPheno.SORT_MAX_FANIN * 4, 3)
+    key = operator.itemgetter(0)
+    groups = list(convertPheno.external_group(iter(records), key, max_records = 4))
+    assert groups == expected_groups(records, key)
+    assert all(len(g) > 4 for k, g in groups)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_external_group_by_a_coarser_key(seed):
+    # Sorted by (person, date), grouped by person, as the domain records are
+    rng = random.Random(seed)
+    records = [{'person_id': rng.randrange(5), 'date': rng.randrange(30), 'n': i} for i in range(150)]
+    sort_key = operator.itemgetter('person_id', 'date')
+    group_key = operator.itemgetter('person_id')
+    groups = list(convertPheno.external_group(iter(records), sort_key, group_key, max_records = 3))
+    assert groups == expected_groups(records, sort_key, group_key)
+
+
+def test_group_by_person():
+    records = [{'person_id': p, 'n': i} for i, p in enumerate([3, 1, 3, 2, 1, 3])]
+    groups = list(convertPheno.group_by_person(iter(records), max_records = 2))
+    assert [(p, [r['n'] for r in rows]) for p, rows in groups] == [(1, [1, 4]), (2, [3]), (3, [0, 2, 5])]
@@ -0,0 +1,116 @@
+"""
+Golden files of PhenopacketToJson: tests/golden/<name>.indent2.json, .indent0.json and .compact.json hold the 
+MessageToJson output of golden_phenopacket and of Phenopackets converted from the SQLite stand-in (omopStandIn.py) at 
+indent 2, 0 and None. `python tests/test_json.py` writes them again, e.g. after a protobuf upgrade.
+"""
+import glob
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+from google.protobuf.json_format import MessageToJson, Parse
+from google.protobuf.timestamp_pb2 import Timestamp
+from phenopackets import Phenopacket
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import convertPheno
+import omopStandIn
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+# Suffix of a golden file -> indent
+INDENTS = {'indent2': 2, 'indent0': 0, 'compact': None}
+# Converted persons written as golden files, those of the stand-in database with the most entries
+CONVERTED_PACKETS = 4
+
+
+def golden_path(name, suffix):
+    return os.path.join(GOLDEN_DIR, f"{name}.{suffix}.json")
+
+
+def converted_phenopackets(n = CONVERTED_PACKETS):
+    # Phenopackets of a fixed synthetic database, with a fixed metadata timestamp
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, 'omop.db')
+        omopStandIn.create_database(database, persons = 20, seed = 3, rows_per_person = 12)
+        conn_args = {'connect': omopStandIn.connect, 'database': database}
+        opts = dict(convertPheno.DEFAULT_OPTIONS, vocabulary_version = 'v1', drug_strength_dir = tmp)
+        meta_data = convertPheno.createMetadata('omop2pheno')
+        meta_data['created'] = Timestamp(seconds=1700000000)
+        pool = convertPheno.ConnectionPool(conn_args)
+        cur = convertPheno.PooledCursor(pool)
+        try:
+            lists, timings = convertPheno.extract_chunk(cur, omopStandIn.read_person_ids(database), opts, {})
+            packets = list(convertPheno.iter_packets(lists, meta_data))
+        finally:
+            cur.close()
+            pool.close()
+    packets.sort(key=lambda item: -item[1].ByteSize())
+    return {f"person{pid}": pheno for pid, pheno in packets[:n]}
+
+
+def write_golden():
+    packets = dict(converted_phenopackets(), golden=convertPheno.golden_phenopacket())
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    for f in glob.glob(os.path.join(GOLDEN_DIR, '*.json')):
+        os.remove(f)
+    for name, pheno in packets.items():
+        for suffix, indent in INDENTS.items():
+            with open(golden_path(name, suffix), 'w', encoding='utf-8') as f:
+                f.write(MessageToJson(pheno, indent=indent))
+
+
+def read_golden(name, suffix):
+    with open(golden_path(name, suffix), encoding='utf-8') as f:
+        return f.read()
+
+
+GOLDEN_NAMES = sorted({os.path.basename(f).split('.')[0] for f in glob.glob(os.path.join(GOLDEN_DIR, '*.json'))})
+
+
+def golden_message(name):
+    # The golden files define the message: MessageToJson output parses back to the message it was written from
+    return Parse(read_golden(name, 'indent2'), Phenopacket())
+
+
+def test_golden_files():
+    assert 'golden' in GOLDEN_NAMES
+    assert len([n for n in GOLDEN_NAMES if n.startswith('person')]) == CONVERTED_PACKETS
+    for name in GOLDEN_NAMES:
+        for suffix in INDENTS:
+            assert os.path.exists(golden_path(name, suffix))
+
+
+@pytest.mark.parametrize('suffix', sorted(INDENTS))
+def test_golden_phenopacket_matches_its_golden_file(suffix):
+    # Its golden files are not parsed back: the sign of its negated NaN is lost in JSON
+    pheno = convertPheno.golden_phenopacket()
+    assert MessageToJson(pheno, indent=INDENTS[suffix]) == read_golden('golden', suffix)
+    if INDENTS[suffix] is not None:
+        assert convertPheno.PhenopacketToJson(pheno, INDENTS[suffix]) == read_golden('golden', suffix)
+
+
+@pytest.mark.parametrize('name', GOLDEN_NAMES)
+@pytest.mark.parametrize('suffix', ['indent2', 'indent0'])
+def test_indented(name, suffix):
+    assert convertPheno.PhenopacketToJson(golden_message(name), INDENTS[suffix]) == read_golden(name, suffix)
+
+
+@pytest.mark.parametrize('name', GOLDEN_NAMES)
+def test_compact_with_json(name, monkeypatch):
+    monkeypatch.setattr(convertPheno, 'orjson', None)
+    assert convertPheno.PhenopacketToJson(golden_message(name), None) == read_golden(name, 'compact')
+
+
+@pytest.mark.parametrize('name', GOLDEN_NAMES)
+def test_compact_with_orjson(name):
+    # orjson only differs in whitespace and by writing non-ASCII characters unescaped
+    pytest.importorskip('orjson')
+    assert json.loads(convertPheno.PhenopacketToJson(golden_message(name), None)) == json.loads(read_golden(name, 'compact'))
+
+
+if __name__ == '__main__':
+    write_golden()
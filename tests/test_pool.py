@@ -0,0 +1,100 @@
+import pytest
+
+import convertPheno
+import omopStandIn
+
+
+def count_query(pids, pool):
+    # A parameterized statement: the person_ids are sent as one parameter, see batch_pid
+    qpid, params = convertPheno.batch_pid(pids, convertPheno.DEFAULT_OPTIONS, pool.paramstyle)
+    return "select count(*) from person where person_id in " + qpid + ";", params
+
+
+def test_pool_reuses_connections_and_statements(conn_args, standin_db):
+    pool = convertPheno.ConnectionPool(conn_args)
+    pids = omopStandIn.read_person_ids(standin_db)
+    opts = dict(convertPheno.DEFAULT_OPTIONS, vocabulary_version = 'v1')
+
+    cur = convertPheno.PooledCursor(pool)
+    convertPheno.extract_chunk(cur, pids[:6], opts, {})
+    cur.close()
+    first = dict(pool.stats)
+    assert first['connects'] == 1
+    assert first['prepares'] > 0
+    assert first['executions'] >= first['prepares']
+
+    # The second chunk runs the same statements on the pooled connection: nothing is connected or prepared again
+    cur = convertPheno.PooledCursor(pool)
+    convertPheno.extract_chunk(cur, pids[6:], opts, {})
+    cur.close()
+    assert pool.stats['connects'] == 1
+    assert pool.stats['prepares'] == first['prepares']
+    assert pool.stats['executions'] - first['executions'] == first['prepares']
+    assert pool.stats['reconnects'] == 0
+    pool.close()
+
+
+def test_statement_counters(conn_args):
+    pool = convertPheno.ConnectionPool(conn_args)
+    cur = convertPheno.PooledCursor(pool)
+    query, params = count_query([1, 2, 3], pool)
+    cur.execute(query, params)
+    assert cur.fetchall() == [(3,)]
+    query, params = count_query([4, 5], pool)
+    cur.execute(query, params)
+    assert cur.fetchall() == [(2,)]
+    cur.execute("select count(*) from person;")
+    assert cur.fetchall() == [(12,)]
+    cur.close()
+    assert pool.stats == {'connects': 1, 'reconnects': 0, 'checks': 0, 'prepares': 1, 'executions': 3}
+    pool.close()
+
+
+def test_dropped_connection_is_retried(conn_args):
+    pool = convertPheno.ConnectionPool(conn_args)
+    cur = convertPheno.PooledCursor(pool)
+    query, params = count_query([1, 2, 3], pool)
+    cur.execute(query, params)
+    assert cur.fetchall() == [(3,)]
+
+    cur.entry[0].close() # dropped by the server
+    cur.execute(query, params)
+    assert cur.fetchall() == [(3,)]
+    cur.close()
+    assert pool.stats['connects'] == 2
+    assert pool.stats['reconnects'] == 1
+    assert pool.stats['checks'] == 1
+    # The statement is prepared again on the new connection, the failed attempt is counted as well
+    assert pool.stats['prepares'] == 2
+    assert pool.stats['executions'] == 3
+    pool.close()
+
+
+def test_dropped_idle_connection_is_replaced(conn_args):
+    pool = convertPheno.ConnectionPool(conn_args, check_seconds = -1)
+    cur = convertPheno.PooledCursor(pool)
+    cur.execute("select 1;")
+    cur.fetchall()
+    cur.close()
+    pool.idle[0][0].close()
+
+    cur = convertPheno.PooledCursor(pool)
+    cur.execute("select count(*) from person;")
+    assert cur.fetchall() == [(12,)]
+    cur.close()
+    assert pool.stats['checks'] == 1
+    assert pool.stats['reconnects'] == 1
+    assert pool.stats['connects'] == 2
+    pool.close()
+
+
+def test_errors_on_a_live_connection_are_raised(conn_args):
+    pool = convertPheno.ConnectionPool(conn_args)
+    cur = convertPheno.PooledCursor(pool)
+    with pytest.raises(Exception):
+        cur.execute("select * from no_such_table;")
+    cur.close()
+    assert pool.stats['checks'] == 1
+    assert pool.stats['reconnects'] == 0
+    assert pool.stats['connects'] == 1
+    pool.close()
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+from phenopackets import Individual, Phenopacket
+
+import convertPheno
+
+
+def packet(pid):
+    return Phenopacket(id=f"phenopacket-{pid}", subject=Individual(id=str(pid)))
+
+
+def write_chunks(store_dir, chunks):
+    # chunks: list of person_id lists, one data file and index per chunk, indexed together into index.idx
+    for chunk_id, pids in enumerate(chunks):
+        convertPheno.write_store_chunk([(pid, packet(pid)) for pid in pids], chunk_id, store_dir)
+    return convertPheno.build_store_index(store_dir)
+
+
+def test_store_round_trip(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    # Unsorted person_ids, a chunk without Phenopackets, and chunks whose person_ids interleave
+    chunks = [[9, 1, 5], [], [12, 3, 7], [2]]
+    assert write_chunks(store_dir, chunks) == 7
+    assert sorted(os.listdir(store_dir)) == ['chunk00000.idx', 'chunk00000.pb', 'chunk00001.idx', 'chunk00001.pb',
+                                             'chunk00002.idx', 'chunk00002.pb', 'chunk00003.idx', 'chunk00003.pb', 'index.idx']
+
+    with convertPheno.PhenopacketStore(store_dir) as store:
+        assert len(store) == 7
+        assert store.ids() == [1, 2, 3, 5, 7, 9, 12]
+        for pid in (1, 12, 5, 2): # first, last, and one of every other chunk
+            assert pid in store
+            assert store.get(pid) == packet(pid)
+            assert bytes(store.get_bytes(pid)) == packet(pid).SerializeToString()
+            assert store.get_json(pid) == convertPheno.PhenopacketToJson(packet(pid))
+        for pid in (0, 4, 13): # before the first, between two and after the last person_id
+            assert pid not in store
+            assert store.get(pid) is None
+            assert store.get_bytes(pid) is None
+            assert store.get_json(pid) is None
+
+
+def test_store_index_locates_chunks(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    write_chunks(store_dir, [[4, 2], [], [3, 1]])
+    ids, offsets, lengths, chunks = convertPheno.read_store_index(os.path.join(store_dir, 'index.idx'))
+    assert ids.tolist() == [1, 2, 3, 4]
+    assert chunks.tolist() == [2, 0, 2, 0]
+    for pid, offset, length, chunk_id in zip(ids, offsets, lengths, chunks):
+        with open(convertPheno.store_data_file(store_dir, int(chunk_id)), 'rb') as f:
+            f.seek(int(offset))
+            assert f.read(int(length)) == packet(pid).SerializeToString()
+
+
+def test_empty_store(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    assert write_chunks(store_dir, [[]]) == 0
+    assert os.path.getsize(convertPheno.store_data_file(store_dir, 0)) == 0
+    with convertPheno.PhenopacketStore(store_dir) as store:
+        assert len(store) == 0
+        assert store.ids() == []
+        assert store.get(1) is None
+        assert store.get_json(1) is None
+
+
+def test_store_index_is_rebuilt(tmp_path):
+    store_dir = str(tmp_path / 'store')
+    write_chunks(store_dir, [[1, 2]])
+    convertPheno.write_store_chunk({5: packet(5)}, 1, store_dir)
+    assert convertPheno.build_store_index(store_dir) == 3
+    with convertPheno.PhenopacketStore(store_dir) as store:
+        assert store.ids() == [1, 2, 5]
+        assert store.get(5) == packet(5)
+
+
+def test_write_packets_store(tmp_path):
+    opts = dict(convertPheno.DEFAULT_OPTIONS, output_path=str(tmp_path), output_format='store')
+    written = convertPheno.write_packets(iter([(8, packet(8)), (6, packet(6))]), 3, opts)
+    store_dir = str(tmp_path / 'store')
+    assert written == [convertPheno.store_data_file(store_dir, 3), os.path.join(store_dir, 'chunk00003.idx')]
+    convertPheno.build_store_index(store_dir)
+    with convertPheno.PhenopacketStore(store_dir) as store:
+        assert store.ids() == [6, 8]
+        assert store.get(8) == packet(8)
+
+
+def test_not_a_store(tmp_path):
+    with open(tmp_path / 'index.idx', 'wb') as f:
+        f.write(convertPheno.STORE_HEADER.pack(b'XXXX', convertPheno.STORE_VERSION, 0))
+    with pytest.raises(ValueError):
+        convertPheno.PhenopacketStore(str(tmp_path))